@@ -1,35 +1,110 @@
+import mimetypes
 import os
 
-from flask import Flask, render_template, request, flash, redirect, session, g
-from flask_debugtoolbar import DebugToolbarExtension
-from sqlalchemy.exc import IntegrityError
-
+from flask import (Flask, Blueprint, render_template, request, flash, redirect,
+                   session, g, abort, send_file, safe_join, jsonify, current_app,
+                   Response, stream_with_context)
+from sqlalchemy.exc import DBAPIError, IntegrityError
+from werkzeug.exceptions import ServiceUnavailable
+
+from archive import archived_messages, has_archive
+from assets import BUILD_DIR, asset_url, precompressed
+from bulk import MAX_REQUEST_USERS, follow_users, unfollow_users
+from compression import Compressor
+from config import CONFIGS
+from deadlines import DeadlineExceeded, LastGoodCache, is_deadline_error, statement_timeout
+from export import DATASETS, FORMATS, export
+from followgraph import init_follow_graph, apply_recorded_follows, record_user_deleted
 from forms import UserAddForm, LoginForm, MessageForm, UserUpdateForm
-from models import db, connect_db, User, Message, Likes
+from hashtags import index_message, linkify, trending
+from images import (VARIANTS, CACHE_HEADERS, ImageUnavailable, get_cache,
+                    resized, sign)
+from memprofile import MemoryProfiler
+from models import (db, connect_db, follow_graph, User, Follows, Tag,
+                    Recommendation)
+from notifications import notify, mark_seen, unread_count, notification_page
+from queries import (home_feed, user_messages, message_by_id, liked_messages,
+                     liked_ids, message_count, like_count, add_message,
+                     delete_message, toggle_like, delete_user_rows, tag_messages)
+from querytrace import QueryTracer
+from search import search_messages
+from sharding import init_shards, shard_router
+from singleflight import SingleFlight, detached_session
+from snowflake import init_ids
+from templating import init_templates
 
 CURR_USER_KEY = "curr_user"
 
-app = Flask(__name__)
+views = Blueprint('views', __name__)
+
+
+def create_app(config=None):
+    """Create the Warbler app.
+
+    `config` is a class from config.py or its name ('development',
+    'testing' or 'production'); the default is picked by FLASK_ENV.
+
+    Nothing here touches the database, so the app can be created in a
+    server's master process and shared by the workers it forks (see
+    gunicorn.conf.py).
+    """
+
+    if config is None:
+        config = os.environ.get('FLASK_ENV', 'production')
+
+    if isinstance(config, str):
+        config = CONFIGS[config]
+
+    app = Flask(__name__)
+    app.config.from_object(config)
+
+    if app.config['IMAGE_CACHE_DIR'] is None:
+        app.config['IMAGE_CACHE_DIR'] = os.path.join(app.instance_path, 'image-cache')
+
+    if app.config['ARCHIVE_DIR'] is None:
+        app.config['ARCHIVE_DIR'] = os.path.join(app.instance_path, 'archive')
+
+    init_templates(app)
+
+    if app.config['DEBUG_TOOLBAR']:
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
+
+    connect_db(app)
+
+    init_ids(app)
 
-# Get DB_URI from environ variable (useful for production/testing) or,
-# if not set there, use development local db.
-app.config['SQLALCHEMY_DATABASE_URI'] = (
-    os.environ.get('DATABASE_URL', 'postgresql:///warbler'))
+    init_shards(app)
 
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = False
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
-toolbar = DebugToolbarExtension(app)
+    init_follow_graph(app)
 
-connect_db(app)
+    Compressor(app)
+
+    if app.config['QUERY_TRACE']:
+        QueryTracer(app)
+
+    if app.config['MEMORY_PROFILE_RATE'] > 0:
+        MemoryProfiler(app)
+
+    app.extensions['singleflight'] = SingleFlight()
+    app.extensions['last_good'] = LastGoodCache(
+        app, app.config['LAST_GOOD_CACHE_SIZE'], app.config['STALE_REFRESH_DEADLINE_MS'])
+
+    app.add_template_filter(linkify)
+    app.add_template_filter(resized)
+    app.add_template_global(asset_url)
+    app.add_template_global(unread_notifications)
+
+    app.register_blueprint(views)
+
+    return app
 
 
 ##############################################################################
 # User signup/login/logout
 
 
-@app.before_request
+@views.before_app_request
 def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
 
@@ -53,7 +128,7 @@ def do_logout():
         del session[CURR_USER_KEY]
 
 
-@app.route('/signup', methods=["GET", "POST"])
+@views.route('/signup', methods=["GET", "POST"])
 def signup():
     """Handle user signup.
 
@@ -89,7 +164,7 @@ def signup():
         return render_template('users/signup.html', form=form)
 
 
-@app.route('/login', methods=["GET", "POST"])
+@views.route('/login', methods=["GET", "POST"])
 def login():
     """Handle user login."""
 
@@ -109,7 +184,7 @@ def login():
     return render_template('users/login.html', form=form)
 
 
-@app.route('/logout')
+@views.route('/logout')
 def logout():
     """Handle logout of user."""
 
@@ -120,10 +195,171 @@ def logout():
     return redirect('/login')
 
 
+def following_ids(user_id, session=db.session):
+    """Return the ids of the users `user_id` follows."""
+
+    graph = follow_graph()
+
+    if graph is not None:
+        return graph.following(user_id)
+
+    return [followed_id for (followed_id,) in (session
+                                               .query(Follows.user_being_followed_id)
+                                               .filter(Follows.user_following_id == user_id))]
+
+
+def users_in_graph(user, direction):
+    """Return the users `user` follows ('following') or is followed by
+    ('followers'), looked up in the follow graph if it's enabled."""
+
+    graph = follow_graph()
+
+    if graph is None:
+        return getattr(user, direction).all()
+
+    ids = getattr(graph, direction)(user.id)
+    return User.query.filter(User.id.in_(ids)).all() if ids else []
+
+
+def profile_counts(user, session=db.session):
+    """Return the message, following, follower and like counts for a profile."""
+
+    return dict(messages=message_count(session, user.id),
+                following=user.following_count(),
+                followers=user.followers_count(),
+                likes=like_count(session, user.id))
+
+
+def liked_by_viewer(messages):
+    """Return the set of ids of `messages` the logged-in user has liked
+    (none on a page served stale)."""
+
+    if not g.user or g.get('stale'):
+        return set()
+
+    return liked_ids(db.session, g.user.id, [message.id for message in messages])
+
+
+def followed_by_viewer(users):
+    """Return the set of ids of `users` the logged-in user follows."""
+
+    if not g.user or not users:
+        return set()
+
+    graph = follow_graph()
+
+    if graph is not None:
+        return {user.id for user in users if graph.is_following(g.user.id, user.id)}
+
+    return {followed_id for (followed_id,) in (db.session
+                                               .query(Follows.user_being_followed_id)
+                                               .filter(Follows.user_following_id == g.user.id)
+                                               .filter(Follows.user_being_followed_id
+                                                       .in_([user.id for user in users])))}
+
+
+##############################################################################
+# Shared page loads
+#
+# Hot pages load their data through current_app.extensions['singleflight'],
+# so concurrent requests for the same page share one load (singleflight.py).
+# Only the data is shared: each request still renders its own page, since
+# follow and like buttons depend on who's looking.
+#
+# The homepage and profiles also have a query deadline: if the database
+# can't load them in time, they're served from their last good load, marked
+# stale, while it's refreshed in the background (deadlines.py). The rest of
+# the request's queries (per-viewer lookups, the navbar) get the same
+# deadline, and 503 if they miss it; on a page served stale they're
+# skipped, since the database just missed a deadline.
+
+
+def load_page(key, load):
+    """Return the page for `key`, loading it with `load(timeout_ms)` if needed.
+
+    Sets g.stale if the page is an older copy served because the database
+    missed the route's deadline; 503s if there's no older copy (there never
+    is for pages past the first).
+    """
+
+    deadline_ms = current_app.config['QUERY_DEADLINES_MS'].get(key[0])
+    last_good = current_app.extensions['last_good']
+
+    # Keys end with the page's `before` cursor; older pages aren't worth
+    # keeping a last good copy of
+    keep = key[-1] is None
+
+    try:
+        page, g.stale = current_app.extensions['singleflight'].do(
+            key, lambda: last_good.fetch(key, load, deadline_ms, keep))
+
+    except DeadlineExceeded:
+        abort(503)
+
+    if deadline_ms is not None:
+        statement_timeout(db.session, deadline_ms)
+
+    return page
+
+
+@views.app_errorhandler(DBAPIError)
+def database_error(exc):
+    """503 a request whose query missed its deadline; re-raise other errors."""
+
+    if not is_deadline_error(exc):
+        raise exc
+
+    db.session.rollback()
+    return ServiceUnavailable()
+
+
+def load_home(user_id, before, timeout_ms=None):
+    """Return everything the homepage reads from the database for a user.
+
+    That's their feed (messages with their authors), profile counts, which
+    of the feed they've liked, who to follow and their unread count, so
+    all of it runs under the deadline and comes from the last good load
+    together.
+    """
+
+    with detached_session(timeout_ms) as session:
+        user = session.query(User).get(user_id)
+        following = following_ids(user_id, session)
+        following.append(user_id)
+        messages = home_feed(session, following, before)
+
+        return dict(messages=messages,
+                    counts=profile_counts(user, session),
+                    likes=liked_ids(session, user_id, [message.id for message in messages]),
+                    suggestions=Recommendation.for_user(user_id, session=session),
+                    unread=unread_count(session, user_id))
+
+
+def load_profile(user_id, before, timeout_ms=None):
+    """Return (user, messages, counts) for users_show, or None if no such user."""
+
+    with detached_session(timeout_ms) as session:
+        user = session.query(User).get(user_id)
+
+        if user is None:
+            return None
+
+        messages = user_messages(session, user_id, before)
+
+        return user, messages, profile_counts(user, session)
+
+
+def load_message(message_id):
+    """Return the message (with its author) for messages_show, or None."""
+
+    with detached_session() as session:
+        return message_by_id(session, message_id)
+
+
 ##############################################################################
 # General user routes:
 
-@app.route('/users')
+@views.route('/users')
 def list_users():
     """Page with listing of users.
 
@@ -137,30 +373,45 @@ def list_users():
     else:
         users = User.query.filter(User.username.like(f"%{search}%")).all()
 
-    return render_template('users/index.html', users=users)
+    return render_template('users/index.html', users=users, follows=followed_by_viewer(users))
 
 
-@app.route('/users/<int:user_id>')
+@views.route('/users/<int:user_id>')
 def users_show(user_id):
     """Show user profile."""
 
-    user = User.query.get_or_404(user_id)
+    before = request.args.get('before', type=int)
 
-    # snagging messages in order from the database;
-    # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
+    page = load_page(('users_show', user_id, before),
+                     lambda timeout_ms: load_profile(user_id, before, timeout_ms))
 
-    likes = [like.id for like in g.user.likes]
-    
-    return render_template('users/show.html', user=user, messages=messages, likes=likes)
+    if page is None:
+        abort(404)
+
+    user, messages, counts = page
+    archived = has_archive(current_app.config['ARCHIVE_DIR'], user.id)
+
+    return render_template('users/show.html', user=user, messages=messages,
+                           counts=counts, likes=liked_by_viewer(messages),
+                           archived=archived)
+
+
+@views.route('/users/<int:user_id>/archive')
+def users_archive(user_id):
+    """Show a user's archived (older) messages.
+
+    Pages back with "?before=<message id>", like the profile page.
+    """
+
+    user = User.query.get_or_404(user_id)
+    messages = archived_messages(current_app.config['ARCHIVE_DIR'], user.id,
+                                 request.args.get('before', type=int))
+
+    return render_template('users/archive.html', user=user, messages=messages,
+                           counts=profile_counts(user))
 
 
-@app.route('/users/<int:user_id>/following')
+@views.route('/users/<int:user_id>/following')
 def show_following(user_id):
     """Show list of people this user is following."""
 
@@ -169,10 +420,13 @@ def show_following(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    users = users_in_graph(user, 'following')
+    return render_template('users/following.html', user=user,
+                           counts=profile_counts(user),
+                           users=users, follows=followed_by_viewer(users))
 
 
-@app.route('/users/<int:user_id>/followers')
+@views.route('/users/<int:user_id>/followers')
 def users_followers(user_id):
     """Show list of followers of this user."""
 
@@ -181,10 +435,44 @@ def users_followers(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    users = users_in_graph(user, 'followers')
+    return render_template('users/followers.html', user=user,
+                           counts=profile_counts(user),
+                           users=users, follows=followed_by_viewer(users))
+
+
+def requested_user_ids():
+    """Return the set of user ids posted to a bulk follow or unfollow, as
+    form fields or a JSON body: {"user_ids": [...]}."""
+
+    if request.is_json:
+        user_ids = (request.get_json(silent=True) or {}).get('user_ids')
+    else:
+        user_ids = request.form.getlist('user_ids')
+
+    if not isinstance(user_ids, list) or len(user_ids) > MAX_REQUEST_USERS:
+        abort(400)
+
+    try:
+        return {int(user_id) for user_id in user_ids}
+    except (TypeError, ValueError):
+        abort(400)
+
+
+def follows_changed(key, user_ids):
+    """Commit a follow or unfollow and respond to the request."""
+
+    if user_ids:
+        db.session.commit()
+        apply_recorded_follows()
 
+    if request.is_json:
+        return jsonify({key: sorted(user_ids)})
 
-@app.route('/users/follow/<int:follow_id>', methods=['POST'])
+    return redirect(f"/users/{g.user.id}/following")
+
+
+@views.route('/users/follow/<int:follow_id>', methods=['POST'])
 def add_follow(follow_id):
     """Add a follow for the currently-logged-in user."""
 
@@ -193,13 +481,28 @@ def add_follow(follow_id):
         return redirect("/")
 
     followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
-    db.session.commit()
 
-    return redirect(f"/users/{g.user.id}/following")
+    followed = follow_users(db.session, g.user.id, [followed_user.id])
+    notify(db.session, 'follow', g.user.id, followed)
+
+    return follows_changed('followed', followed)
+
+
+@views.route('/users/follow', methods=['POST'])
+def add_follows():
+    """Follow every user in the posted `user_ids` at once."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    followed = follow_users(db.session, g.user.id, requested_user_ids())
+    notify(db.session, 'follow', g.user.id, followed)
+
+    return follows_changed('followed', followed)
 
 
-@app.route('/users/stop-following/<int:follow_id>', methods=['POST'])
+@views.route('/users/stop-following/<int:follow_id>', methods=['POST'])
 def stop_following(follow_id):
     """Have currently-logged-in-user stop following this user."""
 
@@ -207,14 +510,22 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
-    db.session.commit()
+    return follows_changed('unfollowed', unfollow_users(db.session, g.user.id, [follow_id]))
 
-    return redirect(f"/users/{g.user.id}/following")
+
+@views.route('/users/stop-following', methods=['POST'])
+def stop_following_many():
+    """Stop following every user in the posted `user_ids` at once."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    return follows_changed('unfollowed',
+                           unfollow_users(db.session, g.user.id, requested_user_ids()))
 
 
-@app.route('/users/profile', methods=["GET", "POST"])
+@views.route('/users/profile', methods=["GET", "POST"])
 def profile():
     """Update profile for current user."""
 
@@ -245,7 +556,7 @@ def profile():
     return render_template('users/edit.html', form=form, user=g.user)
 
 
-@app.route('/users/delete', methods=["POST"])
+@views.route('/users/delete', methods=["POST"])
 def delete_user():
     """Delete user."""
 
@@ -255,16 +566,36 @@ def delete_user():
 
     do_logout()
 
+    record_user_deleted(g.user.id)
+    delete_user_rows(db.session, g.user.id)
     db.session.delete(g.user)
     db.session.commit()
+    apply_recorded_follows()
 
     return redirect("/signup")
 
 
+@views.route('/users/export/<dataset>.<fmt>')
+def export_data(dataset, fmt):
+    """Download the current user's messages, follows or likes."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    if dataset not in DATASETS or fmt not in FORMATS:
+        abort(404)
+
+    chunks = export(g.user.id, dataset, fmt, current_app.config['ARCHIVE_DIR'])
+
+    return Response(stream_with_context(chunks), mimetype=FORMATS[fmt], headers={
+        'Content-Disposition': f'attachment; filename=warbler-{dataset}.{fmt}'})
+
+
 ##############################################################################
 # Messages routes:
 
-@app.route('/messages/new', methods=["GET", "POST"])
+@views.route('/messages/new', methods=["GET", "POST"])
 def messages_add():
     """Add a message:
 
@@ -278,8 +609,12 @@ def messages_add():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
+        msg = add_message(db.session, g.user.id, form.text.data)
+
+        # Tags and mentions refer to messages in the main database
+        if not shard_router().sharded:
+            index_message(msg)
+
         db.session.commit()
 
         return redirect(f"/users/{g.user.id}")
@@ -287,15 +622,35 @@ def messages_add():
     return render_template('messages/new.html', form=form)
 
 
-@app.route('/messages/<int:message_id>', methods=["GET"])
+@views.route('/messages/search')
+def messages_search():
+    """Page with message search results.
+
+    Takes a 'q' param in querystring to search message text, and an 'after'
+    cursor (from the previous page) to page through the results.
+    """
+
+    search = request.args.get('q', '')
+    messages, next_cursor = search_messages(search, request.args.get('after'))
+
+    return render_template('messages/search.html', search=search,
+                           messages=messages, next_cursor=next_cursor)
+
+
+@views.route('/messages/<int:message_id>', methods=["GET"])
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get(message_id)
+    msg = current_app.extensions['singleflight'].do(
+        ('messages_show', message_id), lambda: load_message(message_id))
+
+    if msg is None:
+        abort(404)
+
     return render_template('messages/show.html', message=msg)
 
 
-@app.route('/messages/<int:message_id>/delete', methods=["POST"])
+@views.route('/messages/<int:message_id>/delete', methods=["POST"])
 def messages_destroy(message_id):
     """Delete a message."""
 
@@ -303,18 +658,93 @@ def messages_destroy(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get(message_id)
-    db.session.delete(msg)
+    delete_message(db.session, message_id)
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}")
 
 
+##############################################################################
+# Hashtag routes:
+
+@views.route('/tags/<name>')
+def tags_show(name):
+    """Show the newest messages using a hashtag.
+
+    Pages back through older messages with "?before=<message id>".
+    """
+
+    tag = Tag.query.filter_by(name=name.lower()).first_or_404()
+    before = request.args.get('before', type=int)
+
+    messages = tag_messages(db.session, tag.id, before)
+
+    return render_template('tags/show.html', tag=tag, messages=messages,
+                           likes=liked_by_viewer(messages))
+
+
+##############################################################################
+# Image proxy routes:
+
+@views.route('/images/<variant>/<signature>')
+def proxied_image(variant, signature):
+    """Serve a resized, cached copy of a user image.
+
+    Takes the source URL as the 'src' param in querystring; links are made
+    (and signed) by the `resized` template filter.
+    """
+
+    src = request.args.get('src', '')
+
+    if variant not in VARIANTS or signature != sign(src, variant, current_app.config['SECRET_KEY']):
+        abort(404)
+
+    try:
+        path, mimetype = get_cache().variant(src, variant)
+
+    except ImageUnavailable:
+        if src.startswith(('http://', 'https://')):
+            return redirect(src)
+        abort(404)
+
+    response = send_file(path, mimetype=mimetype, conditional=True)
+    response.headers['Cache-Control'] = CACHE_HEADERS
+    return response
+
+
+##############################################################################
+# Static assets:
+
+@views.route(f'/static/{BUILD_DIR}/<path:filename>')
+def serve_asset(filename):
+    """Serve a fingerprinted asset built by assets.py.
+
+    Uses the brotli or gzip copy if the client accepts one. The name changes
+    whenever the contents do, so browsers may cache it forever.
+    """
+
+    path = safe_join(os.path.join(current_app.static_folder, BUILD_DIR), filename)
+
+    if not os.path.isfile(path):
+        abort(404)
+
+    served, encoding = precompressed(path, request.headers.get('Accept-Encoding', ''))
+
+    response = send_file(served, mimetype=mimetypes.guess_type(path)[0], conditional=True)
+    response.headers['Cache-Control'] = CACHE_HEADERS
+    response.vary.add('Accept-Encoding')
+
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+
+    return response
+
+
 ##############################################################################
 # Likes routes:
 
 
-@app.route('/users/<user_id>/likes')
+@views.route('/users/<user_id>/likes')
 def show_user_likes(user_id):
     """Show the warbles this user likes."""
 
@@ -324,19 +754,13 @@ def show_user_likes(user_id):
     
     user = User.query.get_or_404(user_id)
 
-    likes = [like.id for like in user.likes]
+    messages = liked_messages(db.session, user.id)
 
-    messages = (Message
-                .query
-                .filter(Message.id.in_(likes))
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
+    return render_template('users/likes.html', user=user, messages=messages,
+                           counts=profile_counts(user))
 
-    return render_template('users/likes.html', user=user, messages=messages)
 
-
-@app.route('/users/add_like/<msg_id>', methods=['POST'])
+@views.route('/users/add_like/<int:msg_id>', methods=['POST'])
 def add_like(msg_id):
     """Add or remove a like on a message."""
 
@@ -344,30 +768,62 @@ def add_like(msg_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    message = Message.query.get_or_404(msg_id)
+    message = message_by_id(db.session, msg_id)
 
-    if message and message.user_id != g.user.id:
+    if message is None:
+        abort(404)
 
-        like = Likes.query.filter(Likes.user_id==g.user.id, Likes.message_id==msg_id).first()
+    if message.user_id != g.user.id:
+        if toggle_like(db.session, g.user.id, message.id):
+            notify(db.session, 'like', g.user.id, [message.user_id], message.id)
 
-        if like:
-            db.session.delete(like)
-            db.session.commit()
-
-        else:
-            new_like = Likes(user_id=g.user.id,message_id=msg_id)
-            
-            db.session.add(new_like)
-            db.session.commit()
+        db.session.commit()
     
     return redirect('/')
 
 
+##############################################################################
+# Notifications
+
+
+def unread_notifications():
+    """Return the current user's unread notification count, for the navbar
+    (0 on a page served stale, unless the page loaded it)."""
+
+    if not g.user:
+        return 0
+
+    if 'unread_notifications' not in g:
+        if g.get('stale'):
+            return 0
+        g.unread_notifications = unread_count(db.session, g.user.id)
+
+    return g.unread_notifications
+
+
+@views.route('/notifications')
+def show_notifications():
+    """Show the current user's follows and likes, grouped, newest first."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    before = request.args.get('before', type=int)
+    notices, cursor = notification_page(db.session, g.user.id, before)
+
+    if before is None and notices and notices[0].unread:
+        mark_seen(db.session, g.user.id, notices[0].newest_id)
+        db.session.commit()
+
+    return render_template('users/notifications.html', notices=notices, cursor=cursor)
+
+
 # ##############################################################################
 # Homepage and error pages
 
 
-@app.route('/')
+@views.route('/')
 def homepage():
     """Show homepage:
 
@@ -376,26 +832,75 @@ def homepage():
     """
 
     if g.user:
-        user = User.query.get_or_404(g.user.id)
-
-        following = [u.id for u in user.following]
-        following.append(g.user.id)
-
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(following))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
+        user_id = g.user.id
+        before = request.args.get('before', type=int)
 
-        likes = [like.id for like in user.likes]
+        page = load_page(('homepage', user_id, before),
+                         lambda timeout_ms: load_home(user_id, before, timeout_ms))
+        g.unread_notifications = page['unread']
 
-        return render_template('home.html', messages=messages, likes=likes)
+        return render_template('home.html', messages=page['messages'], counts=page['counts'],
+                               likes=page['likes'], suggestions=page['suggestions'],
+                               trends=trending.get())
 
     else:
         return render_template('home-anon.html')
 
 
+##############################################################################
+# Admin metrics
+
+
+def require_admin():
+    """404 unless ADMIN_METRICS is on and the user is one of ADMIN_USERNAMES."""
+
+    if (not current_app.config['ADMIN_METRICS'] or not g.user
+            or g.user.username not in current_app.config['ADMIN_USERNAMES']):
+        abort(404)
+
+
+@views.route('/admin/compression')
+def compression_stats():
+    """Show per-route response compression ratios and CPU cost, as JSON."""
+
+    require_admin()
+
+    return jsonify(routes=current_app.extensions['compressor'].stats.snapshot())
+
+
+@views.route('/admin/singleflight')
+def singleflight_stats():
+    """Show per-route counts of loads run and requests coalesced, as JSON."""
+
+    require_admin()
+
+    return jsonify(routes=current_app.extensions['singleflight'].snapshot())
+
+
+@views.route('/admin/queries')
+def query_stats():
+    """Show each route's latest query count and repeated statements, as JSON."""
+
+    require_admin()
+
+    if 'query_tracer' not in current_app.extensions:
+        abort(404)
+
+    return jsonify(routes=current_app.extensions['query_tracer'].snapshot())
+
+
+@views.route('/admin/memory')
+def memory_stats():
+    """Show per-route peak memory and top allocation sites of sampled requests, as JSON."""
+
+    require_admin()
+
+    if 'memory_profiler' not in current_app.extensions:
+        abort(404)
+
+    return jsonify(routes=current_app.extensions['memory_profiler'].snapshot())
+
+
 ##############################################################################
 # Turn off all caching in Flask
 #   (useful for dev; in production, this kind of stuff is typically
@@ -403,9 +908,19 @@ def homepage():
 #
 # https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
 
-@app.after_request
+@views.after_app_request
 def add_header(req):
-    """Add non-caching headers on every request."""
+    """Add non-caching headers on every request.
+
+    Responses that are safe to cache forever (see images.py and assets.py)
+    keep theirs. Pages served stale after a missed query deadline say so.
+    """
+
+    if g.get('stale'):
+        req.headers['Warning'] = '110 - "Response is Stale"'
+
+    if req.headers.get('Cache-Control') == CACHE_HEADERS:
+        return req
 
     req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
     req.headers["Pragma"] = "no-cache"
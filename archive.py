@@ -0,0 +1,361 @@
+"""Cold storage for old messages, one file per month.
+
+Feeds only ever read the newest messages, so messages older than
+ARCHIVE_AFTER_DAYS are moved out of the `messages` tables (on every
+shard, see sharding.py) into ARCHIVE_DIR by a batch job:
+
+    python archive.py
+
+Message ids are time-ordered (snowflake.py), so a month is a range of
+ids: the job archives whole months, and the live tables keep the newest
+months as a contiguous id range. Each month becomes
+
+    messages-YYYY-MM.ndjson.gz   one gzip member per user, holding that
+                                 user's messages as JSON lines, newest first
+    messages-YYYY-MM.index.json  where each user's member is, and the size
+                                 of the archive it describes
+
+so reading one user's month is a seek and one small decompress. (If the
+index doesn't match its archive, e.g. the job died between writing the
+two, the archive is scanned instead.) Archived
+messages keep the ids of the users who liked them; their likes, tags and
+mentions leave the live tables with them.
+
+Profiles read archived messages through the slower "older warbles" path
+(/users/<id>/archive), a month at a time.
+
+The job writes a month's files before deleting its rows, and merges with
+what's already archived, so a rerun after a failure loses nothing.
+"""
+
+import argparse
+import gzip
+import json
+import os
+import re
+import tempfile
+import time
+import zlib
+from datetime import datetime, timedelta
+from functools import lru_cache
+
+from sqlalchemy import select, func
+
+from models import db
+from queries import PAGE_SIZE, FeedMessage
+from sharding import messages, likes, shard_router
+from snowflake import id_for, timestamp_of
+
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+MONTH_FILE = re.compile(r'^messages-(\d{4})-(\d{2})\.ndjson\.gz$')
+
+
+def month_start(timestamp):
+    return datetime(timestamp.year, timestamp.month, 1)
+
+
+def next_month(start):
+    return datetime(start.year + start.month // 12, start.month % 12 + 1, 1)
+
+
+def month_ids(start):
+    """Return the (lowest, past-the-highest) message ids of the month at `start`."""
+
+    return id_for(start), id_for(next_month(start))
+
+
+def month_path(directory, start, suffix='ndjson.gz'):
+    return os.path.join(directory, f'messages-{start:%Y-%m}.{suffix}')
+
+
+def per_version(cached, directory, default):
+    """Return `cached(directory, mtime)`, or `default` with no directory.
+
+    Writing a month replaces its files, which changes the directory's
+    mtime, so results keyed by it are current. But a result read just
+    after a change could miss another change made within the same clock
+    tick, which wouldn't change the mtime, so those aren't cached.
+    """
+
+    try:
+        stat = os.stat(directory)
+    except FileNotFoundError:
+        return default
+
+    if time.time() - stat.st_mtime < 1:
+        return cached.__wrapped__(directory, stat.st_mtime_ns)
+
+    return cached(directory, stat.st_mtime_ns)
+
+
+def archived_months(directory):
+    """Return the starts of the archived months in `directory`, newest first."""
+
+    return list(per_version(list_months, directory, ()))
+
+
+@lru_cache(maxsize=8)
+def list_months(directory, mtime):
+    """Return the archived months in `directory` (cached per version)."""
+
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return ()
+
+    return tuple(sorted((datetime(int(match.group(1)), int(match.group(2)), 1)
+                         for match in map(MONTH_FILE.match, names) if match),
+                        reverse=True))
+
+
+##############################################################################
+# Reading
+
+
+def parse_block(data):
+    return [json.loads(line) for line in data.decode('utf-8').splitlines()]
+
+
+def scan(path):
+    """Yield (offset, length, records) for each user's block of a month archive."""
+
+    with open(path, 'rb') as archive:
+        data = archive.read()
+
+    offset = 0
+
+    while offset < len(data):
+        block = zlib.decompressobj(wbits=31)
+        records = parse_block(block.decompress(data[offset:]))
+        length = len(data) - offset - len(block.unused_data)
+
+        yield offset, length, records
+        offset += length
+
+
+@lru_cache(maxsize=64)
+def load_index(path, index_path, size, mtime):
+    """Return {user id: (offset, length)} for the month archive at `path`
+    (cached per version of the archive)."""
+
+    try:
+        with open(index_path) as index:
+            index = json.load(index)
+    except FileNotFoundError:
+        index = None
+
+    if index and index['size'] == size:
+        return {int(user_id): (offset, length)
+                for user_id, (offset, length, _) in index['users'].items()}
+
+    return {records[0]['user_id']: (offset, length) for offset, length, records in scan(path)}
+
+
+def read_block(path, offset, length):
+    """Return the records of one user's block of a month archive."""
+
+    with open(path, 'rb') as archive:
+        archive.seek(offset)
+        return parse_block(gzip.decompress(archive.read(length)))
+
+
+def month_index(directory, start):
+    """Return {user id: (offset, length)} for the month at `start`."""
+
+    path = month_path(directory, start)
+
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return {}
+
+    return load_index(path, month_path(directory, start, 'index.json'),
+                      stat.st_size, stat.st_mtime_ns)
+
+
+def read_user_month(directory, start, user_id):
+    """Return user `user_id`'s archived records for the month at `start`."""
+
+    index = month_index(directory, start)
+
+    if user_id not in index:
+        return []
+
+    return read_block(month_path(directory, start), *index[user_id])
+
+
+def has_archive(directory, user_id):
+    """Does user `user_id` have any archived messages?"""
+
+    return user_id in per_version(archived_users, directory, frozenset())
+
+
+@lru_cache(maxsize=8)
+def archived_users(directory, mtime):
+    """Return the ids of the users with archived messages in `directory`
+    (cached per version, so profiles don't read every month's index)."""
+
+    return frozenset(user_id
+                     for start in list_months.__wrapped__(directory, mtime)
+                     for user_id in month_index(directory, start))
+
+
+def to_message(record):
+    return FeedMessage(record['id'], record['text'],
+                       datetime.strptime(record['timestamp'], TIMESTAMP_FORMAT),
+                       record['user_id'], None)
+
+
+def archived_messages(directory, user_id, before=None, limit=PAGE_SIZE):
+    """Return up to `limit` of user `user_id`'s archived messages older
+    than message id `before`, newest first, as FeedMessages."""
+
+    page = []
+
+    for start in archived_months(directory):
+        if before is not None and id_for(start) >= before:
+            continue
+
+        for record in read_user_month(directory, start, user_id):
+            if before is None or record['id'] < before:
+                page.append(to_message(record))
+
+                if len(page) == limit:
+                    return page
+
+    return page
+
+
+##############################################################################
+# Archiving
+
+
+def read_month(directory, start):
+    """Return {user id: records} already archived for the month at `start`."""
+
+    path = month_path(directory, start)
+
+    if not os.path.exists(path):
+        return {}
+
+    return {records[0]['user_id']: records for _, _, records in scan(path)}
+
+
+def write_month(directory, start, records):
+    """Write {user id: records} as the archive of the month at `start`."""
+
+    users = {}
+    descriptor, temporary = tempfile.mkstemp(dir=directory)
+
+    with os.fdopen(descriptor, 'wb') as archive:
+        for user_id in sorted(records):
+            lines = sorted(records[user_id], key=lambda record: record['id'], reverse=True)
+            block = gzip.compress(''.join(json.dumps(record) + '\n' for record in lines)
+                                  .encode('utf-8'))
+            users[user_id] = [archive.tell(), len(block), len(lines)]
+            archive.write(block)
+
+        size = archive.tell()
+
+    os.replace(temporary, month_path(directory, start))
+
+    descriptor, temporary = tempfile.mkstemp(dir=directory)
+    with os.fdopen(descriptor, 'w') as index:
+        json.dump(dict(size=size, users=users), index)
+    os.replace(temporary, month_path(directory, start, 'index.json'))
+
+
+def archive_month(engines, directory, start):
+    """Move the messages of the month at `start` from `engines` to the archive.
+
+    Returns the number of messages moved.
+    """
+
+    low, high = month_ids(start)
+    in_month = messages.c.id.between(low, high - 1)
+    liked_in_month = likes.c.message_id.between(low, high - 1)
+
+    records = read_month(directory, start)
+    archived = {record['id'] for block in records.values() for record in block}
+    liked_by = {}
+    moved = 0
+
+    for engine in engines:
+        with engine.connect() as conn:
+            for message_id, user_id in conn.execute(
+                    select([likes.c.message_id, likes.c.user_id]).where(liked_in_month)):
+                liked_by.setdefault(message_id, []).append(user_id)
+
+    for engine in engines:
+        with engine.connect() as conn:
+            for row in conn.execute(select([messages]).where(in_month)):
+                if row.id in archived:
+                    continue
+
+                records.setdefault(row.user_id, []).append(dict(
+                    id=row.id, text=row.text, user_id=row.user_id,
+                    timestamp=row.timestamp.strftime(TIMESTAMP_FORMAT),
+                    liked_by=sorted(liked_by.get(row.id, []))))
+                moved += 1
+
+    if not records:
+        return 0
+
+    write_month(directory, start, records)
+
+    for engine in engines:
+        with engine.begin() as conn:
+            conn.execute(likes.delete().where(liked_in_month))
+            conn.execute(messages.delete().where(in_month))
+
+    return moved
+
+
+def archive_before(cutoff, directory, engines=None):
+    """Archive every whole month of messages before `cutoff`.
+
+    Returns {month start: messages moved} for the months that had any.
+    """
+
+    engines = engines or shard_router().engines or [db.engine]
+    os.makedirs(directory, exist_ok=True)
+
+    oldest = []
+    for engine in engines:
+        with engine.connect() as conn:
+            oldest.append(conn.execute(select([func.min(messages.c.id)])).scalar())
+
+    oldest = [message_id for message_id in oldest if message_id is not None]
+
+    if not oldest:
+        return {}
+
+    start = month_start(timestamp_of(min(oldest)))
+    moved = {}
+
+    while next_month(start) <= cutoff:
+        count = archive_month(engines, directory, start)
+        if count:
+            moved[start] = count
+        start = next_month(start)
+
+    return moved
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Archive old messages by month.")
+    parser.add_argument('--days', type=int, help='archive months older than this '
+                                                 '(default: ARCHIVE_AFTER_DAYS)')
+    args = parser.parse_args()
+
+    from app import create_app
+    app = create_app()  # binds db to the configured database
+
+    with app.app_context():
+        days = args.days or app.config['ARCHIVE_AFTER_DAYS']
+        directory = app.config['ARCHIVE_DIR']
+
+        for start, count in archive_before(datetime.utcnow() - timedelta(days=days),
+                                           directory).items():
+            print(f"{start:%Y-%m}: archived {count:,} messages to {directory}")
@@ -0,0 +1,216 @@
+"""Static asset pipeline: fingerprinted, precompressed copies of static files.
+
+Run at deploy time, before starting the app:
+
+    python assets.py
+
+Every file under static/ is copied into static/dist/ under a name containing
+a hash of its contents (stylesheets/style.css becomes
+stylesheets/style.3f9a0c1b2d.css). Images are recompressed with Pillow
+first, stylesheets have their url(/static/...) references rewritten to the
+fingerprinted names, and text assets are also written gzip- and
+brotli-compressed alongside (style.3f9a0c1b2d.css.gz, .br). A manifest maps
+each source path to its built path.
+
+Templates link to assets with `asset_url('stylesheets/style.css')`. A
+fingerprinted file's contents never change, so it is served with a one-year
+immutable Cache-Control (see `serve_asset` in app.py) and browsers never
+ask for it again; a new build changes the name instead. Without a build, as
+in development, `asset_url` falls back to the plain /static/ URL.
+"""
+
+import argparse
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+
+from flask import current_app, url_for
+
+from compression import accepted_encodings
+
+BUILD_DIR = 'dist'
+MANIFEST = 'manifest.json'
+
+HASH_LENGTH = 10
+
+COMPRESSIBLE = {'.css', '.js', '.svg', '.json', '.txt', '.ico'}
+OPTIMIZABLE = {'.png', '.jpg', '.jpeg'}
+
+# Encodings we precompress, in order of preference, with file suffixes.
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+CSS_URL_RE = re.compile(r'''url\((['"]?)/static/([^'")?#]+)\1\)''')
+
+
+def fingerprint(path, data):
+    """Return `path` with a hash of `data` before its extension."""
+
+    stem, extension = os.path.splitext(path)
+    digest = hashlib.sha256(data).hexdigest()[:HASH_LENGTH]
+    return f"{stem}.{digest}{extension}"
+
+
+def optimize_image(data, extension):
+    """Return `data` recompressed by Pillow, or unchanged if that's no smaller."""
+
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(data))
+    out = io.BytesIO()
+
+    if extension == '.png':
+        image.save(out, 'PNG', optimize=True)
+    else:
+        image.save(out, 'JPEG', quality='keep', optimize=True, progressive=True)
+
+    optimized = out.getvalue()
+    return optimized if len(optimized) < len(data) else data
+
+
+def compress(data):
+    """Return {encoding: compressed bytes} for `data`."""
+
+    import brotli
+
+    return {
+        'br': brotli.compress(data, quality=11),
+        'gzip': gzip.compress(data, compresslevel=9, mtime=0),
+    }
+
+
+def source_files(static_folder):
+    """Return paths (relative, with forward slashes) of files to build.
+
+    Hidden files and directories (.DS_Store, .git) are left out.
+    Stylesheets come last, so the images they reference are already built
+    when their URLs are rewritten.
+    """
+
+    paths = []
+
+    for directory, subdirectories, filenames in os.walk(static_folder):
+        relative = os.path.relpath(directory, static_folder)
+
+        if relative == BUILD_DIR:
+            subdirectories[:] = []
+            continue
+
+        subdirectories[:] = [name for name in subdirectories if not name.startswith('.')]
+
+        for filename in filenames:
+            if filename.startswith('.'):
+                continue
+
+            path = os.path.normpath(os.path.join(relative, filename))
+            paths.append(path.replace(os.sep, '/'))
+
+    return sorted(paths, key=lambda path: (path.endswith('.css'), path))
+
+
+def build(static_folder, build_dir=BUILD_DIR):
+    """Build fingerprinted assets into `static_folder`/`build_dir`.
+
+    Returns the manifest, which is also written to the build directory.
+    Files from earlier builds are removed.
+    """
+
+    out = os.path.join(static_folder, build_dir)
+    shutil.rmtree(out, ignore_errors=True)
+
+    manifest = {}
+
+    for path in source_files(static_folder):
+        with open(os.path.join(static_folder, path), 'rb') as source:
+            data = source.read()
+
+        extension = os.path.splitext(path)[1].lower()
+
+        if extension in OPTIMIZABLE:
+            data = optimize_image(data, extension)
+
+        if extension == '.css':
+            data = CSS_URL_RE.sub(
+                lambda match: (f"url({match.group(1)}/static/"
+                               f"{manifest.get(match.group(2), match.group(2))}"
+                               f"{match.group(1)})"),
+                data.decode('utf-8')).encode('utf-8')
+
+        built = f"{build_dir}/{fingerprint(path, data)}"
+        manifest[path] = built
+
+        target = os.path.join(static_folder, built)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+
+        with open(target, 'wb') as copy:
+            copy.write(data)
+
+        if extension in COMPRESSIBLE:
+            for encoding, compressed in compress(data).items():
+                if len(compressed) < len(data):
+                    with open(target + dict(ENCODINGS)[encoding], 'wb') as copy:
+                        copy.write(compressed)
+
+    with open(os.path.join(out, MANIFEST), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+
+    return manifest
+
+
+def load_manifest(static_folder, build_dir=BUILD_DIR):
+    """Return the manifest of the last build, or {} if there isn't one."""
+
+    try:
+        with open(os.path.join(static_folder, build_dir, MANIFEST)) as manifest_file:
+            return json.load(manifest_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def get_manifest():
+    """Return the current app's asset manifest, loading it on first use."""
+
+    manifest = current_app.extensions.get('asset_manifest')
+
+    if manifest is None:
+        manifest = current_app.extensions['asset_manifest'] = load_manifest(
+            current_app.static_folder)
+
+    return manifest
+
+
+def asset_url(path):
+    """Template global: return the URL of static file `path`, fingerprinted if built."""
+
+    return url_for('static', filename=get_manifest().get(path, path))
+
+
+def precompressed(path, accept_encoding):
+    """Return (path, encoding) of the best precompressed copy of `path`:
+    the client's highest q-value, then our order of preference.
+
+    Falls back to (`path`, None) when the client accepts none we have.
+    """
+
+    weights = accepted_encodings(accept_encoding)
+    candidates = [(encoding, suffix) for encoding, suffix in ENCODINGS
+                  if weights.get(encoding, 0) > 0 and os.path.isfile(path + suffix)]
+
+    if not candidates:
+        return path, None
+
+    encoding, suffix = max(candidates, key=lambda candidate: weights[candidate[0]])
+    return path + suffix, encoding
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build fingerprinted static assets.")
+    parser.add_argument('--static', default=os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'static'))
+    args = parser.parse_args()
+
+    manifest = build(args.static)
+    print(f"Built {len(manifest)} assets into {os.path.join(args.static, BUILD_DIR)}")
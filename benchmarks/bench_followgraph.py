@@ -0,0 +1,112 @@
+"""Benchmark follow graph lookups at scale.
+
+Builds a synthetic follow graph (who gets followed follows a Zipf
+distribution, like real social graphs), snapshots it to a file, maps it
+back the way a worker would, and times membership, degree and neighbour
+lookups. No database is needed.
+
+    python benchmarks/bench_followgraph.py --users 1000000 --edges 10000000
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+LOOKUPS = 100000
+
+
+def synthetic_edges(users, edges, seed=0):
+    """Return (followers, followed) arrays of `edges` distinct follows between users 1..users."""
+
+    import numpy as np
+
+    rng = np.random.RandomState(seed)
+
+    # Oversample: popular accounts draw many duplicate follows
+    draws = edges * 2
+    followers = rng.randint(1, users + 1, size=draws).astype(np.int64)
+    followed = np.minimum(rng.zipf(1.3, size=draws), users).astype(np.int64)
+
+    # Scatter the popular ids so they aren't all the lowest user ids
+    followed = (followed * 2654435761) % users + 1
+
+    keys = np.unique(followers * (users + 1) + followed)
+    followers, followed = keys // (users + 1), keys % (users + 1)
+    keep = np.flatnonzero(followers != followed)
+    keep = np.sort(rng.choice(keep, size=min(edges, len(keep)), replace=False))
+
+    return followers[keep].astype(np.int32), followed[keep].astype(np.int32)
+
+
+def time_per_call(function, arguments):
+    """Return the mean microseconds per call of `function` over `arguments`."""
+
+    start = time.perf_counter()
+
+    for args in arguments:
+        function(*args)
+
+    return (time.perf_counter() - start) / len(arguments) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000000)
+    parser.add_argument('--edges', type=int, default=10000000)
+    args = parser.parse_args()
+
+    import numpy as np
+    from followgraph import FollowGraph, Snapshot
+
+    print(f"Generating {args.edges:,} follows between {args.users:,} users")
+    followers, followed = synthetic_edges(args.users, args.edges)
+
+    start = time.perf_counter()
+    snapshot = Snapshot.from_edges(followers, followed, args.users + 1)
+    print(f"  built CSR in both directions in {time.perf_counter() - start:.2f}s "
+          f"({snapshot.edges:,} distinct edges)")
+
+    path = os.path.join(tempfile.mkdtemp(), 'follows.graph')
+
+    start = time.perf_counter()
+    snapshot.save(path)
+    print(f"  wrote {os.path.getsize(path) / 1e6:,.0f}MB snapshot "
+          f"in {time.perf_counter() - start:.2f}s")
+
+    start = time.perf_counter()
+    graph = FollowGraph(path)
+    graph.reset(Snapshot.load(path))
+    print(f"  mapped it in {(time.perf_counter() - start) * 1000:.2f}ms")
+
+    rng = np.random.RandomState(1)
+    sample = rng.randint(0, len(followers), size=LOOKUPS)
+    hits = list(zip(followers[sample].tolist(), followed[sample].tolist()))
+    misses = list(zip(rng.randint(1, args.users + 1, size=LOOKUPS).tolist(),
+                      rng.randint(1, args.users + 1, size=LOOKUPS).tolist()))
+    users = [(user_id,) for user_id, _ in misses]
+    popular = [(user_id,) for user_id in np.bincount(followed).argsort()[-100:].tolist()]
+
+    # A few follows and unfollows in the overlay, as between snapshots
+    for follower_id, followed_id in hits[:1000]:
+        graph.apply(follower_id, followed_id, False)
+    for follower_id, followed_id in misses[:1000]:
+        graph.apply(follower_id, followed_id, True)
+
+    print(f"\n{'lookup':<34}{'per call':>10}")
+
+    for label, function, arguments in [
+            ('is_following (edge exists)', graph.is_following, hits),
+            ('is_following (no edge)', graph.is_following, misses),
+            ('following_count', graph.following_count, users),
+            ('followers_count', graph.followers_count, users),
+            ('following (list of ids)', graph.following, users),
+            ('followers (100 most followed)', graph.followers, popular)]:
+        print(f"{label:<34}{time_per_call(function, arguments):>8.2f}us")
+
+
+if __name__ == '__main__':
+    main()
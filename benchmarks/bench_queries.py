@@ -0,0 +1,128 @@
+"""Benchmark the Python overhead of the hot queries, prepared and built per call.
+
+Runs each hot query (see queries.py) against a tiny scratch database, so
+the time is almost all SQLAlchemy building, compiling and loading, and
+compares it with building the same query from scratch every time, as
+app.py used to. The database is dropped and recreated first, so never
+point this at one you care about.
+
+    python benchmarks/bench_queries.py
+    python benchmarks/bench_queries.py postgresql:///warbler-bench
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+CALLS = 2000
+
+
+def fill(db, User, Message, Likes):
+    """Add two users with a few messages and likes; return their ids."""
+
+    users = [User(username=f'bench{n}', email=f'bench{n}@example.com', password='x')
+             for n in range(2)]
+    db.session.add_all(users)
+    db.session.flush()
+
+    for n in range(20):
+        db.session.add(Message(text=f'warble {n}', user_id=users[n % 2].id))
+        db.session.flush()
+
+    for message in Message.query.filter_by(user_id=users[1].id).limit(5):
+        db.session.add(Likes(user_id=users[0].id, message_id=message.id))
+
+    db.session.commit()
+    return [user.id for user in users]
+
+
+def time_per_call(function):
+    """Return the mean microseconds per call of `function`."""
+
+    function()  # warm up (and bake)
+    start = time.perf_counter()
+
+    for _ in range(CALLS):
+        function()
+
+    return (time.perf_counter() - start) / CALLS * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('database_url', nargs='?', default='sqlite://',
+                        help='scratch database (default: in-memory SQLite)')
+    args = parser.parse_args()
+
+    os.environ['DATABASE_URL'] = args.database_url
+
+    from app import create_app
+    app = create_app()  # binds db to the scratch database
+    app.app_context().push()
+
+    from sqlalchemy import bindparam
+    from sqlalchemy.orm import joinedload
+    from models import db, bakery, User, Message, Likes
+    from queries import home_feed, user_messages, liked_messages, liked_ids
+
+    db.drop_all()
+    db.create_all()
+    user_id, other_id = fill(db, User, Message, Likes)
+    on_screen = [message.id for message in home_feed(db.session(), [user_id, other_id])]
+    session = db.session()
+
+    def unbaked_home():
+        return (session.query(Message)
+                .options(joinedload(Message.user))
+                .filter(Message.user_id.in_([user_id, other_id]))
+                .order_by(Message.id.desc())
+                .limit(100)
+                .all())
+
+    def unbaked_profile():
+        return (session.query(Message)
+                .filter(Message.user_id == other_id)
+                .order_by(Message.id.desc())
+                .limit(100)
+                .all())
+
+    def unbaked_likes():
+        return (session.query(Message)
+                .join(Likes, Likes.message_id == Message.id)
+                .filter(Likes.user_id == user_id)
+                .order_by(Message.id.desc())
+                .limit(100)
+                .all())
+
+    def unbaked_liked_ids():
+        return {message_id for (message_id,) in (session
+                                                 .query(Likes.message_id)
+                                                 .filter(Likes.user_id == user_id,
+                                                         Likes.message_id.in_(on_screen)))}
+
+    def unbaked_authenticate():
+        return session.query(User).filter_by(username='bench0').first()
+
+    def baked_authenticate():
+        # User.authenticate's lookup, without the bcrypt check
+        query = bakery(lambda session: session.query(User))
+        query += lambda q: q.filter(User.username == bindparam('username'))
+        return query(session).params(username='bench0').first()
+
+    print(f"{'query':<16}{'built':>10}{'prepared':>10}{'saved':>8}")
+
+    for label, unbaked, baked in [
+            ('homepage', unbaked_home, lambda: home_feed(session, [user_id, other_id])),
+            ('users_show', unbaked_profile, lambda: user_messages(session, other_id)),
+            ('user likes', unbaked_likes, lambda: liked_messages(session, user_id)),
+            ('liked_ids', unbaked_liked_ids, lambda: liked_ids(session, user_id, on_screen)),
+            ('authenticate', unbaked_authenticate, baked_authenticate)]:
+        before, after = time_per_call(unbaked), time_per_call(baked)
+        print(f"{label:<16}{before:>8.0f}us{after:>8.0f}us{1 - after / before:>8.0%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""Benchmark the recommendation engine on a synthetic follow graph.
+
+No database is involved: a graph with a skewed (Zipf-like) follower
+distribution is generated in memory and scored the same way
+`recommendations.recompute` scores the real one.
+
+    python benchmarks/bench_recommendations.py --users 1000000 --follows 50
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+from scipy import sparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from recommendations import CHUNK_SIZE, TOP_K, score, top_k  # noqa: E402
+
+
+def synthetic_graph(users, follows_per_user, seed=0):
+    """Return (graph, transposed) with popular accounts drawn more often."""
+
+    rng = np.random.RandomState(seed)
+    edges = users * follows_per_user
+
+    followers = np.repeat(np.arange(1, users + 1, dtype=np.int32), follows_per_user)
+    followed = np.minimum(rng.zipf(1.3, edges), users).astype(np.int32)
+
+    # Shuffle popularity so low ids aren't all celebrities.
+    followed = rng.permutation(users + 1).astype(np.int32)[followed]
+
+    graph = sparse.csr_matrix(
+        (np.ones(edges, dtype=np.float32), (followers, followed)),
+        shape=(users + 1, users + 1))
+    graph.data[:] = 1
+
+    return graph, graph.T.tocsr()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--follows', type=int, default=50,
+                        help='follows per user')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    graph, transposed = synthetic_graph(args.users, args.follows)
+    built = time.perf_counter()
+
+    users = np.arange(1, args.users + 1, dtype=np.int32)
+    rows = 0
+
+    for offset in range(0, len(users), CHUNK_SIZE):
+        chunk = users[offset:offset + CHUNK_SIZE]
+        rows += sum(1 for _ in top_k(score(graph, transposed, chunk), chunk, TOP_K))
+
+    done = time.perf_counter()
+
+    print(f"users:        {args.users:,}")
+    print(f"edges:        {graph.nnz:,}")
+    print(f"build graph:  {built - start:.1f}s")
+    print(f"score + topK: {done - built:.1f}s ({rows:,} rows)")
+
+
+if __name__ == '__main__':
+    main()
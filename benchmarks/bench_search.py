@@ -0,0 +1,130 @@
+"""Benchmark full-text message search at scale.
+
+Fills a *scratch* database with synthetic messages (word frequencies follow
+a Zipf distribution, like real text), then times ranked searches for
+common, mid-frequency and rare words, including paging deep with cursors.
+The database is dropped and recreated first, so never point this at one
+you care about.
+
+    python benchmarks/bench_search.py postgresql:///warbler-bench --messages 2000000
+    python benchmarks/bench_search.py sqlite:////tmp/warbler-bench.db
+"""
+
+import argparse
+import itertools
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BATCH_SIZE = 10000
+VOCABULARY_SIZE = 50000
+
+
+def make_vocabulary(size):
+    """Return `size` distinct pronounceable-ish words."""
+
+    syllables = ['ba', 'ke', 'lo', 'mi', 'nu', 'ra', 'si', 'to', 'vu', 'we',
+                 'zo', 'qui', 'dra', 'fen', 'gol', 'har', 'jin', 'por']
+    words = set()
+    rng = random.Random(0)
+
+    while len(words) < size:
+        words.add(''.join(rng.choice(syllables) for _ in range(rng.randint(2, 4))))
+
+    return sorted(words)
+
+
+def fill(db, Message, User, count):
+    """Insert `count` messages; return seconds spent inserting."""
+
+    from snowflake import id_for
+
+    vocabulary = make_vocabulary(VOCABULARY_SIZE)
+    cum_weights = list(itertools.accumulate(
+        1 / rank for rank in range(1, len(vocabulary) + 1)))
+    rng = random.Random(1)
+
+    db.session.add(User(username='bench', email='bench@example.com', password='x'))
+    db.session.commit()
+
+    start = time.perf_counter()
+    base = datetime(2020, 1, 1).timestamp()
+
+    for offset in range(0, count, BATCH_SIZE):
+        rows = []
+
+        for i in range(offset, min(offset + BATCH_SIZE, count)):
+            timestamp = datetime.fromtimestamp(base + i)
+            text = ' '.join(rng.choices(vocabulary, cum_weights=cum_weights, k=rng.randint(5, 20)))
+            rows.append(dict(id=id_for(timestamp, i), text=text[:140],
+                             timestamp=timestamp, user_id=1))
+
+        db.session.execute(Message.__table__.insert(), rows)
+        db.session.commit()
+        print(f"\r  inserted {offset + len(rows):,}", end='', flush=True)
+
+    print()
+    return time.perf_counter() - start, vocabulary
+
+
+def time_search(search_messages, query, pages, repeat=5):
+    """Return the median seconds to fetch `pages` pages of results."""
+
+    timings = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        cursor = None
+
+        for _ in range(pages):
+            messages, cursor = search_messages(query, cursor)
+            if not cursor:
+                break
+
+        timings.append(time.perf_counter() - start)
+
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('database_url', help='scratch database to fill')
+    parser.add_argument('--messages', type=int, default=1000000)
+    args = parser.parse_args()
+
+    os.environ['DATABASE_URL'] = args.database_url
+
+    from app import create_app
+    create_app()  # binds db to the scratch database
+    from models import db, Message, User
+    from search import search_messages
+
+    db.drop_all()
+    db.create_all()
+
+    print(f"Filling {args.database_url} with {args.messages:,} messages")
+    elapsed, vocabulary = fill(db, Message, User, args.messages)
+    print(f"  {args.messages / elapsed:,.0f} inserts/s with the index maintained")
+
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute("ANALYZE messages")
+        db.session.commit()
+
+    print(f"\n{'query':<28}{'1 page':>10}{'5 pages':>10}")
+
+    for label, word in [('common', vocabulary[0]),
+                        ('mid-frequency', vocabulary[500]),
+                        ('rare', vocabulary[-1]),
+                        ('two words', f"{vocabulary[1]} {vocabulary[2]}")]:
+        one = time_search(search_messages, word, 1)
+        five = time_search(search_messages, word, 5)
+        print(f"{label + ' (' + word + ')':<28}{one * 1000:>8.1f}ms{five * 1000:>8.1f}ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""Benchmark worker startup: import time, app creation and first request.
+
+Each run starts a fresh interpreter, as a newly spawned (not preloaded)
+worker would, and times:
+
+- importing app.py and everything it imports
+- create_app()
+- the first request, which also loads templates and the asset manifest
+- a second request, for comparison
+
+Requests are anonymous, so no database is needed.
+
+    python benchmarks/bench_startup.py --runs 20
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Run in each child interpreter; prints its timings as JSON.
+CHILD = """
+import json, time
+start = time.perf_counter()
+from app import create_app
+imported = time.perf_counter()
+app = create_app({config!r})
+created = time.perf_counter()
+client = app.test_client()
+assert client.get({path!r}).status_code == 200
+first = time.perf_counter()
+client.get({path!r})
+second = time.perf_counter()
+print(json.dumps({{
+    'import': imported - start,
+    'create_app': created - imported,
+    'first request': first - created,
+    'second request': second - first,
+}}))
+"""
+
+
+def run_once(config, path):
+    """Return the timings of one fresh interpreter."""
+
+    output = subprocess.run(
+        [sys.executable, '-c', CHILD.format(config=config, path=path)],
+        cwd=ROOT, check=True, stdout=subprocess.PIPE).stdout
+
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--config', default='production',
+                        help='config name passed to create_app')
+    parser.add_argument('--path', default='/', help='page to request')
+    args = parser.parse_args()
+
+    runs = [run_once(args.config, args.path) for _ in range(args.runs)]
+
+    print(f"{'phase':<16}{'median':>10}{'max':>10}")
+
+    for phase in runs[0]:
+        timings = [run[phase] for run in runs]
+        print(f"{phase:<16}{statistics.median(timings) * 1000:>8.1f}ms"
+              f"{max(timings) * 1000:>8.1f}ms")
+
+
+if __name__ == '__main__':
+    main()
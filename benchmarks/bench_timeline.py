@@ -0,0 +1,115 @@
+"""Benchmark loading and rendering a home feed page: ORM objects vs records.
+
+Fills a scratch database with users (with realistic bios and password
+hashes) and their messages, then times loading a 100-message home feed
+and rendering home.html with it, both as full Message/User objects (as
+app.py used to) and as the FeedMessage records of queries.py, and
+measures the peak memory allocated while doing so. The database is
+dropped and recreated first, so never point this at one you care about.
+
+    python benchmarks/bench_timeline.py
+    python benchmarks/bench_timeline.py postgresql:///warbler-bench
+"""
+
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+AUTHORS = 50
+MESSAGES = 2000
+RENDERS = 200
+
+
+def fill(db, User, Message):
+    """Add AUTHORS users and MESSAGES messages between them; return the user ids."""
+
+    users = [User(username=f'bench{n}', email=f'bench{n}@example.com',
+                  password='$2b$12$' + 'x' * 53, bio='Warbling since forever. ' * 6)
+             for n in range(AUTHORS)]
+    db.session.add_all(users)
+    db.session.flush()
+
+    for n in range(MESSAGES):
+        db.session.add(Message(text=f'Warble number {n}, with a few more words ' * 3,
+                               user_id=users[n % AUTHORS].id))
+
+        if n % 500 == 0:
+            db.session.flush()
+
+    db.session.commit()
+    return [user.id for user in users]
+
+
+def measure(function):
+    """Return (mean milliseconds, peak KB allocated) of calling `function`."""
+
+    function()  # warm up (template and query caches)
+
+    start = time.perf_counter()
+    for _ in range(RENDERS):
+        function()
+    elapsed = (time.perf_counter() - start) / RENDERS * 1000
+
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return elapsed, peak / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('database_url', nargs='?', default='sqlite://',
+                        help='scratch database (default: in-memory SQLite)')
+    args = parser.parse_args()
+
+    os.environ['DATABASE_URL'] = args.database_url
+
+    from flask import g, render_template
+    from sqlalchemy.orm import joinedload
+    from app import create_app, profile_counts
+    app = create_app()  # binds db to the scratch database
+
+    from models import db, User, Message
+    from queries import home_feed
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        following = fill(db, User, Message)
+
+    def render(load):
+        with app.test_request_context('/'):
+            g.user = User.query.get(following[0])
+            messages = load()
+            html = render_template('home.html', messages=messages, likes=set(),
+                                   counts=profile_counts(g.user),
+                                   suggestions=[], trends=[])
+            db.session.remove()
+            return html
+
+    def orm():
+        return (Message.query
+                .options(joinedload(Message.user))
+                .filter(Message.user_id.in_(following))
+                .order_by(Message.id.desc())
+                .limit(100)
+                .all())
+
+    def records():
+        return home_feed(db.session(), following)
+
+    print(f"{'home feed page':<18}{'load+render':>12}{'peak memory':>14}")
+
+    for label, load in [('ORM objects', orm), ('FeedMessages', records)]:
+        elapsed, peak = measure(lambda: render(load))
+        print(f"{label:<18}{elapsed:>10.2f}ms{peak:>12,.0f}KB")
+
+
+if __name__ == '__main__':
+    main()
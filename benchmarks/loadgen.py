@@ -0,0 +1,389 @@
+"""Drive a running Warbler with many concurrent users, Zipf-style.
+
+Each worker thread plays one user at a time: it logs in through the real
+login form (so it carries a real session cookie and CSRF tokens), makes
+--session-length requests picked from --mix, then moves on to another
+user. Who's active and who gets looked at both follow Zipf distributions
+(exponent --zipf) over the users of generator/users.csv, as seeded by
+seed.py (user n is row n), so a few accounts get most of the traffic,
+as in production. Messages to like come from the profiles workers have
+seen, the newest most often.
+
+    python seed.py
+    python benchmarks/loadgen.py prepare            # known passwords, once
+    gunicorn -c gunicorn.conf.py wsgi:app &
+    python benchmarks/loadgen.py run --workers 32 --duration 60
+    python benchmarks/loadgen.py run --mix home=80,profile=20
+
+`prepare` sets every user's password to --password, since the seeded
+hashes' passwords aren't known. `replay` sends the requests in a file of
+"METHOD PATH [form data]" lines (e.g. from an access log) instead of a
+mix, as users picked the same way. Form data without a csrf_token gets a
+fresh one from the form at its path (fetched untimed), since recorded
+tokens belong to other sessions.
+
+At the end it prints, per route, requests, errors, throughput and
+latency percentiles.
+"""
+
+import argparse
+import bisect
+import csv
+import itertools
+import os
+import random
+import re
+import sys
+import threading
+import time
+from http.cookiejar import CookieJar
+from urllib.error import HTTPError, URLError
+from urllib.parse import parse_qs, urlencode
+from urllib.request import HTTPCookieProcessor, HTTPRedirectHandler, build_opener
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+USERS_CSV = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                         'generator', 'users.csv')
+
+DEFAULT_MIX = 'home=45,profile=30,like=12,follow=5,post=5,message=3'
+
+CSRF_TOKEN = re.compile(r'name="csrf_token"[^>]*value="([^"]*)"')
+MESSAGE_LINK = re.compile(r'href="/messages/(\d+)"')
+
+# Message ids remembered per author, newest first.
+MESSAGES_PER_AUTHOR = 20
+
+PERCENTILES = (50, 90, 99)
+
+
+class Zipf:
+    """Draws from `items`, the k-th most popular with weight 1 / k ** exponent.
+
+    Popularity is a fixed shuffle of `items` (by `seed`), so runs agree on
+    who the popular users are.
+    """
+
+    def __init__(self, items, exponent, seed=0):
+        self.items = list(items)
+        random.Random(seed).shuffle(self.items)
+        self.cumulative = list(itertools.accumulate(
+            1 / rank ** exponent for rank in range(1, len(self.items) + 1)))
+
+    def draw(self, rng):
+        return self.items[bisect.bisect(self.cumulative, rng.random() * self.cumulative[-1])]
+
+
+class NoRedirects(HTTPRedirectHandler):
+    """Time each request on its own: hand redirects back instead of following them."""
+
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class Results:
+    """Thread-safe latencies and errors per route."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+
+    def record(self, route, seconds, ok):
+        with self.lock:
+            self.latencies.setdefault(route, []).append(seconds)
+
+            if not ok:
+                self.errors[route] = self.errors.get(route, 0) + 1
+
+    def report(self, elapsed):
+        print(f"{'route':<14}{'requests':>10}{'errors':>8}{'req/s':>9}"
+              + ''.join(f"{f'p{p} ms':>10}" for p in PERCENTILES) + f"{'max ms':>10}")
+
+        total = 0
+
+        for route, latencies in sorted(self.latencies.items()):
+            latencies.sort()
+            total += len(latencies)
+            marks = [latencies[min(len(latencies) - 1, len(latencies) * p // 100)]
+                     for p in PERCENTILES]
+
+            print(f"{route:<14}{len(latencies):>10,}{self.errors.get(route, 0):>8,}"
+                  f"{len(latencies) / elapsed:>9.1f}"
+                  + ''.join(f"{mark * 1000:>10.1f}" for mark in marks)
+                  + f"{latencies[-1] * 1000:>10.1f}")
+
+        print(f"{'all':<14}{total:>10,}{sum(self.errors.values()):>8,}{total / elapsed:>9.1f}")
+
+
+class Session:
+    """One user's cookies, logged in against the app at `base_url`."""
+
+    def __init__(self, base_url, results, timeout):
+        self.base_url = base_url.rstrip('/')
+        self.results = results
+        self.timeout = timeout
+        self.opener = build_opener(HTTPCookieProcessor(CookieJar()), NoRedirects)
+
+    def request(self, route, path, data=None):
+        """Send a request, timing it as `route`; return the body (or None on failure)."""
+
+        if isinstance(data, str):
+            body = data.encode()
+        else:
+            body = urlencode(data, doseq=True).encode() if data is not None else None
+        start = time.perf_counter()
+        status = None
+
+        try:
+            with self.opener.open(self.base_url + path, body, timeout=self.timeout) as resp:
+                page = resp.read().decode('utf-8', 'replace')
+                status = resp.status
+        except HTTPError as error:
+            page = None
+            status = error.code
+            error.close()
+        except (URLError, OSError):
+            page = None
+
+        self.results.record(route, time.perf_counter() - start,
+                            status is not None and status < 400)
+        return page
+
+    def fetch(self, path):
+        """Return the page at `path` without timing it (or None on failure)."""
+
+        try:
+            with self.opener.open(self.base_url + path, timeout=self.timeout) as resp:
+                return resp.read().decode('utf-8', 'replace')
+        except (URLError, OSError):
+            return None
+
+    def csrf_token(self, path):
+        """Return the CSRF token of the form at `path` (fetched untimed), or ''."""
+
+        token = CSRF_TOKEN.search(self.fetch(path) or '')
+        return token.group(1) if token else ''
+
+    def form(self, route, path, fields):
+        """Fetch the form at `path` (untimed) and submit it with its CSRF token."""
+
+        return self.request(route, path, dict(fields, csrf_token=self.csrf_token(path)))
+
+
+class Worker(threading.Thread):
+    """Plays users one after another until `deadline`."""
+
+    def __init__(self, number, args, users, active, popular, messages, results, deadline):
+        super().__init__(daemon=True)
+        self.rng = random.Random(args.seed * 1000 + number)
+        self.args = args
+        self.users = users
+        self.active = active
+        self.popular = popular
+        self.messages = messages
+        self.results = results
+        self.deadline = deadline
+
+        routes, weights = zip(*parse_mix(args.mix).items())
+        self.routes = routes
+        self.cumulative = list(itertools.accumulate(weights))
+
+    def pick_route(self):
+        return self.routes[bisect.bisect(self.cumulative, self.rng.random() * self.cumulative[-1])]
+
+    def login(self):
+        user_id = self.active.draw(self.rng)
+        session = Session(self.args.url, self.results, self.args.timeout)
+        session.form('login', '/login', dict(username=self.users[user_id],
+                                             password=self.args.password))
+        return session
+
+    def remember_messages(self, author_id, page):
+        if page:
+            found = list(dict.fromkeys(MESSAGE_LINK.findall(page)))[:MESSAGES_PER_AUTHOR]
+            if found:
+                self.messages[author_id] = found
+
+    def act(self, session, route):
+        # Without known messages of `other`, 'message' and 'like' fetch
+        # their profile instead, untimed, so the stats stay per action.
+        other = self.popular.draw(self.rng)
+
+        if route == 'home':
+            session.request(route, '/')
+
+        elif route == 'profile':
+            self.remember_messages(other, session.request(route, f'/users/{other}'))
+
+        elif route == 'message':
+            known = self.messages.get(other)
+            if known:
+                session.request(route, f'/messages/{known[self.rng.randrange(len(known))]}')
+            else:
+                self.remember_messages(other, session.fetch(f'/users/{other}'))
+
+        elif route == 'like':
+            known = self.messages.get(other)
+            if known:
+                # Newer messages get more likes
+                index = min(int(self.rng.expovariate(0.5)), len(known) - 1)
+                session.request(route, f'/users/add_like/{known[index]}', {})
+            else:
+                self.remember_messages(other, session.fetch(f'/users/{other}'))
+
+        elif route == 'follow':
+            session.request(route, f'/users/follow/{other}', {})
+
+        elif route == 'post':
+            session.form(route, '/messages/new',
+                         dict(text=f'Load test warble {self.rng.getrandbits(32):x}'))
+
+    def run(self):
+        while time.monotonic() < self.deadline:
+            session = self.login()
+
+            for _ in range(self.args.session_length):
+                if time.monotonic() >= self.deadline:
+                    return
+
+                self.act(session, self.pick_route())
+
+
+class Replayer(Worker):
+    """Sends its share of recorded requests, as users picked like Worker's."""
+
+    def __init__(self, lines, *args):
+        super().__init__(*args)
+        self.lines = lines
+
+    def run(self):
+        session = None
+
+        for count, line in enumerate(self.lines):
+            if time.monotonic() >= self.deadline:
+                return
+
+            if count % self.args.session_length == 0:
+                session = self.login()
+
+            method, path, *data = line.split(None, 2)
+            route = path.split('?')[0].strip('/').split('/')[0] or 'home'
+            body = None
+
+            if method == 'POST':
+                body = data[0] if data else ''
+
+                if body and 'csrf_token' not in parse_qs(body):
+                    body += '&' + urlencode(dict(csrf_token=session.csrf_token(path)))
+
+            session.request(route, path, body)
+
+
+def parse_mix(mix):
+    """Parse "home=45,profile=30" into {'home': 45.0, 'profile': 30.0}."""
+
+    routes = {}
+
+    for part in mix.split(','):
+        route, _, weight = part.partition('=')
+        if route.strip() not in {'home', 'profile', 'message', 'like', 'follow', 'post'}:
+            raise argparse.ArgumentTypeError(f"unknown route in mix: {route}")
+        routes[route.strip()] = float(weight or 1)
+
+    return routes
+
+
+def load_users(path):
+    """Return {user id: username} for the users seed.py made from `path`."""
+
+    with open(path) as users:
+        return {number: row['username']
+                for number, row in enumerate(csv.DictReader(users), start=1)}
+
+
+def prepare(password):
+    """Give every user `password`, so workers can log in as any of them."""
+
+    from app import create_app
+    from models import db, bcrypt, User
+
+    with create_app().app_context():
+        hashed = bcrypt.generate_password_hash(password).decode('UTF-8')
+        count = User.query.update({User.password: hashed}, synchronize_session=False)
+        db.session.commit()
+
+    print(f"Set the password of {count:,} users")
+
+
+def run(args, lines=None):
+    users = load_users(args.users)
+    active = Zipf(users, args.zipf, seed=args.seed)
+    popular = Zipf(users, args.zipf, seed=args.seed + 1)
+    messages = {}
+    results = Results()
+    deadline = time.monotonic() + args.duration
+
+    if lines is None:
+        workers = [Worker(number, args, users, active, popular, messages, results, deadline)
+                   for number in range(args.workers)]
+    else:
+        workers = [Replayer(lines[number::args.workers], number, args, users, active, popular,
+                            messages, results, deadline)
+                   for number in range(args.workers)]
+
+    start = time.monotonic()
+
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    results.report(time.monotonic() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command')
+
+    setup = commands.add_parser('prepare', help="set every user's password (writes to DATABASE_URL)")
+    setup.add_argument('--password', default='password')
+
+    load = commands.add_parser('run', help='drive the app with a mix of routes')
+    replay = commands.add_parser('replay', help='send the requests in a file')
+    replay.add_argument('requests', help='file of "METHOD PATH [form data]" lines')
+
+    for command in (load, replay):
+        command.add_argument('--url', default='http://localhost:5000')
+        command.add_argument('--workers', type=int, default=16)
+        command.add_argument('--duration', type=float, default=30, help='seconds')
+        command.add_argument('--session-length', type=int, default=20,
+                             help='requests per login')
+        command.add_argument('--mix', type=str, default=DEFAULT_MIX,
+                             help=f'route weights (default: {DEFAULT_MIX})')
+        command.add_argument('--zipf', type=float, default=1.1, help='Zipf exponent')
+        command.add_argument('--users', default=USERS_CSV)
+        command.add_argument('--password', default='password')
+        command.add_argument('--timeout', type=float, default=10, help='seconds per request')
+        command.add_argument('--seed', type=int, default=0)
+
+    args = parser.parse_args()
+
+    if args.command == 'prepare':
+        prepare(args.password)
+
+    elif args.command == 'run':
+        parse_mix(args.mix)
+        run(args)
+
+    elif args.command == 'replay':
+        with open(args.requests) as requests:
+            lines = [line.strip() for line in requests if line.strip()]
+        run(args, lines)
+
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
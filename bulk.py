@@ -0,0 +1,191 @@
+"""Follows and unfollows in bulk.
+
+Following or unfollowing many users at once (POST /users/follow and
+/users/stop-following with a list of `user_ids`) takes one select of the
+edges that already exist and one insert or delete for the rest, however
+many users there are.
+
+Follow lists are CSV files with the columns of generator/follows.csv
+(and of a follows export, see export.py):
+
+    user_being_followed_id,user_following_id
+
+    python bulk.py follows.csv
+
+Rows are read with DictReader, as seed.py does, and inserted in batches
+of BATCH_SIZE, one transaction each. Follows that already exist, repeat
+within the file, follow oneself or name a user that doesn't exist are
+skipped, so an import can be rerun safely.
+"""
+
+import argparse
+from csv import DictReader
+from itertools import islice
+
+from sqlalchemy import select
+
+from followgraph import record_follow, apply_recorded_follows
+from models import db, User, Follows, StaleRecommendation
+
+# Rows per insert (and per transaction) while importing.
+BATCH_SIZE = 5000
+
+# Users one request can follow or unfollow at once.
+MAX_REQUEST_USERS = 1000
+
+follows = Follows.__table__
+users = User.__table__
+
+
+def insert_ignore(conn, table, rows):
+    """Insert `rows` (dicts) into `table`, skipping any that would violate
+    a unique constraint. Returns how many were inserted."""
+
+    if not rows:
+        return 0
+
+    dialect = conn.dialect.name
+
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        statement = insert(table).on_conflict_do_nothing()
+
+    elif dialect == 'sqlite':
+        statement = table.insert().prefix_with('OR IGNORE')
+
+    else:
+        statement = table.insert()
+
+    return conn.execute(statement, rows).rowcount
+
+
+def known_users(conn, user_ids):
+    """Return which of `user_ids` are users."""
+
+    if not user_ids:
+        return set()
+
+    return {user_id for (user_id,) in conn.execute(
+        select([users.c.id]).where(users.c.id.in_(user_ids)))}
+
+
+def existing_follows(conn, pairs):
+    """Return which (followed id, follower id) `pairs` are already follows."""
+
+    if not pairs:
+        return set()
+
+    followers = {follower_id for _, follower_id in pairs}
+    followed = {followed_id for followed_id, _ in pairs}
+
+    rows = conn.execute(select([follows.c.user_being_followed_id, follows.c.user_following_id])
+                        .where(follows.c.user_following_id.in_(followers))
+                        .where(follows.c.user_being_followed_id.in_(followed)))
+
+    return {tuple(row) for row in rows} & pairs
+
+
+def add_follows(session, pairs):
+    """Add the (followed id, follower id) `pairs` that aren't follows yet.
+
+    Marks both users' recommendations stale and records the follows for
+    the follow graph. Doesn't commit (call
+    apply_recorded_follows() after committing). Returns the pairs added.
+    """
+
+    conn = session.connection()
+    pairs = set(pairs) - existing_follows(conn, set(pairs))
+
+    insert_ignore(conn, follows, [
+        dict(user_being_followed_id=followed_id, user_following_id=follower_id)
+        for followed_id, follower_id in pairs])
+
+    for user_id in {user_id for pair in pairs for user_id in pair}:
+        StaleRecommendation.mark(user_id)
+
+    for followed_id, follower_id in pairs:
+        record_follow(follower_id, followed_id)
+
+    return pairs
+
+
+def follow_users(session, follower_id, user_ids):
+    """Have user `follower_id` follow the users in `user_ids`.
+
+    Ids of users that don't exist, and the follower's own, are ignored.
+    Doesn't commit. Returns the ids newly followed.
+    """
+
+    user_ids = known_users(session.connection(), set(user_ids) - {follower_id})
+
+    return {followed_id for followed_id, _ in
+            add_follows(session, {(user_id, follower_id) for user_id in user_ids})}
+
+
+def unfollow_users(session, follower_id, user_ids):
+    """Have user `follower_id` stop following the users in `user_ids`.
+
+    Doesn't commit. Returns the ids unfollowed.
+    """
+
+    conn = session.connection()
+    unfollowed = {followed_id for followed_id, _ in existing_follows(
+        conn, {(user_id, follower_id) for user_id in user_ids})}
+
+    if not unfollowed:
+        return unfollowed
+
+    conn.execute(follows.delete()
+                 .where(follows.c.user_following_id == follower_id)
+                 .where(follows.c.user_being_followed_id.in_(unfollowed)))
+
+    for user_id in unfollowed | {follower_id}:
+        StaleRecommendation.mark(user_id)
+
+    for followed_id in unfollowed:
+        record_follow(follower_id, followed_id, following=False)
+
+    return unfollowed
+
+
+def import_follows(rows, batch_size=BATCH_SIZE):
+    """Import follows from dicts like DictReader's rows of follows.csv.
+
+    Returns (rows read, follows added).
+    """
+
+    read = added = 0
+    rows = iter(rows)
+
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            return read, added
+
+        read += len(batch)
+        pairs = {(int(row['user_being_followed_id']), int(row['user_following_id']))
+                 for row in batch}
+        pairs = {(followed_id, follower_id) for followed_id, follower_id in pairs
+                 if followed_id != follower_id}
+
+        known = known_users(db.session.connection(),
+                            {user_id for pair in pairs for user_id in pair})
+
+        added += len(add_follows(db.session, {pair for pair in pairs
+                                              if pair[0] in known and pair[1] in known}))
+        db.session.commit()
+        apply_recorded_follows()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Import follows from a CSV file.")
+    parser.add_argument('path', help='CSV with user_being_followed_id,user_following_id')
+    args = parser.parse_args()
+
+    from app import create_app
+    app = create_app()  # binds db to the configured database
+
+    with app.app_context(), open(args.path) as follows:
+        read, added = import_follows(DictReader(follows))
+
+    print(f"Read {read:,} follows, added {added:,} (the rest already existed or were invalid)")
@@ -0,0 +1,273 @@
+"""Response compression for rendered pages.
+
+`Compressor` wraps the app's WSGI callable, so it sees each response after
+every Flask hook (including the debug toolbar) has run. Responses of a
+compressible type are sent brotli- or gzip-encoded, whichever the client
+prefers, when they're at least COMPRESS_MIN_SIZE bytes. Streamed responses
+(no Content-Length) are compressed chunk by chunk and flushed as they go,
+so they still stream. Anything that already has a Content-Encoding, like
+the precompressed assets from assets.py, is passed through untouched.
+
+Per route, the compressor counts bytes before and after and the CPU time
+spent compressing, so COMPRESS_LEVELS can be tuned against real traffic;
+see the /admin/compression route in app.py.
+"""
+
+import threading
+import time
+import zlib
+
+from flask import request
+
+COMPRESSIBLE_TYPES = {
+    'text/html', 'text/css', 'text/plain', 'text/xml', 'text/csv',
+    'application/json', 'application/javascript', 'application/xml',
+    'image/svg+xml',
+}
+
+# Preferred first when the client accepts both equally.
+ENCODINGS = ['br', 'gzip']
+
+ROUTE_KEY = 'warbler.route'
+
+
+def accepted_encodings(accept_encoding):
+    """Return {encoding: q-value} for an Accept-Encoding header."""
+
+    weights = {}
+
+    for value in accept_encoding.split(','):
+        name, _, params = value.strip().partition(';')
+        weight = 1.0
+
+        if params.strip().startswith('q='):
+            try:
+                weight = float(params.strip()[2:])
+            except ValueError:
+                continue
+
+        weights[name.strip().lower()] = weight
+
+    return weights
+
+
+def choose_encoding(accept_encoding):
+    """Return the encoding to use for an Accept-Encoding header, or None."""
+
+    weights = accepted_encodings(accept_encoding)
+    candidates = [encoding for encoding in ENCODINGS if weights.get(encoding, 0) > 0]
+
+    if not candidates:
+        return None
+
+    return max(candidates, key=lambda encoding: weights[encoding])
+
+
+def compressor(encoding, level):
+    """Return (compress, flush, finish) functions for a new stream."""
+
+    if encoding == 'br':
+        import brotli
+
+        stream = brotli.Compressor(quality=level)
+        return stream.process, stream.flush, stream.finish
+
+    stream = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return (stream.compress,
+            lambda: stream.flush(zlib.Z_SYNC_FLUSH),
+            lambda: stream.flush(zlib.Z_FINISH))
+
+
+class CompressionStats:
+    """Thread-safe per-route totals of bytes in, bytes out and CPU time."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._routes = {}
+
+    def record(self, route, encoding, bytes_in, bytes_out, cpu_seconds):
+        with self._lock:
+            totals = self._routes.setdefault((route, encoding), [0, 0, 0, 0.0])
+            totals[0] += 1
+            totals[1] += bytes_in
+            totals[2] += bytes_out
+            totals[3] += cpu_seconds
+
+    def snapshot(self):
+        """Return a list of per-route dicts, most bytes saved first."""
+
+        with self._lock:
+            routes = {key: list(totals) for key, totals in self._routes.items()}
+
+        rows = []
+
+        for (route, encoding), (responses, bytes_in, bytes_out, cpu) in routes.items():
+            rows.append({
+                'route': route,
+                'encoding': encoding,
+                'responses': responses,
+                'bytes_in': bytes_in,
+                'bytes_out': bytes_out,
+                'ratio': round(bytes_out / bytes_in, 3) if bytes_in else None,
+                'cpu_ms': round(cpu * 1000, 2),
+                'cpu_ms_per_mb': round(cpu * 1000 / (bytes_in / 1e6), 2) if bytes_in else None,
+            })
+
+        return sorted(rows, key=lambda row: row['bytes_out'] - row['bytes_in'])
+
+    def reset(self):
+        with self._lock:
+            self._routes.clear()
+
+
+class Compressor:
+    """WSGI middleware that compresses a Flask app's responses.
+
+    Reads its settings from the app's config on every request:
+
+    - COMPRESS_MIN_SIZE: smallest body (in bytes) worth compressing
+    - COMPRESS_LEVELS: {'br': quality, 'gzip': level}
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.wsgi_app = app.wsgi_app
+        self.stats = CompressionStats()
+
+        app.wsgi_app = self
+        app.extensions['compressor'] = self
+        app.before_request(self.remember_route)
+
+    @staticmethod
+    def remember_route():
+        """Note the matched route, for the per-route stats."""
+
+        if request.url_rule is not None:
+            request.environ[ROUTE_KEY] = request.url_rule.rule
+
+    def __call__(self, environ, start_response):
+        captured = []
+
+        def write(data):
+            raise RuntimeError("write() isn't supported; return an iterable")
+
+        def capture(status, headers, exc_info=None):
+            captured[:] = [status, headers, exc_info]
+            return write
+
+        body = self.wsgi_app(environ, capture)
+        status, headers, exc_info = captured
+        encoding = self.encoding_for(environ, status, headers)
+
+        if encoding is None:
+            start_response(status, headers, exc_info)
+            return body
+
+        route = environ.get(ROUTE_KEY, '<unmatched>')
+        length = next((value for name, value in headers if name.lower() == 'content-length'),
+                      None)
+
+        if length is None:
+            headers = self.compressed_headers(headers, encoding)
+            start_response(status, headers, exc_info)
+            return self.stream(body, encoding, route)
+
+        try:
+            data = b''.join(body)
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+
+        if len(data) < self.app.config['COMPRESS_MIN_SIZE']:
+            start_response(status, headers, exc_info)
+            return [data]
+
+        compressed = self.compress(data, encoding, route)
+
+        if len(compressed) >= len(data):
+            start_response(status, headers, exc_info)
+            return [data]
+
+        headers = self.compressed_headers(headers, encoding) + [
+            ('Content-Length', str(len(compressed)))]
+        start_response(status, headers, exc_info)
+        return [compressed]
+
+    def encoding_for(self, environ, status, headers):
+        """Return the encoding to compress this response with, or None."""
+
+        if environ['REQUEST_METHOD'] == 'HEAD':
+            return None
+
+        code = int(status.split(None, 1)[0])
+
+        if code < 200 or code in (204, 206, 304):
+            return None
+
+        values = {name.lower(): value for name, value in headers}
+        mimetype = values.get('content-type', '').split(';')[0].strip()
+
+        if ('content-encoding' in values
+                or mimetype not in COMPRESSIBLE_TYPES
+                or 'no-transform' in values.get('cache-control', '')):
+            return None
+
+        return choose_encoding(environ.get('HTTP_ACCEPT_ENCODING', ''))
+
+    @staticmethod
+    def compressed_headers(headers, encoding):
+        """Return `headers` updated for a body sent with `encoding`."""
+
+        vary = [value for name, value in headers if name.lower() == 'vary']
+        headers = [(name, value) for name, value in headers
+                   if name.lower() not in ('content-length', 'vary', 'etag')]
+
+        return headers + [
+            ('Content-Encoding', encoding),
+            ('Vary', ', '.join(vary + ['Accept-Encoding'])),
+        ]
+
+    def compress(self, data, encoding, route):
+        """Return `data` compressed in one go."""
+
+        start = time.thread_time()
+        compress, _, finish = compressor(encoding, self.app.config['COMPRESS_LEVELS'][encoding])
+        compressed = compress(data) + finish()
+
+        self.stats.record(route, encoding, len(data), len(compressed),
+                          time.thread_time() - start)
+        return compressed
+
+    def stream(self, body, encoding, route):
+        """Compress a streamed body, flushing after every chunk."""
+
+        compress, flush, finish = compressor(encoding,
+                                             self.app.config['COMPRESS_LEVELS'][encoding])
+        bytes_in = bytes_out = 0
+        cpu = 0.0
+
+        try:
+            for chunk in body:
+                if not chunk:
+                    continue
+
+                start = time.thread_time()
+                out = compress(chunk) + flush()
+                cpu += time.thread_time() - start
+
+                bytes_in += len(chunk)
+                bytes_out += len(out)
+                yield out
+
+            start = time.thread_time()
+            out = finish()
+            cpu += time.thread_time() - start
+
+            bytes_out += len(out)
+            yield out
+
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+
+            self.stats.record(route, encoding, bytes_in, bytes_out, cpu)
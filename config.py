@@ -0,0 +1,100 @@
+"""App configuration, picked by name (or class) in `create_app`.
+
+Settings are read from the environment when this module is imported, so
+set DATABASE_URL, SECRET_KEY etc. before starting the app.
+"""
+
+import os
+
+
+class Config:
+    """Settings shared by every environment."""
+
+    # Get DB_URI from environ variable (useful for production) or,
+    # if not set there, use development local db.
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL', 'postgresql:///warbler')
+
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ECHO = False
+    SECRET_KEY = os.environ.get('SECRET_KEY', "it's a secret")
+
+    # Only DevelopmentConfig installs the debug toolbar.
+    DEBUG_TOOLBAR = False
+    DEBUG_TB_INTERCEPT_REDIRECTS = True
+
+    # Resized user images (see images.py); defaults to instance/image-cache
+    IMAGE_CACHE_DIR = os.environ.get('IMAGE_CACHE_DIR')
+    IMAGE_CACHE_MAX_BYTES = 512 * 1024 * 1024
+    IMAGE_PROXY_ALLOW_FILES = False
+
+    # Compiled templates, shared by workers and kept across restarts (see
+    # templating.py); defaults to instance/template-cache
+    TEMPLATE_CACHE_DIR = os.environ.get('TEMPLATE_CACHE_DIR')
+
+    # Response compression (see compression.py)
+    COMPRESS_MIN_SIZE = 1024
+    COMPRESS_LEVELS = {'br': 4, 'gzip': 6}
+
+    # In-memory follow graph (see followgraph.py); off unless a path is set
+    FOLLOW_GRAPH_PATH = os.environ.get('FOLLOW_GRAPH_PATH')
+    FOLLOW_GRAPH_SYNC_SECONDS = 1.0
+
+    # Pin the worker id in message ids (see snowflake.py); by default each
+    # process claims a free one from Postgres
+    SNOWFLAKE_WORKER_ID = os.environ.get('SNOWFLAKE_WORKER_ID')
+
+    # Per-route query deadlines, the longer one for refreshing a page
+    # served stale after missing its deadline, and how many pages' last
+    # good loads each worker keeps (see deadlines.py)
+    QUERY_DEADLINES_MS = {'homepage': 800, 'users_show': 800}
+    STALE_REFRESH_DEADLINE_MS = 10000
+    LAST_GOOD_CACHE_SIZE = 1000
+
+    # Databases holding messages and likes, by user id (see sharding.py);
+    # the main database holds them when there are none
+    MESSAGE_SHARDS = os.environ.get('MESSAGE_SHARDS', '').split()
+
+    # Months of messages older than this are moved to files (see archive.py);
+    # ARCHIVE_DIR defaults to instance/archive
+    ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR')
+    ARCHIVE_AFTER_DAYS = 365
+
+    # Record every request's SQL and log likely N+1s (see querytrace.py)
+    QUERY_TRACE = os.environ.get('QUERY_TRACE') == '1'
+
+    # Fraction of requests traced for per-route memory use, how many
+    # allocation sites to keep, and a file to append samples to
+    # (see memprofile.py)
+    MEMORY_PROFILE_RATE = float(os.environ.get('MEMORY_PROFILE_RATE', 0))
+    MEMORY_PROFILE_TOP = 10
+    MEMORY_PROFILE_LOG = os.environ.get('MEMORY_PROFILE_LOG')
+
+    # Expose /admin/* metrics routes, to users logged in as one of
+    # ADMIN_USERNAMES (comma-separated)
+    ADMIN_METRICS = os.environ.get('ADMIN_METRICS') == '1'
+    ADMIN_USERNAMES = set(filter(None, os.environ.get('ADMIN_USERNAMES', '').split(',')))
+
+
+class DevelopmentConfig(Config):
+    DEBUG = True
+    DEBUG_TOOLBAR = True
+    QUERY_TRACE = True
+
+
+class TestingConfig(Config):
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = "postgresql:///warbler-test"
+
+    # Don't have WTForms use CSRF at all, since it's a pain to test
+    WTF_CSRF_ENABLED = False
+
+
+class ProductionConfig(Config):
+    pass
+
+
+CONFIGS = {
+    'development': DevelopmentConfig,
+    'testing': TestingConfig,
+    'production': ProductionConfig,
+}
@@ -0,0 +1,168 @@
+"""Query deadlines, with the last good result to fall back on.
+
+Hot pages give their queries a deadline (QUERY_DEADLINES_MS, per route),
+enforced by Postgres as a statement timeout on each connection (main
+database and shards) of the load's session:
+
+    SET LOCAL statement_timeout = 800
+
+so a slow database cancels the query instead of holding the worker until
+the server gives up on it. `LastGoodCache` remembers each page's last
+successful load; when a load misses its deadline, the route is served
+that result marked as stale while a background thread loads the page
+again with a longer deadline (STALE_REFRESH_DEADLINE_MS). Only when
+there's nothing cached does a missed deadline become an error (a 503).
+
+The cache is per process and only read when the database is struggling;
+every other request still loads its page fresh. It holds at most
+max_entries results, dropping the least recently used, and callers keep
+only the pages worth it (app.py keeps first pages, not older ones).
+"""
+
+import threading
+from collections import OrderedDict
+
+from sqlalchemy import event
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import Session
+
+# Postgres' SQLSTATE for a statement cancelled by statement_timeout.
+QUERY_CANCELED = '57014'
+
+# Keys in Session.info: the session's statement timeout, and the
+# connections its current transaction holds.
+TIMEOUT_KEY = 'warbler.statement_timeout_ms'
+CONNECTIONS_KEY = 'warbler.connections'
+
+
+class DeadlineExceeded(Exception):
+    """A load's queries didn't finish within its deadline."""
+
+
+def statement_timeout(session, timeout_ms):
+    """Limit each statement `session` runs to `timeout_ms`, on every database.
+
+    Connections the session's transaction already holds get the timeout
+    now; any it begins later (a shard, or any after a commit) get it as
+    they begin. Only Postgres supports this; elsewhere it does nothing.
+    """
+
+    session.info[TIMEOUT_KEY] = int(timeout_ms)
+
+    for connection in session.info.get(CONNECTIONS_KEY, ()):
+        set_local_timeout(connection, timeout_ms)
+
+
+def set_local_timeout(connection, timeout_ms):
+    if connection.dialect.name == 'postgresql':
+        connection.execute(f'SET LOCAL statement_timeout = {int(timeout_ms)}')
+
+
+@event.listens_for(Session, 'after_begin')
+def after_begin(session, transaction, connection):
+    if transaction.nested:
+        return
+
+    session.info.setdefault(CONNECTIONS_KEY, []).append(connection)
+
+    if TIMEOUT_KEY in session.info:
+        set_local_timeout(connection, session.info[TIMEOUT_KEY])
+
+
+@event.listens_for(Session, 'after_transaction_end')
+def after_transaction_end(session, transaction):
+    if transaction.parent is None:
+        session.info.pop(CONNECTIONS_KEY, None)
+
+
+def is_deadline_error(exc):
+    """Is `exc` Postgres cancelling a statement that ran out of time?"""
+
+    return (isinstance(exc, DBAPIError)
+            and getattr(exc.orig, 'pgcode', None) == QUERY_CANCELED)
+
+
+class LastGoodCache:
+    """The last good result of each page load, for when the next one is late."""
+
+    def __init__(self, app, max_entries=1000, refresh_deadline_ms=10000):
+        self.app = app
+        self.max_entries = max_entries
+        self.refresh_deadline_ms = refresh_deadline_ms
+        self._lock = threading.Lock()
+        self._results = OrderedDict()
+        self._refreshing = {}
+
+    def fetch(self, key, load, deadline_ms, keep=True):
+        """Return (result, stale) for `key`.
+
+        `load(deadline_ms)` loads the page, raising DeadlineExceeded (or the
+        database's own cancellation error) if it runs out of time. If it
+        does, the last good result is returned with stale=True, and a
+        refresh is started; with no last good result, the error propagates.
+        With keep=False a good result isn't remembered.
+        """
+
+        try:
+            result = self._load(load, deadline_ms)
+
+        except DeadlineExceeded:
+            with self._lock:
+                if key not in self._results:
+                    raise
+                result = self._results[key]
+                self._results.move_to_end(key)
+
+            self.refresh(key, load)
+            return result, True
+
+        if keep:
+            self._store(key, result)
+
+        return result, False
+
+    def refresh(self, key, load):
+        """Load `key` again in the background; return the thread doing it."""
+
+        with self._lock:
+            if key in self._refreshing:
+                return self._refreshing[key]
+
+            thread = self._refreshing[key] = threading.Thread(
+                target=self._refresh, args=(key, load), daemon=True)
+
+        thread.start()
+        return thread
+
+    def _refresh(self, key, load):
+        try:
+            with self.app.app_context():
+                self._store(key, self._load(load, self.refresh_deadline_ms))
+
+        except Exception:
+            self.app.logger.exception("Refreshing %r failed", key)
+
+        finally:
+            with self._lock:
+                del self._refreshing[key]
+
+    def _load(self, load, deadline_ms):
+        try:
+            return load(deadline_ms)
+
+        except DBAPIError as exc:
+            if is_deadline_error(exc):
+                raise DeadlineExceeded(str(exc.orig)) from exc
+            raise
+
+    def _store(self, key, result):
+        with self._lock:
+            self._results[key] = result
+            self._results.move_to_end(key)
+
+            while len(self._results) > self.max_entries:
+                self._results.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
@@ -0,0 +1,143 @@
+"""Account data exports, streamed.
+
+A user can download their messages, follows and likes as NDJSON or CSV
+(/users/export/<dataset>.<format>), and operators can export any user's:
+
+    python export.py USER_ID messages --format csv > messages.csv
+
+Rows come off a server-side cursor (stream_results) in batches of
+FETCH_SIZE and are written out as they arrive, so an export takes the
+same memory however much there is. CSV columns follow generator/*.csv,
+so a follows export can be imported again with bulk.py.
+"""
+
+import argparse
+import csv
+import io
+import json
+import sys
+
+from sqlalchemy import select
+
+from archive import archived_months, read_user_month, to_message
+from models import db, Follows
+from sharding import messages, likes, shard_router
+
+# Rows pulled per round trip while exporting.
+FETCH_SIZE = 1000
+
+FORMATS = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+
+follows = Follows.__table__
+
+# (columns, select of one user's rows, whether it's on the user's shard)
+DATASETS = {
+    'messages': (
+        ['id', 'text', 'timestamp', 'user_id'],
+        lambda user_id: (select([messages.c.id, messages.c.text, messages.c.timestamp,
+                                 messages.c.user_id])
+                         .where(messages.c.user_id == user_id)
+                         .order_by(messages.c.id.desc())),
+        True),
+    'follows': (
+        ['user_being_followed_id', 'user_following_id'],
+        lambda user_id: (select([follows.c.user_being_followed_id, follows.c.user_following_id])
+                         .where(follows.c.user_following_id == user_id)
+                         .order_by(follows.c.user_being_followed_id)),
+        False),
+    'likes': (
+        ['message_id'],
+        lambda user_id: (select([likes.c.message_id])
+                         .where(likes.c.user_id == user_id)
+                         .order_by(likes.c.message_id.desc())),
+        True),
+}
+
+
+def stream(engine, statement):
+    """Yield the rows of `statement` from a server-side cursor."""
+
+    with engine.connect() as conn:
+        rows = conn.execution_options(stream_results=True).execute(statement)
+
+        while True:
+            batch = rows.fetchmany(FETCH_SIZE)
+            if not batch:
+                return
+
+            yield from batch
+
+
+def archived_rows(directory, user_id):
+    """Yield user `user_id`'s archived messages as rows, newest first."""
+
+    for start in archived_months(directory):
+        for record in read_user_month(directory, start, user_id):
+            message = to_message(record)
+            yield message.id, message.text, message.timestamp, message.user_id
+
+
+def export_rows(user_id, dataset, archive_dir=None):
+    """Yield user `user_id`'s rows of `dataset`, as tuples in its column order.
+
+    Messages include those archived in `archive_dir`, after the live ones.
+    """
+
+    _, build, sharded = DATASETS[dataset]
+    router = shard_router()
+    engine = router.engine(router.shard_for(user_id)) if sharded else db.engine
+
+    yield from stream(engine, build(user_id))
+
+    if dataset == 'messages' and archive_dir:
+        yield from archived_rows(archive_dir, user_id)
+
+
+def value(column):
+    return column.isoformat(' ') if hasattr(column, 'isoformat') else column
+
+
+def as_ndjson(columns, rows):
+    for row in rows:
+        yield json.dumps(dict(zip(columns, map(value, row)))) + '\n'
+
+
+def as_csv(columns, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    writer.writerow(columns)
+
+    for row in rows:
+        writer.writerow(map(value, row))
+
+        if buffer.tell() >= 8192:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    yield buffer.getvalue()
+
+
+def export(user_id, dataset, fmt, archive_dir=None):
+    """Yield chunks of text: user `user_id`'s `dataset` in format `fmt`."""
+
+    columns = DATASETS[dataset][0]
+    rows = export_rows(user_id, dataset, archive_dir)
+
+    return as_csv(columns, rows) if fmt == 'csv' else as_ndjson(columns, rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export a user's data to stdout.")
+    parser.add_argument('user_id', type=int)
+    parser.add_argument('dataset', choices=sorted(DATASETS))
+    parser.add_argument('--format', dest='fmt', choices=sorted(FORMATS), default='ndjson')
+    args = parser.parse_args()
+
+    from app import create_app
+    app = create_app()  # binds db to the configured database
+
+    with app.app_context():
+        sys.stdout.writelines(export(args.user_id, args.dataset, args.fmt,
+                                     app.config['ARCHIVE_DIR']))
@@ -0,0 +1,480 @@
+"""In-memory follow graph, shared by every worker through a mmapped snapshot.
+
+When FOLLOW_GRAPH_PATH is set, follow questions (is_following, follower and
+following counts and lists, the home feed's authors) are answered from
+arrays instead of the `follows` table:
+
+- following: CSR adjacency, follower -> followed. Row u is
+  following_ids[following_ptr[u]:following_ptr[u + 1]], sorted, so
+  membership is a binary search and a count is a subtraction.
+- followers: the same for the reverse direction.
+
+The snapshot is built by a batch job:
+
+    python followgraph.py
+
+and written atomically to a single file that every worker maps read-only,
+so the operating system keeps one copy in memory however many workers
+there are. Workers notice a new snapshot by its mtime and switch to it.
+
+Between snapshots, follows and unfollows are recorded as FollowEvent rows.
+Each worker replays new events (at most every FOLLOW_GRAPH_SYNC_SECONDS)
+into a small private overlay of added and removed edges, so answers stay
+current without rebuilding the arrays.
+
+Event ids are handed out when a row is inserted, not when it commits, so
+a smaller id can show up after a larger one. A worker keeps looking for
+the ids it skipped for GAP_SECONDS. When it switches to a snapshot, it
+replays the REPLAY_EVENTS events before the snapshot's cursor: those that
+committed while the snapshot was built. Replaying an event the arrays
+already reflect changes nothing.
+
+Only numpy is needed, and only when the graph is enabled.
+"""
+
+import argparse
+import json
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+from flask import g
+from sqlalchemy import select, func, or_
+
+from models import db, User, Follows, FollowEvent, follow_graph
+
+MAGIC = b'WFG1'
+
+# Follows rows pulled per round trip while loading the graph.
+FETCH_SIZE = 100000
+
+ARRAYS = ['following_ptr', 'following_ids', 'followers_ptr', 'followers_ids']
+
+# Events before a snapshot's cursor replayed on top of it.
+REPLAY_EVENTS = 1000
+
+# Seconds to keep looking for a skipped event id whose transaction may
+# not have committed yet (ids of rolled back ones never show up).
+GAP_SECONDS = 60
+
+
+##############################################################################
+# Compact adjacency
+
+
+def csr(sources, targets, size):
+    """Return (indptr, indices) of the edges sources[i] -> targets[i].
+
+    Each row's targets come out sorted, for binary search.
+    """
+
+    import numpy as np
+
+    order = np.lexsort((targets, sources))
+    counts = np.bincount(sources, minlength=size)
+
+    indptr = np.zeros(size + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+
+    return indptr, targets[order].astype(np.int32)
+
+
+def load_edges(conn):
+    """Return (followers, followed) arrays of every row in `follows`."""
+
+    import numpy as np
+
+    followers, followed = [], []
+    result = (conn
+              .execution_options(stream_results=True)
+              .execute(select([Follows.user_following_id,
+                               Follows.user_being_followed_id])))
+
+    while True:
+        rows = result.fetchmany(FETCH_SIZE)
+        if not rows:
+            break
+
+        edges = np.array([tuple(row) for row in rows], dtype=np.int32)
+        followers.append(edges[:, 0])
+        followed.append(edges[:, 1])
+
+    if not followers:
+        return np.empty(0, np.int32), np.empty(0, np.int32)
+
+    return np.concatenate(followers), np.concatenate(followed)
+
+
+class Snapshot:
+    """Read-only follow graph arrays, in memory or mapped from a file."""
+
+    def __init__(self, arrays, size, last_event_id=0):
+        self.size = size
+        self.last_event_id = last_event_id
+
+        for name in ARRAYS:
+            setattr(self, name, arrays[name])
+
+    @classmethod
+    def from_edges(cls, followers, followed, size, last_event_id=0):
+        """Build a snapshot from parallel arrays of follower and followed ids."""
+
+        following_ptr, following_ids = csr(followers, followed, size)
+        followers_ptr, followers_ids = csr(followed, followers, size)
+
+        return cls(dict(following_ptr=following_ptr, following_ids=following_ids,
+                        followers_ptr=followers_ptr, followers_ids=followers_ids),
+                   size, last_event_id)
+
+    @property
+    def edges(self):
+        return len(self.following_ids)
+
+    def save(self, path):
+        """Write the snapshot to `path` atomically.
+
+        Layout: magic, header length, JSON header, then each array's raw
+        bytes at the offset the header gives (8-byte aligned).
+        """
+
+        offset = 0
+        layout = {}
+
+        for name in ARRAYS:
+            array = getattr(self, name)
+            layout[name] = [offset, array.dtype.str, len(array)]
+            offset += (array.nbytes + 7) // 8 * 8
+
+        header = json.dumps(dict(size=self.size, last_event_id=self.last_event_id,
+                                 arrays=layout)).encode('utf-8')
+        header += b' ' * (-(len(MAGIC) + 8 + len(header)) % 8)
+
+        descriptor, temporary = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+
+        with os.fdopen(descriptor, 'wb') as out:
+            out.write(MAGIC + struct.pack('<Q', len(header)) + header)
+
+            for name in ARRAYS:
+                data = getattr(self, name).tobytes()
+                out.write(data + b'\0' * (-len(data) % 8))
+
+        os.replace(temporary, path)
+
+    @classmethod
+    def load(cls, path):
+        """Map the snapshot at `path` read-only (pages are shared between processes)."""
+
+        import numpy as np
+
+        with open(path, 'rb') as snapshot:
+            if snapshot.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not a follow graph snapshot")
+
+            header_length, = struct.unpack('<Q', snapshot.read(8))
+            header = json.loads(snapshot.read(header_length).decode('utf-8'))
+
+        start = len(MAGIC) + 8 + header_length
+
+        with open(path, 'rb') as snapshot:
+            # Plain arrays over one shared mapping: slicing an ndarray is
+            # much cheaper than slicing an np.memmap.
+            mapping = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+
+        arrays = {name: np.frombuffer(mapping, dtype=dtype, count=length,
+                                      offset=start + offset)
+                  for name, (offset, dtype, length) in header['arrays'].items()}
+
+        return cls(arrays, header['size'], header['last_event_id'])
+
+    def row(self, direction, user_id):
+        """Return the sorted ids adjacent to `user_id` ('following' or 'followers')."""
+
+        if not 0 <= user_id < self.size:
+            return getattr(self, f'{direction}_ids')[:0]
+
+        indptr = getattr(self, f'{direction}_ptr')
+        return getattr(self, f'{direction}_ids')[indptr[user_id]:indptr[user_id + 1]]
+
+    def has_edge(self, follower_id, followed_id):
+        import numpy as np
+
+        row = self.row('following', follower_id)
+        i = np.searchsorted(row, followed_id)
+        return i < len(row) and row[i] == followed_id
+
+    def degree(self, direction, user_id):
+        if not 0 <= user_id < self.size:
+            return 0
+
+        indptr = getattr(self, f'{direction}_ptr')
+        return int(indptr[user_id + 1] - indptr[user_id])
+
+
+##############################################################################
+# Per-worker service
+
+
+class FollowGraph:
+    """A snapshot plus this worker's overlay of newer follows and unfollows."""
+
+    def __init__(self, path, sync_seconds=1.0):
+        self.path = path
+        self.sync_seconds = sync_seconds
+        self._lock = threading.RLock()
+        # (snapshot, overlay), swapped as one so readers never mix them.
+        # The overlay maps direction -> user id -> (added ids, removed ids).
+        self._state = None
+        self._cursor = 0
+        # Event ids skipped past the snapshot's cursor -> when first missed
+        self._gaps = {}
+        self._floor = 0
+        self._mtime = None
+        self._next_sync = 0
+
+    def reset(self, snapshot):
+        """Switch to `snapshot` and drop the overlay.
+
+        The next sync replays the last REPLAY_EVENTS events before the
+        snapshot's cursor.
+        """
+
+        with self._lock:
+            self._state = (snapshot, {'following': {}, 'followers': {}})
+            self._cursor = max(snapshot.last_event_id - REPLAY_EVENTS, 0)
+            self._floor = snapshot.last_event_id
+            self._gaps = {}
+
+    def available(self):
+        """Load the snapshot if needed; return False if there isn't one yet."""
+
+        if self._state is None:
+            try:
+                self.sync(force=True)
+            except FileNotFoundError:
+                return False
+
+        return True
+
+    def sync(self, force=False):
+        """Pick up a new snapshot and replay new events, if it's time to."""
+
+        now = time.monotonic()
+
+        if not force and now < self._next_sync:
+            return
+
+        with self._lock:
+            self._next_sync = now + self.sync_seconds
+
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+            except FileNotFoundError:
+                if self._state is None:
+                    raise
+                # Removed under us; the mapped copy is still readable.
+                mtime = self._mtime
+
+            if mtime != self._mtime:
+                self.reset(Snapshot.load(self.path))
+                self._mtime = mtime
+
+            criterion = FollowEvent.id > self._cursor
+
+            if self._gaps:
+                criterion = or_(criterion, FollowEvent.id.in_(list(self._gaps)))
+
+            events = (db.session
+                      .query(FollowEvent)
+                      .filter(criterion)
+                      .order_by(FollowEvent.id)
+                      .all())
+
+            for event in events:
+                if event.id in self._gaps:
+                    del self._gaps[event.id]
+                else:
+                    for skipped in range(max(self._cursor, self._floor) + 1, event.id):
+                        self._gaps[skipped] = now
+                    self._cursor = event.id
+
+                self.apply(event.follower_id, event.followed_id, event.following)
+
+            self._gaps = {event_id: missed for event_id, missed in self._gaps.items()
+                          if now - missed < GAP_SECONDS}
+
+    def apply(self, follower_id, followed_id, following):
+        """Record a follow (or unfollow, if `following` is False) in the overlay."""
+
+        with self._lock:
+            snapshot, overlay = self._state
+            in_snapshot = snapshot.has_edge(follower_id, followed_id)
+
+            for direction, user_id, other_id in (('following', follower_id, followed_id),
+                                                 ('followers', followed_id, follower_id)):
+                added, removed = overlay[direction].setdefault(user_id, (set(), set()))
+
+                if following:
+                    removed.discard(other_id)
+                    if not in_snapshot:
+                        added.add(other_id)
+                else:
+                    added.discard(other_id)
+                    if in_snapshot:
+                        removed.add(other_id)
+
+    def is_following(self, follower_id, followed_id):
+        snapshot, overlay = self._state
+        added, removed = overlay['following'].get(follower_id, ((), ()))
+
+        if followed_id in added:
+            return True
+        if followed_id in removed:
+            return False
+
+        return bool(snapshot.has_edge(follower_id, followed_id))
+
+    def _count(self, direction, user_id):
+        snapshot, overlay = self._state
+        added, removed = overlay[direction].get(user_id, ((), ()))
+        return snapshot.degree(direction, user_id) + len(added) - len(removed)
+
+    def following_count(self, user_id):
+        return self._count('following', user_id)
+
+    def followers_count(self, user_id):
+        return self._count('followers', user_id)
+
+    def _ids(self, direction, user_id):
+        snapshot, overlay = self._state
+        added, removed = overlay[direction].get(user_id, ((), ()))
+        ids = snapshot.row(direction, user_id).tolist()
+
+        if removed:
+            ids = [other_id for other_id in ids if other_id not in removed]
+
+        return ids + sorted(added)
+
+    def following(self, user_id):
+        """Return the ids of the users `user_id` follows."""
+
+        return self._ids('following', user_id)
+
+    def followers(self, user_id):
+        """Return the ids of the users following `user_id`."""
+
+        return self._ids('followers', user_id)
+
+
+def init_follow_graph(app):
+    """Enable the follow graph for `app` if FOLLOW_GRAPH_PATH is set."""
+
+    path = app.config.get('FOLLOW_GRAPH_PATH')
+
+    if not path:
+        return
+
+    graph = app.extensions['follow_graph'] = FollowGraph(
+        path, app.config['FOLLOW_GRAPH_SYNC_SECONDS'])
+
+    @app.before_request
+    def sync_follow_graph():
+        if graph.available():
+            graph.sync()
+
+
+def record_follow(follower_id, followed_id, following=True):
+    """Queue a follow or unfollow for the follow graph, if it's enabled.
+
+    Call before committing; the worker applies it to its own overlay right
+    after the commit, and other workers on their next sync.
+    """
+
+    if follow_graph() is None:
+        return
+
+    db.session.add(FollowEvent(follower_id=follower_id, followed_id=followed_id,
+                               following=following))
+    g.setdefault('follow_events', []).append((follower_id, followed_id, following))
+
+
+def record_user_deleted(user_id):
+    """Queue unfollows for every follow to or from user `user_id`, who is
+    about to be deleted (taking those follows rows with them)."""
+
+    if follow_graph() is None:
+        return
+
+    follows = (db.session
+               .query(Follows.user_following_id, Follows.user_being_followed_id)
+               .filter(or_(Follows.user_following_id == user_id,
+                           Follows.user_being_followed_id == user_id))
+               .all())
+
+    for follower_id, followed_id in follows:
+        record_follow(follower_id, followed_id, following=False)
+
+
+def apply_recorded_follows():
+    """Apply this request's committed follow events to the local overlay."""
+
+    graph = follow_graph()
+
+    for event in g.pop('follow_events', []):
+        if graph is not None:
+            graph.apply(*event)
+
+
+##############################################################################
+# Snapshot builder
+
+
+def build_snapshot(path, engine=None):
+    """Write a fresh snapshot of `follows` to `path`; return it.
+
+    Events older than the snapshot being replaced are pruned: workers still
+    on that snapshot only need the ones after it.
+    """
+
+    engine = engine or db.engine
+    events = FollowEvent.__table__
+
+    try:
+        previous = Snapshot.load(path).last_event_id
+    except (OSError, ValueError):
+        previous = None
+
+    with engine.connect() as conn:
+        # Read the cursor first: events that land while the edges load are
+        # replayed on top, and replaying an edge that's already there is
+        # harmless.
+        last_event_id = conn.execute(select([func.max(events.c.id)])).scalar() or 0
+        size = (conn.execute(select([func.max(User.id)])).scalar() or 0) + 1
+        followers, followed = load_edges(conn)
+
+    snapshot = Snapshot.from_edges(followers, followed, size, last_event_id)
+    snapshot.save(path)
+
+    if previous:
+        with engine.begin() as conn:
+            conn.execute(events.delete().where(events.c.id <= previous))
+
+    return snapshot
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build the follow graph snapshot.")
+    parser.add_argument('--path', help='snapshot file (default: FOLLOW_GRAPH_PATH)')
+    args = parser.parse_args()
+
+    from app import create_app
+    app = create_app()  # binds db to the configured database
+
+    path = args.path or app.config['FOLLOW_GRAPH_PATH']
+    if not path:
+        parser.error("set FOLLOW_GRAPH_PATH or pass --path")
+
+    snapshot = build_snapshot(path)
+    print(f"Wrote {snapshot.edges:,} follows for {snapshot.size - 1:,} users to {path}")
@@ -0,0 +1,40 @@
+"""Gunicorn settings: build the app once, then fork workers that share it.
+
+With preload_app the master imports wsgi.py (and so every module and the
+app object) before forking, so each worker starts without paying the
+import cost and shares those memory pages with the master.
+"""
+
+import gc
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+preload_app = True
+
+
+def when_ready(server):
+    """Compile every template, then move everything loaded so far out of
+    the GC's reach before forking.
+
+    Workers then start with the templates ready (see templating.py), and
+    the first collection in each worker doesn't touch every preloaded
+    object and copy the pages they live on.
+    """
+
+    from templating import warm_templates
+    from wsgi import app
+
+    warm_templates(app)
+
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    """Don't let a worker reuse database connections opened by the master."""
+
+    from models import db
+    from sharding import shard_router
+
+    db.engine.dispose()
+    shard_router().dispose()
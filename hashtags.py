@@ -0,0 +1,175 @@
+"""Hashtags, @mentions and trending topics.
+
+When a message is posted, `index_message` records the hashtags and
+mentions in its text and bumps a counter for each hashtag in the current
+time bucket. A tag's trending score is the sum of its counters over the
+last TRENDING_BUCKETS buckets, so the window slides forward one bucket at
+a time and old buckets are pruned as tags are used again.
+"""
+
+import re
+import threading
+import time
+
+from markupsafe import Markup, escape
+from sqlalchemy import func, desc
+from sqlalchemy.exc import IntegrityError
+
+from models import db, User, Tag, MessageTag, Mention, TagCount
+
+# "&" is excluded before the sigil so escaped entities like "&#39;" aren't
+# mistaken for tags.
+HASHTAG_RE = re.compile(r'(?<![\w&])#(\w{1,50})')
+MENTION_RE = re.compile(r'(?<![\w&])@(\w(?:[\w.]*\w)?)')
+
+BUCKET_SECONDS = 5 * 60
+TRENDING_BUCKETS = 12
+TRENDING_SIZE = 10
+
+
+def extract_tags(text):
+    """Return the set of (lowercased) hashtags in `text`."""
+
+    return {tag.lower() for tag in HASHTAG_RE.findall(text)}
+
+
+def extract_mentions(text):
+    """Return the set of usernames @mentioned in `text`."""
+
+    return set(MENTION_RE.findall(text))
+
+
+def current_bucket(now=None):
+    """Return the start of the bucket containing `now` (default: now)."""
+
+    now = time.time() if now is None else now
+    return int(now) // BUCKET_SECONDS * BUCKET_SECONDS
+
+
+def get_or_create_tags(names):
+    """Return Tag rows for every name in `names`, creating missing ones."""
+
+    tags = {tag.name: tag for tag in Tag.query.filter(Tag.name.in_(names))}
+
+    for name in names - tags.keys():
+        try:
+            with db.session.begin_nested():
+                tag = Tag(name=name)
+                db.session.add(tag)
+                db.session.flush()
+
+        except IntegrityError:
+            # Another request created it first.
+            tag = Tag.query.filter_by(name=name).one()
+
+        tags[name] = tag
+
+    return list(tags.values())
+
+
+def bump_counts(tags, now=None):
+    """Count one use of each tag in the current bucket."""
+
+    bucket = current_bucket(now)
+
+    for tag in tags:
+        counter = TagCount.query.filter_by(tag_id=tag.id, bucket=bucket)
+
+        if counter.update({TagCount.count: TagCount.count + 1},
+                          synchronize_session=False):
+            continue
+
+        try:
+            with db.session.begin_nested():
+                db.session.add(TagCount(tag_id=tag.id, bucket=bucket, count=1))
+                db.session.flush()
+
+        except IntegrityError:
+            counter.update({TagCount.count: TagCount.count + 1},
+                           synchronize_session=False)
+            continue
+
+        # First use of this tag in a new bucket: drop its buckets that have
+        # slid out of the window.
+        (TagCount
+         .query
+         .filter(TagCount.tag_id == tag.id,
+                 TagCount.bucket <= bucket - BUCKET_SECONDS * TRENDING_BUCKETS)
+         .delete(synchronize_session=False))
+
+
+def index_message(message, now=None):
+    """Record the hashtags and mentions of a new, flushed `message`."""
+
+    names = extract_tags(message.text)
+    tags = get_or_create_tags(names) if names else []
+
+    for tag in tags:
+        db.session.add(MessageTag(tag_id=tag.id, message_id=message.id))
+
+    usernames = extract_mentions(message.text)
+
+    if usernames:
+        for user in User.query.filter(User.username.in_(usernames)):
+            db.session.add(Mention(user_id=user.id, message_id=message.id))
+
+    bump_counts(tags, now)
+
+
+class Trending:
+    """Per-process cache of the current trending tags.
+
+    The top tags are recomputed at most once every `ttl` seconds, so the
+    sidebar is served from memory on nearly every request.
+    """
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._tags = []
+        self._expires = 0
+
+    def get(self):
+        """Return a list of (tag name, uses) pairs, most used first."""
+
+        now = time.time()
+
+        if now >= self._expires:
+            with self._lock:
+                if now >= self._expires:
+                    self._tags = self.compute(now)
+                    self._expires = now + self.ttl
+
+        return self._tags
+
+    def invalidate(self):
+        """Force the next `get` to recompute."""
+
+        self._expires = 0
+
+    @staticmethod
+    def compute(now=None):
+        """Query the top tags over the sliding window ending at `now`."""
+
+        oldest = current_bucket(now) - BUCKET_SECONDS * (TRENDING_BUCKETS - 1)
+        uses = func.sum(TagCount.count).label('uses')
+
+        return (db.session
+                .query(Tag.name, uses)
+                .join(TagCount, TagCount.tag_id == Tag.id)
+                .filter(TagCount.bucket >= oldest)
+                .group_by(Tag.name)
+                .order_by(desc('uses'), Tag.name)
+                .limit(TRENDING_SIZE)
+                .all())
+
+
+trending = Trending()
+
+
+def linkify(text):
+    """Escape message text and turn its hashtags into links to tag pages."""
+
+    return Markup(HASHTAG_RE.sub(
+        lambda match: f'<a href="/tags/{match.group(1).lower()}">#{match.group(1)}</a>',
+        str(escape(text))))
@@ -0,0 +1,360 @@
+"""Image proxy: resized, locally cached copies of user images.
+
+`User.image_url` and `header_image_url` point at full-size images anywhere
+on the web. Templates run them through the `resized` filter, which links
+to /images/<variant>/<signature>?src=<url> instead. That route fetches the
+source once, stores the original and each resized variant on disk, and
+serves the variant with headers that let browsers cache it for a year.
+
+The disk cache is content-addressed: originals are stored under the
+SHA-256 of their bytes (so the same image at two URLs is stored once) and
+variants under that hash plus the variant name, with a small file per
+source URL pointing at its content hash. Every hit bumps the file's mtime,
+and when the cache grows past its size limit the least recently used files
+are deleted.
+
+URLs are signed with the app's SECRET_KEY so the route can only be used
+for images the app itself linked to, not as an open proxy. But users pick
+those URLs, so before each request (including each redirect, which is
+followed by hand) the host is resolved, and hosts on loopback, private,
+link-local or reserved addresses are refused: the proxy won't fetch from
+the network it runs in. A source that can't be fetched or decoded is
+remembered for FAILURE_TTL, so a dead URL doesn't cost every request for
+it the fetch timeout.
+"""
+
+import hashlib
+import hmac
+import io
+import ipaddress
+import os
+import socket
+import tempfile
+import threading
+import time
+from urllib.parse import quote, urljoin, urlparse
+
+from flask import current_app
+
+# name: (width, height, crop to fill)
+VARIANTS = {
+    'timeline': (96, 96, True),
+    'card': (400, 400, True),
+    'hero': (1200, 600, False),
+}
+
+MAX_SOURCE_BYTES = 10 * 1024 * 1024
+FETCH_CHUNK_BYTES = 64 * 1024
+FETCH_TIMEOUT = 5
+MAX_REDIRECTS = 3
+
+# Seconds before a source that failed is tried again.
+FAILURE_TTL = 15 * 60
+
+CACHE_HEADERS = 'public, max-age=31536000, immutable'
+
+
+class ImageUnavailable(Exception):
+    """The source image couldn't be fetched or decoded."""
+
+
+def sign(src, variant, secret):
+    """Return the signature for proxying `src` as `variant`."""
+
+    message = f"{variant}:{src}".encode('utf-8')
+    return hmac.new(secret.encode('utf-8'), message, hashlib.sha256).hexdigest()[:16]
+
+
+def resized(src, variant):
+    """Template filter: return the proxy URL for `src` at size `variant`."""
+
+    if not src:
+        return src
+
+    signature = sign(src, variant, current_app.config['SECRET_KEY'])
+    return f"/images/{variant}/{signature}?src={quote(src, safe='')}"
+
+
+def check_host(url):
+    """Raise ImageUnavailable unless every address `url`'s host resolves to is public."""
+
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(
+            url.hostname, url.port or (443 if url.scheme == 'https' else 80),
+            proto=socket.IPPROTO_TCP)}
+    except (socket.error, UnicodeError, ValueError) as exc:
+        raise ImageUnavailable(f"{url.hostname}: {exc}")
+
+    for address in addresses:
+        ip = ipaddress.ip_address(address.split('%')[0])
+
+        if ip.version == 6 and ip.ipv4_mapped:
+            ip = ip.ipv4_mapped
+
+        # Not global: loopback, private, link-local, reserved and the like
+        if not ip.is_global or ip.is_multicast:
+            raise ImageUnavailable(f"{url.hostname} is not a public address")
+
+
+def get_cache():
+    """Return the current app's image cache, creating it on first use."""
+
+    cache = current_app.extensions.get('image_cache')
+
+    if cache is None:
+        cache = current_app.extensions['image_cache'] = ImageCache(
+            current_app.config['IMAGE_CACHE_DIR'],
+            current_app.config['IMAGE_CACHE_MAX_BYTES'],
+            static_folder=current_app.static_folder,
+            allow_files=current_app.config['IMAGE_PROXY_ALLOW_FILES'])
+
+    return cache
+
+
+def resize(data, variant):
+    """Return (bytes, mimetype) of `data` resized to `variant`."""
+
+    from PIL import Image, ImageOps
+
+    width, height, crop = VARIANTS[variant]
+
+    try:
+        image = Image.open(io.BytesIO(data))
+        image.load()
+    except (IOError, SyntaxError, ValueError, Image.DecompressionBombError) as exc:
+        raise ImageUnavailable(str(exc))
+
+    if crop:
+        image = ImageOps.fit(image, (width, height), Image.LANCZOS)
+    else:
+        image.thumbnail((width, height), Image.LANCZOS)
+
+    out = io.BytesIO()
+
+    if image.mode in ('RGBA', 'LA', 'P'):
+        image.save(out, 'PNG', optimize=True)
+        return out.getvalue(), 'image/png'
+
+    image.convert('RGB').save(out, 'JPEG', quality=85, optimize=True, progressive=True)
+    return out.getvalue(), 'image/jpeg'
+
+
+class ImageCache:
+    """Disk cache of source images and their resized variants."""
+
+    def __init__(self, directory, max_bytes, static_folder=None, allow_files=False):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.static_folder = static_folder
+        self.allow_files = allow_files
+        self._lock = threading.Lock()
+        self._size = None
+
+        for subdirectory in ('sources', 'originals', 'variants', 'failures'):
+            os.makedirs(os.path.join(directory, subdirectory), exist_ok=True)
+
+    def variant(self, src, variant):
+        """Return (path, mimetype) of `src` resized to `variant`, making it if needed.
+
+        Raises ImageUnavailable, without trying again, for FAILURE_TTL after
+        `src` couldn't be fetched or decoded.
+        """
+
+        failure = self._path('failures', self._source_key(src))
+
+        try:
+            if time.time() - os.stat(failure).st_mtime < FAILURE_TTL:
+                raise ImageUnavailable(f"{src} failed recently")
+        except FileNotFoundError:
+            pass
+
+        try:
+            return self._variant(src, variant)
+        except ImageUnavailable:
+            self._write(failure, b'')
+            raise
+
+    def _variant(self, src, variant):
+        content_hash = self._content_hash(src)
+
+        for extension, mimetype in (('jpg', 'image/jpeg'), ('png', 'image/png')):
+            path = self._path('variants', f"{content_hash}-{variant}.{extension}")
+
+            if os.path.exists(path):
+                self._touch(path)
+                return path, mimetype
+
+        try:
+            original = self._read(self._path('originals', content_hash))
+        except FileNotFoundError:
+            # Evicted since it was looked up. The source may have changed
+            # since, so store it (and the variant) under what it is now.
+            original = self.fetch(src)
+            content_hash = self._store_source(src, original)
+
+        data, mimetype = resize(original, variant)
+        extension = 'png' if mimetype == 'image/png' else 'jpg'
+        path = self._path('variants', f"{content_hash}-{variant}.{extension}")
+        self._write(path, data)
+
+        return path, mimetype
+
+    def _content_hash(self, src):
+        """Return the content hash of `src`, fetching it on first use."""
+
+        pointer = self._path('sources', self._source_key(src))
+
+        if os.path.exists(pointer):
+            content_hash = self._read(pointer).decode('ascii')
+
+            if os.path.exists(self._path('originals', content_hash)):
+                self._touch(pointer)
+                return content_hash
+
+        return self._store_source(src, self.fetch(src))
+
+    def _store_source(self, src, data):
+        """Store `data` as the original of `src`; return its content hash."""
+
+        content_hash = hashlib.sha256(data).hexdigest()
+
+        self._write(self._path('originals', content_hash), data)
+        self._write(self._path('sources', self._source_key(src)), content_hash.encode('ascii'))
+
+        return content_hash
+
+    def fetch(self, src):
+        """Return the bytes of the image at `src`.
+
+        Paths under /static/ are read from the app's static folder, and
+        file:// URLs are allowed when `allow_files` is set (for tests).
+        Other sources must be http(s) on public addresses, as must each
+        redirect; at most MAX_REDIRECTS are followed.
+        """
+
+        url = urlparse(src)
+
+        if not url.scheme and url.path.startswith('/static/') and self.static_folder:
+            path = os.path.realpath(os.path.join(self.static_folder, url.path[len('/static/'):]))
+            if not path.startswith(os.path.realpath(self.static_folder) + os.sep):
+                raise ImageUnavailable(src)
+            return self._read_source_file(path)
+
+        if url.scheme == 'file' and self.allow_files:
+            return self._read_source_file(url.path)
+
+        import requests
+
+        for _ in range(MAX_REDIRECTS + 1):
+            if url.scheme not in ('http', 'https') or not url.hostname:
+                raise ImageUnavailable(src)
+
+            check_host(url)
+
+            try:
+                with requests.get(url.geturl(), stream=True, timeout=FETCH_TIMEOUT,
+                                  allow_redirects=False) as response:
+                    if response.is_redirect:
+                        url = urlparse(urljoin(url.geturl(), response.headers['Location']))
+                        continue
+
+                    response.raise_for_status()
+
+                    # iter_content wraps a broken connection or encoding
+                    # in requests' own exceptions
+                    chunks = []
+                    size = 0
+
+                    for chunk in response.iter_content(FETCH_CHUNK_BYTES):
+                        size += len(chunk)
+                        if size > MAX_SOURCE_BYTES:
+                            raise ImageUnavailable(f"{src} is too large")
+                        chunks.append(chunk)
+
+                    return b''.join(chunks)
+            except requests.RequestException as exc:
+                raise ImageUnavailable(str(exc))
+
+        raise ImageUnavailable(f"{src} redirects too many times")
+
+    def _read_source_file(self, path):
+        try:
+            with open(path, 'rb') as source:
+                return source.read(MAX_SOURCE_BYTES)
+        except OSError as exc:
+            raise ImageUnavailable(str(exc))
+
+    def _source_key(self, src):
+        return hashlib.sha256(src.encode('utf-8')).hexdigest()
+
+    def _path(self, kind, name):
+        return os.path.join(self.directory, kind, name)
+
+    def _read(self, path):
+        with open(path, 'rb') as cached:
+            return cached.read()
+
+    def _touch(self, path):
+        """Mark a file as recently used."""
+
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def _write(self, path, data):
+        """Atomically write a cache file, then evict if over the size limit."""
+
+        descriptor, temporary = tempfile.mkstemp(dir=os.path.dirname(path))
+
+        with os.fdopen(descriptor, 'wb') as out:
+            out.write(data)
+
+        os.replace(temporary, path)
+
+        with self._lock:
+            if self._size is None:
+                self._size = self._scan_size()
+            else:
+                self._size += len(data)
+
+            if self._size > self.max_bytes:
+                self._evict(keep=path)
+
+    def _files(self):
+        for subdirectory in ('sources', 'originals', 'variants', 'failures'):
+            with os.scandir(os.path.join(self.directory, subdirectory)) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        yield entry
+
+    def _scan_size(self):
+        return sum(entry.stat().st_size for entry in self._files())
+
+    def _evict(self, keep=None):
+        """Delete least recently used files until 90% of the size limit.
+
+        `keep` (the file just written) is never deleted, so it can still be
+        read even when it alone is bigger than the limit.
+        """
+
+        entries = sorted(((entry.stat().st_mtime, entry.stat().st_size, entry.path)
+                          for entry in self._files()))
+        size = sum(entry_size for _, entry_size, _ in entries)
+        target = self.max_bytes * 0.9
+
+        for _, entry_size, path in entries:
+            if size <= target:
+                break
+
+            if path == keep:
+                continue
+
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+
+            size -= entry_size
+
+        self._size = size
@@ -0,0 +1,130 @@
+"""Which routes use how much memory, from a sample of requests.
+
+Pages that load whole relationship collections (the user list,
+followers, following, likes) can push a worker's memory up, and once it's
+up it rarely comes back down. With MEMORY_PROFILE_RATE above 0, that
+fraction of requests is traced with tracemalloc, recording per route:
+
+- the peak memory allocated while handling the request, and
+- the lines that allocated the most, as of the moment the page's
+  template finished rendering (when everything it shows is still alive),
+  or the end of the request for responses without a template.
+
+See /admin/memory (with ADMIN_METRICS); with MEMORY_PROFILE_LOG set, each
+sample is also appended to that file as a JSON line.
+
+tracemalloc traces the whole process, so one request per worker is
+sampled at a time, and requests not sampled pay only for a random number.
+In a threaded worker, allocations by other threads during a sample are
+counted against the sampled route.
+"""
+
+import json
+import random
+import threading
+import time
+import tracemalloc
+
+from flask import request, template_rendered
+
+SNAPSHOT_KEY = 'warbler.memory_snapshot'
+
+# Frames kept per allocation; only the line that allocated is reported.
+TRACE_FRAMES = 1
+
+IGNORED = [tracemalloc.Filter(False, tracemalloc.__file__),
+           tracemalloc.Filter(False, __file__),
+           tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+           tracemalloc.Filter(False, '<unknown>')]
+
+
+def top_sites(snapshot, limit):
+    """Return the `limit` lines that hold the most memory in `snapshot`."""
+
+    statistics = snapshot.filter_traces(IGNORED).statistics('lineno')
+
+    return [dict(site=f'{stat.traceback[0].filename}:{stat.traceback[0].lineno}',
+                 kib=round(stat.size / 1024, 1), blocks=stat.count)
+            for stat in statistics[:limit]]
+
+
+class MemoryProfiler:
+    """Trace a sample of requests and keep per-route memory stats."""
+
+    def __init__(self, app):
+        self.rate = app.config['MEMORY_PROFILE_RATE']
+        self.top = app.config['MEMORY_PROFILE_TOP']
+        self.log_path = app.config['MEMORY_PROFILE_LOG']
+
+        self._sampling = threading.Lock()
+        self._lock = threading.Lock()
+        self._routes = {}
+
+        app.extensions['memory_profiler'] = self
+        app.before_request(self.before_request)
+        app.teardown_request(self.teardown_request)
+        template_rendered.connect(self.template_rendered, app)
+
+    def before_request(self):
+        if random.random() >= self.rate or not self._sampling.acquire(blocking=False):
+            return
+
+        # Someone else (a test, a debugger) is already tracing
+        if tracemalloc.is_tracing():
+            self._sampling.release()
+            return
+
+        tracemalloc.start(TRACE_FRAMES)
+        request.environ[SNAPSHOT_KEY] = None
+
+    def template_rendered(self, sender, template, context, **extra):
+        if SNAPSHOT_KEY in request.environ and request.environ[SNAPSHOT_KEY] is None:
+            request.environ[SNAPSHOT_KEY] = tracemalloc.take_snapshot()
+
+    def teardown_request(self, exc):
+        if SNAPSHOT_KEY not in request.environ:
+            return
+
+        try:
+            _, peak = tracemalloc.get_traced_memory()
+            snapshot = request.environ.pop(SNAPSHOT_KEY) or tracemalloc.take_snapshot()
+        finally:
+            tracemalloc.stop()
+            self._sampling.release()
+
+        route = request.url_rule.rule if request.url_rule else request.path
+        self.record(route, peak, top_sites(snapshot, self.top))
+
+    def record(self, route, peak, sites):
+        with self._lock:
+            stats = self._routes.setdefault(route, dict(samples=0, peak_kib_total=0.0,
+                                                        peak_kib_max=0.0, top=[]))
+            peak_kib = round(peak / 1024, 1)
+
+            stats['samples'] += 1
+            stats['peak_kib_total'] += peak_kib
+
+            # Keep the allocation sites of the worst request seen
+            if peak_kib >= stats['peak_kib_max']:
+                stats['peak_kib_max'] = peak_kib
+                stats['top'] = sites
+
+        if self.log_path:
+            with open(self.log_path, 'a') as log:
+                log.write(json.dumps(dict(time=time.time(), route=route, peak_kib=peak_kib,
+                                          top=sites)) + '\n')
+
+    def snapshot(self):
+        """Return a list of per-route dicts, highest peak first."""
+
+        with self._lock:
+            rows = [dict(route=route, samples=stats['samples'],
+                         peak_kib_mean=round(stats['peak_kib_total'] / stats['samples'], 1),
+                         peak_kib_max=stats['peak_kib_max'], top=list(stats['top']))
+                    for route, stats in self._routes.items()]
+
+        return sorted(rows, key=lambda row: row['peak_kib_max'], reverse=True)
+
+    def reset(self):
+        with self._lock:
+            self._routes.clear()
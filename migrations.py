@@ -0,0 +1,227 @@
+"""Schema migrations for Warbler.
+
+`db.create_all()` only creates tables that are missing; it never adds an
+index or changes a column on a table that already exists. Each migration
+below is a function that is applied once, in order, and recorded in the
+`schema_migrations` table.
+
+Bring an existing database up to date with:
+
+    python migrations.py
+
+A database built from scratch with `db.create_all()` already matches the
+models, so it should be stamped (see seed.py) rather than upgraded.
+"""
+
+from sqlalchemy import text
+
+from models import (db, Tag, MessageTag, Mention, TagCount, Recommendation,
+                    StaleRecommendation, FollowEvent, Notification,
+                    NotificationCount)
+from search import create_search_index
+from snowflake import id_for
+
+schema_migrations = db.Table(
+    'schema_migrations',
+    db.Column('version', db.Integer, primary_key=True),
+    db.Column('name', db.Text, nullable=False),
+    db.Column(
+        'applied_at',
+        db.DateTime,
+        nullable=False,
+        server_default=db.func.now(),
+    ),
+)
+
+
+##############################################################################
+# Migrations (append only -- never edit one that has shipped)
+
+
+def add_hot_path_indexes(conn):
+    """Index the columns every feed filters or sorts on."""
+
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_messages_user_id_timestamp "
+        "ON messages (user_id, timestamp DESC)"))
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_follows_user_following_id "
+        "ON follows (user_following_id, user_being_followed_id)"))
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_likes_user_id_message_id "
+        "ON likes (user_id, message_id)"))
+
+
+def use_time_ordered_message_ids(conn):
+    """Switch messages to 64-bit time-ordered ids (see snowflake.py).
+
+    Existing messages are renumbered from their timestamps so that ordering
+    by id matches ordering by time for old and new rows alike.
+    """
+
+    postgres = conn.dialect.name == 'postgresql'
+
+    if postgres:
+        conn.execute(text(
+            "ALTER TABLE likes DROP CONSTRAINT IF EXISTS likes_message_id_fkey"))
+        conn.execute(text(
+            "ALTER TABLE messages ALTER COLUMN id DROP DEFAULT"))
+        conn.execute(text("DROP SEQUENCE IF EXISTS messages_id_seq"))
+        conn.execute(text(
+            "ALTER TABLE messages ALTER COLUMN id TYPE BIGINT"))
+        conn.execute(text(
+            "ALTER TABLE likes ALTER COLUMN message_id TYPE BIGINT"))
+        conn.execute(text(
+            "ALTER TABLE messages ALTER COLUMN timestamp SET DEFAULT now()"))
+
+    renumbered = [
+        {'old_id': old_id, 'new_id': id_for(timestamp, tiebreak=old_id)}
+        for old_id, timestamp
+        in conn.execute(text("SELECT id, timestamp FROM messages")
+                        .columns(id=db.BigInteger, timestamp=db.DateTime))
+    ]
+
+    if renumbered:
+        conn.execute(
+            text("UPDATE likes SET message_id = :new_id WHERE message_id = :old_id"),
+            renumbered)
+        conn.execute(
+            text("UPDATE messages SET id = :new_id WHERE id = :old_id"),
+            renumbered)
+
+    if postgres:
+        conn.execute(text(
+            "ALTER TABLE likes ADD CONSTRAINT likes_message_id_fkey "
+            "FOREIGN KEY (message_id) REFERENCES messages (id) ON DELETE CASCADE"))
+
+    conn.execute(text("DROP INDEX IF EXISTS ix_messages_user_id_timestamp"))
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_messages_user_id_id "
+        "ON messages (user_id, id)"))
+
+
+def add_recommendation_tables(conn):
+    """Store precomputed "who to follow" suggestions (recommendations.py)."""
+
+    Recommendation.__table__.create(conn, checkfirst=True)
+    StaleRecommendation.__table__.create(conn, checkfirst=True)
+
+
+def add_tag_tables(conn):
+    """Store hashtags, mentions and trending counters (hashtags.py)."""
+
+    for model in (Tag, MessageTag, Mention, TagCount):
+        model.__table__.create(conn, checkfirst=True)
+
+
+def add_message_search_index(conn):
+    """Index message text for full-text search (search.py)."""
+
+    create_search_index(conn)
+
+
+def allow_many_likes_per_message(conn):
+    """Make likes unique per (user, message) instead of per message.
+
+    SQLite can't drop the old inline UNIQUE(message_id) without rebuilding
+    the table, so there only the new index is added.
+    """
+
+    if conn.dialect.name == 'postgresql':
+        conn.execute(text(
+            "ALTER TABLE likes DROP CONSTRAINT IF EXISTS likes_message_id_key"))
+
+    conn.execute(text("DROP INDEX IF EXISTS ix_likes_user_id_message_id"))
+    conn.execute(text(
+        "CREATE UNIQUE INDEX ix_likes_user_id_message_id "
+        "ON likes (user_id, message_id)"))
+
+
+def add_follow_events_table(conn):
+    """Log follows and unfollows for the in-memory follow graph (followgraph.py)."""
+
+    FollowEvent.__table__.create(conn, checkfirst=True)
+
+
+def add_notification_tables(conn):
+    """Store follow and like notifications and unread counts (notifications.py)."""
+
+    Notification.__table__.create(conn, checkfirst=True)
+    NotificationCount.__table__.create(conn, checkfirst=True)
+
+
+MIGRATIONS = [
+    add_hot_path_indexes,
+    use_time_ordered_message_ids,
+    add_recommendation_tables,
+    add_tag_tables,
+    add_message_search_index,
+    allow_many_likes_per_message,
+    add_follow_events_table,
+    add_notification_tables,
+]
+
+
+##############################################################################
+# Runner
+
+
+def applied_versions(conn):
+    """Return the set of migration versions already applied."""
+
+    schema_migrations.create(conn, checkfirst=True)
+    return {row.version for row in conn.execute(schema_migrations.select())}
+
+
+def upgrade(engine=None):
+    """Apply every pending migration in one transaction.
+
+    Returns the list of versions that were applied.
+    """
+
+    engine = engine or db.engine
+    applied = []
+
+    with engine.begin() as conn:
+        done = applied_versions(conn)
+
+        for version, migration in enumerate(MIGRATIONS, start=1):
+            if version in done:
+                continue
+
+            migration(conn)
+            conn.execute(schema_migrations.insert().values(
+                version=version, name=migration.__name__))
+            applied.append(version)
+
+    return applied
+
+
+def stamp(engine=None):
+    """Mark every migration as applied without running it.
+
+    Use this right after `db.create_all()`, which builds the current schema
+    directly.
+    """
+
+    engine = engine or db.engine
+
+    with engine.begin() as conn:
+        done = applied_versions(conn)
+
+        for version, migration in enumerate(MIGRATIONS, start=1):
+            if version not in done:
+                conn.execute(schema_migrations.insert().values(
+                    version=version, name=migration.__name__))
+
+
+if __name__ == '__main__':
+    from app import create_app
+    create_app()  # binds db to the configured database
+
+    versions = upgrade()
+
+    if versions:
+        print(f"Applied migrations: {', '.join(map(str, versions))}")
+    else:
+        print("Database is up to date.")
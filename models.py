@@ -2,12 +2,20 @@
 
 from datetime import datetime
 
+from flask import current_app, has_app_context
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import bindparam
+from sqlalchemy.ext import baked
+
+from snowflake import next_id, timestamp_of
 
 bcrypt = Bcrypt()
 db = SQLAlchemy()
 
+# Cache of compiled hot queries (see queries.py)
+bakery = baked.bakery()
+
 
 class Follows(db.Model):
     """Connection of a follower <-> followed_user."""
@@ -26,9 +34,28 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    # The primary key leads with user_being_followed_id, which serves
+    # follower lookups; this covers the "who does this user follow" side.
+    __table_args__ = (
+        db.Index(
+            'ix_follows_user_following_id',
+            user_following_id,
+            user_being_followed_id,
+        ),
+    )
+
     def __repr__(self):
         return f"<Follows user #{self.user_following_id} is following user #{self.user_being_followed_id}>"
 
+    @classmethod
+    def exists(cls, follower_id, followed_id):
+        """Does user `follower_id` follow user `followed_id`? (A primary key lookup.)"""
+
+        return db.session.query(
+            cls.query.filter_by(user_being_followed_id=followed_id,
+                                user_following_id=follower_id).exists()
+        ).scalar()
+
 
 class Likes(db.Model):
     """Mapping user likes to warbles."""
@@ -46,9 +73,13 @@ class Likes(db.Model):
     )
 
     message_id = db.Column(
-        db.Integer,
+        db.BigInteger,
         db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
+    )
+
+    # A user likes a message at most once; also serves queries.liked_ids.
+    __table_args__ = (
+        db.Index('ix_likes_user_id_message_id', user_id, message_id, unique=True),
     )
 
     def __repr__(self):
@@ -100,25 +131,39 @@ class User(db.Model):
         nullable=False,
     )
 
-    messages = db.relationship('Message')
+    # These collections can be huge, so they're never loaded whole: each is
+    # a query to filter, page or count, and rows are added or removed
+    # directly (see add_follow and messages_add). Deletes are left to the
+    # foreign keys' ON DELETE CASCADE rather than loading every row.
+    messages = db.relationship(
+        'Message',
+        lazy='dynamic',
+        passive_deletes=True,
+    )
 
     followers = db.relationship(
         "User",
         secondary="follows",
         primaryjoin=(Follows.user_being_followed_id == id),
-        secondaryjoin=(Follows.user_following_id == id)
+        secondaryjoin=(Follows.user_following_id == id),
+        lazy='dynamic',
+        passive_deletes=True,
     )
 
     following = db.relationship(
         "User",
         secondary="follows",
         primaryjoin=(Follows.user_following_id == id),
-        secondaryjoin=(Follows.user_being_followed_id == id)
+        secondaryjoin=(Follows.user_being_followed_id == id),
+        lazy='dynamic',
+        passive_deletes=True,
     )
 
     likes = db.relationship(
         'Message',
-        secondary="likes"
+        secondary="likes",
+        lazy='dynamic',
+        passive_deletes=True,
     )
 
     def __repr__(self):
@@ -127,14 +172,34 @@ class User(db.Model):
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        graph = follow_graph()
+
+        if graph is not None:
+            return graph.is_following(other_user.id, self.id)
+
+        return Follows.exists(follower_id=other_user.id, followed_id=self.id)
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        graph = follow_graph()
+
+        if graph is not None:
+            return graph.is_following(self.id, other_user.id)
+
+        return Follows.exists(follower_id=self.id, followed_id=other_user.id)
+
+    def following_count(self):
+        """How many users this user follows."""
+
+        graph = follow_graph()
+        return graph.following_count(self.id) if graph is not None else self.following.count()
+
+    def followers_count(self):
+        """How many users follow this user."""
+
+        graph = follow_graph()
+        return graph.followers_count(self.id) if graph is not None else self.followers.count()
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -166,7 +231,10 @@ class User(db.Model):
         If can't find matching user (or if password is wrong), returns False.
         """
 
-        user = cls.query.filter_by(username=username).first()
+        query = bakery(lambda session: session.query(User))
+        query += lambda q: q.filter(User.username == bindparam('username'))
+
+        user = query(db.session()).params(username=username).first()
 
         if user:
             is_auth = bcrypt.check_password_hash(user.password, password)
@@ -176,14 +244,24 @@ class User(db.Model):
         return False
 
 
+def message_timestamp(context):
+    """Default a new message's timestamp to the time encoded in its id."""
+
+    message_id = context.get_current_parameters().get('id')
+    return timestamp_of(message_id) if message_id else datetime.utcnow()
+
+
 class Message(db.Model):
     """An individual message ("warble")."""
 
     __tablename__ = 'messages'
 
+    # Time-ordered (see snowflake.py), so newest-first is just id DESC.
     id = db.Column(
-        db.Integer,
+        db.BigInteger,
         primary_key=True,
+        autoincrement=False,
+        default=next_id,
     )
 
     text = db.Column(
@@ -194,7 +272,8 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=message_timestamp,
+        server_default=db.func.now(),
     )
 
     user_id = db.Column(
@@ -203,12 +282,298 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # Profile pages and the home feed both filter on author and sort
+    # newest first.
+    __table_args__ = (
+        db.Index('ix_messages_user_id_id', user_id, id),
+    )
+
     user = db.relationship('User')
 
     def __repr__(self):
         return f"<Message #{self.id} made by user #{self.user_id}>"
 
 
+class Tag(db.Model):
+    """A hashtag used in at least one message."""
+
+    __tablename__ = 'tags'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    # stored lowercase, without the leading "#"
+    name = db.Column(
+        db.Text,
+        nullable=False,
+        unique=True,
+    )
+
+    def __repr__(self):
+        return f"<Tag #{self.id}: #{self.name}>"
+
+
+class MessageTag(db.Model):
+    """Connection of a message <-> hashtag it uses."""
+
+    __tablename__ = 'message_tags'
+
+    # Leading with tag_id makes the primary key the index for tag pages,
+    # newest message first.
+    tag_id = db.Column(
+        db.Integer,
+        db.ForeignKey('tags.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.BigInteger,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+        index=True,
+    )
+
+
+class Mention(db.Model):
+    """Connection of a message <-> user it mentions."""
+
+    __tablename__ = 'mentions'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.BigInteger,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+        index=True,
+    )
+
+
+class TagCount(db.Model):
+    """How many messages used a tag within one time bucket (see hashtags.py)."""
+
+    __tablename__ = 'tag_counts'
+
+    tag_id = db.Column(
+        db.Integer,
+        db.ForeignKey('tags.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    # start of the bucket, in seconds since the Unix epoch
+    bucket = db.Column(
+        db.Integer,
+        primary_key=True,
+        index=True,
+    )
+
+    count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+
+class Recommendation(db.Model):
+    """A precomputed "who to follow" suggestion (see recommendations.py)."""
+
+    __tablename__ = 'recommendations'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    # 0 is the best suggestion for this user
+    rank = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    recommended_user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    score = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+    recommended_user = db.relationship('User', foreign_keys=[recommended_user_id])
+
+    def __repr__(self):
+        return f"<Recommendation #{self.rank} for user #{self.user_id}: user #{self.recommended_user_id}>"
+
+    @classmethod
+    def for_user(cls, user_id, limit=5, session=db.session):
+        """Return the top `limit` suggested users for `user_id`."""
+
+        return (session
+                .query(User)
+                .join(cls, cls.recommended_user_id == User.id)
+                .filter(cls.user_id == user_id)
+                .order_by(cls.rank)
+                .limit(limit)
+                .all())
+
+
+class StaleRecommendation(db.Model):
+    """A user whose follows changed since recommendations were computed.
+
+    Rows are only ever appended here (duplicates are fine), so marking a
+    user stale never conflicts with a concurrent request.
+    """
+
+    __tablename__ = 'stale_recommendations'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    @classmethod
+    def mark(cls, user_id):
+        """Queue `user_id` for the next incremental recommendations run."""
+
+        db.session.add(cls(user_id=user_id))
+
+
+class FollowEvent(db.Model):
+    """A follow or unfollow, for keeping follow graphs current (followgraph.py).
+
+    Only recorded while the in-memory follow graph is enabled; rows older
+    than the newest graph snapshot are pruned when one is built.
+    """
+
+    __tablename__ = 'follow_events'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    follower_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    followed_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    # False for an unfollow
+    following = db.Column(
+        db.Boolean,
+        nullable=False,
+    )
+
+    def __repr__(self):
+        verb = "followed" if self.following else "unfollowed"
+        return f"<FollowEvent #{self.id}: user #{self.follower_id} {verb} user #{self.followed_id}>"
+
+
+class Notification(db.Model):
+    """Something that happened to a user: a follow, or a like of one of
+    their messages (see notifications.py).
+
+    Rows are only ever appended; ids are time-ordered (snowflake.py), so
+    a user's notifications page back by id.
+    """
+
+    __tablename__ = 'notifications'
+
+    id = db.Column(
+        db.BigInteger,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    recipient_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    actor_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    # 'follow' or 'like'
+    kind = db.Column(
+        db.String(10),
+        nullable=False,
+    )
+
+    # The liked message (messages may be sharded, so no foreign key)
+    message_id = db.Column(
+        db.BigInteger,
+    )
+
+    __table_args__ = (
+        db.Index('ix_notifications_recipient_id_id', recipient_id, id),
+    )
+
+    def __repr__(self):
+        return f"<Notification #{self.id}: user #{self.actor_id} {self.kind} for user #{self.recipient_id}>"
+
+
+class NotificationCount(db.Model):
+    """How many notifications a user hasn't seen yet, kept up to date as
+    they're added, so the unread badge is one lookup."""
+
+    __tablename__ = 'notification_counts'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    unread = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    # Id of the newest notification the user has seen
+    seen_id = db.Column(
+        db.BigInteger,
+        nullable=False,
+        default=0,
+    )
+
+
+def follow_graph():
+    """Return the current app's in-memory follow graph (see followgraph.py).
+
+    Returns None when it's disabled or no snapshot has been built yet.
+    """
+
+    if not has_app_context():
+        return None
+
+    graph = current_app.extensions.get('follow_graph')
+    return graph if graph is not None and graph.available() else None
+
+
 def connect_db(app):
     """Connect this database to provided Flask app.
 
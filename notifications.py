@@ -0,0 +1,174 @@
+"""Notifications of follows and likes.
+
+Each follow or like appends one Notification row for its recipient; the
+rows are grouped when they're read, so a page shows "@ada and 41 others
+liked your warble" rather than 42 lines. A page reads PAGE_SIZE rows and
+groups those, and the next page starts below the oldest row read
+("?before=<id>"), so a busy message can appear in more than one page.
+
+Each user's unread count (NotificationCount) is bumped as notifications
+are added and recomputed from the unseen rows when they view the newest
+page, so the badge in the navbar is a lookup by primary key.
+
+Notifications aren't withdrawn: unfollowing or unliking leaves them be.
+"""
+
+from sqlalchemy import select, func
+
+from bulk import insert_ignore
+from models import User, Notification, NotificationCount
+from queries import messages_by_id
+from snowflake import next_id, timestamp_of
+
+# Notifications read per page, before they're grouped.
+PAGE_SIZE = 200
+
+# Users named in a group before the rest are counted ("and 41 others").
+NAMED_ACTORS = 2
+
+notifications = Notification.__table__
+counts = NotificationCount.__table__
+
+
+class Notice:
+    """A group of notifications of one kind about one thing (a message, or
+    the recipient themself for follows), as the notifications page shows it."""
+
+    __slots__ = ('kind', 'message_id', 'message', 'actor_ids', 'actors', 'newest_id', 'unread')
+
+    def __init__(self, kind, message_id, newest_id, unread):
+        self.kind = kind
+        self.message_id = message_id
+        self.message = None
+        self.actor_ids = []
+        self.actors = []
+        self.newest_id = newest_id
+        self.unread = unread
+
+    @property
+    def count(self):
+        """How many different users did this."""
+
+        return len(self.actor_ids)
+
+    @property
+    def others(self):
+        """How many of them aren't named."""
+
+        return self.count - len(self.actors)
+
+    @property
+    def timestamp(self):
+        return timestamp_of(self.newest_id)
+
+
+##############################################################################
+# Writes
+#
+# These run in `session`'s transaction; commit the session to keep them.
+
+
+def notify(session, kind, actor_id, recipient_ids, message_id=None):
+    """Tell the users in `recipient_ids` that user `actor_id` did `kind`
+    ('follow' or 'like' of message `message_id`) to them."""
+
+    recipient_ids = sorted(set(recipient_ids) - {actor_id})
+
+    if not recipient_ids:
+        return
+
+    conn = session.connection()
+
+    conn.execute(notifications.insert(), [
+        dict(id=next_id(), recipient_id=recipient_id, actor_id=actor_id, kind=kind,
+             message_id=message_id)
+        for recipient_id in recipient_ids])
+
+    # Counters are created on first use, then only ever incremented in place
+    insert_ignore(conn, counts, [dict(user_id=recipient_id, unread=0, seen_id=0)
+                                 for recipient_id in recipient_ids])
+    conn.execute(counts.update()
+                 .where(counts.c.user_id.in_(recipient_ids))
+                 .values(unread=counts.c.unread + 1))
+
+
+def mark_seen(session, user_id, newest_id):
+    """Record that user `user_id` has seen their notifications up to
+    `newest_id`. Any that arrived since still count as unread."""
+
+    unseen = (select([func.count()])
+              .where(notifications.c.recipient_id == user_id)
+              .where(notifications.c.id > newest_id)
+              .as_scalar())
+
+    session.connection().execute(counts.update()
+                                 .where(counts.c.user_id == user_id)
+                                 .values(unread=unseen, seen_id=newest_id))
+
+
+##############################################################################
+# Reads
+
+
+def unread_count(session, user_id):
+    """Return how many of user `user_id`'s notifications are unread."""
+
+    return session.connection().execute(
+        select([counts.c.unread]).where(counts.c.user_id == user_id)).scalar() or 0
+
+
+def group(rows, seen_id):
+    """Group notification rows (newest first) into Notices, newest first."""
+
+    notices = {}
+
+    for row in rows:
+        key = (row.kind, row.message_id)
+        notice = notices.get(key)
+
+        if notice is None:
+            notice = notices[key] = Notice(row.kind, row.message_id, row.id, row.id > seen_id)
+
+        if row.actor_id not in notice.actor_ids:
+            notice.actor_ids.append(row.actor_id)
+
+    return list(notices.values())
+
+
+def notification_page(session, user_id, before=None):
+    """Return (notices, cursor of the next page or None) for user `user_id`.
+
+    Likes of messages that have since been deleted are left out.
+    """
+
+    conn = session.connection()
+    query = (select([notifications.c.id, notifications.c.actor_id, notifications.c.kind,
+                     notifications.c.message_id])
+             .where(notifications.c.recipient_id == user_id)
+             .order_by(notifications.c.id.desc())
+             .limit(PAGE_SIZE))
+
+    if before is not None:
+        query = query.where(notifications.c.id < before)
+
+    rows = conn.execute(query).fetchall()
+    seen_id = conn.execute(
+        select([counts.c.seen_id]).where(counts.c.user_id == user_id)).scalar() or 0
+
+    notices = group(rows, seen_id)
+
+    named = {actor_id for notice in notices for actor_id in notice.actor_ids[:NAMED_ACTORS]}
+    actors = {user.id: user for user in User.query.filter(User.id.in_(named))} if named else {}
+    messages = {message.id: message for message in messages_by_id(
+        session, {notice.message_id for notice in notices if notice.kind == 'like'})}
+
+    for notice in notices:
+        notice.actors = [actors[actor_id] for actor_id in notice.actor_ids[:NAMED_ACTORS]
+                         if actor_id in actors]
+        notice.message = messages.get(notice.message_id)
+
+    notices = [notice for notice in notices
+               if notice.actors and (notice.kind != 'like' or notice.message)]
+    cursor = rows[-1].id if len(rows) == PAGE_SIZE else None
+
+    return notices, cursor
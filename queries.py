@@ -0,0 +1,321 @@
+"""The hot page queries, prepared once.
+
+Building a Query and compiling it to SQL costs more Python time than
+running a simple indexed query, so none of these are rebuilt per request.
+
+Messages and likes are read and written with Core statements built once
+at import and compiled once (sharding.COMPILED_CACHE), on whichever shard
+holds them (see sharding.py; without shards that's the main database).
+Timeline rows become `FeedMessage` records rather than ORM objects: no
+identity map, no change tracking, and no user passwords or bios loaded
+only to be thrown away. Their authors are looked up in the main database
+in one query per page, and a page's messages by the same author share
+one `Author`.
+
+The models' own hot lookups (User.authenticate) are baked queries: built
+and compiled the first time they run, then only given new parameter
+values.
+
+Pagination uses "?before=<id of the last message shown>": message ids are
+time-ordered, so that pages back through a feed without an OFFSET.
+
+    python benchmarks/bench_queries.py
+    python benchmarks/bench_timeline.py
+
+compare these with building ORM queries every time.
+"""
+
+import heapq
+from itertools import islice
+
+from sqlalchemy import and_, bindparam, func, select
+
+from models import User, MessageTag
+from sharding import COMPILED_CACHE, messages, likes, shard_router
+from snowflake import next_id, timestamp_of
+
+# Messages per page of a feed.
+PAGE_SIZE = 100
+
+# Message ids per statement when deleting a user's messages' likes.
+DELETE_BATCH_SIZE = 1000
+
+users = User.__table__
+message_tags = MessageTag.__table__
+
+
+class Author:
+    """The author of timeline messages: what the templates show of a user."""
+
+    __slots__ = ('id', 'username', 'image_url')
+
+    def __init__(self, id, username, image_url):
+        self.id = id
+        self.username = username
+        self.image_url = image_url
+
+
+class FeedMessage:
+    """A message as timelines show it, with its `Author` as `user`."""
+
+    __slots__ = ('id', 'text', 'timestamp', 'user_id', 'user')
+
+    def __init__(self, id, text, timestamp, user_id, user):
+        self.id = id
+        self.text = text
+        self.timestamp = timestamp
+        self.user_id = user_id
+        self.user = user
+
+
+MESSAGE_COLUMNS = [messages.c.id, messages.c.text, messages.c.timestamp, messages.c.user_id]
+
+
+def timeline(criterion):
+    """Return the selects for a page of the messages matching `criterion`,
+    keyed by whether the page has a "?before=" cursor."""
+
+    def build(*cursor):
+        return (select(MESSAGE_COLUMNS)
+                .where(and_(criterion, *cursor))
+                .order_by(messages.c.id.desc())
+                .limit(PAGE_SIZE))
+
+    return {False: build(), True: build(messages.c.id < bindparam('before'))}
+
+
+HOME_FEED = timeline(messages.c.user_id.in_(bindparam('following', expanding=True)))
+USER_MESSAGES = timeline(messages.c.user_id == bindparam('user_id'))
+
+
+def tag_timeline(*cursor):
+    return (select(MESSAGE_COLUMNS)
+            .select_from(messages.join(message_tags,
+                                       message_tags.c.message_id == messages.c.id))
+            .where(and_(message_tags.c.tag_id == bindparam('tag_id'), *cursor))
+            .order_by(message_tags.c.message_id.desc())
+            .limit(PAGE_SIZE))
+
+
+# Ordered by message_tags' own copy of the id, so its primary key serves it.
+TAG_MESSAGES = {False: tag_timeline(),
+                True: tag_timeline(message_tags.c.message_id < bindparam('before'))}
+
+MESSAGES_BY_ID = select(MESSAGE_COLUMNS).where(
+    messages.c.id.in_(bindparam('message_ids', expanding=True)))
+
+LIKED_IDS = (select([likes.c.message_id])
+             .where(likes.c.user_id == bindparam('user_id'))
+             .order_by(likes.c.message_id.desc())
+             .limit(PAGE_SIZE))
+
+LIKED_AMONG = select([likes.c.message_id]).where(and_(
+    likes.c.user_id == bindparam('user_id'),
+    likes.c.message_id.in_(bindparam('message_ids', expanding=True))))
+
+MESSAGE_COUNT = select([func.count()]).where(messages.c.user_id == bindparam('user_id'))
+LIKE_COUNT = select([func.count()]).where(likes.c.user_id == bindparam('user_id'))
+
+AUTHORS = select([users.c.id, users.c.username, users.c.image_url]).where(
+    users.c.id.in_(bindparam('user_ids', expanding=True)))
+
+
+def main_connection(session):
+    return session.connection().execution_options(compiled_cache=COMPILED_CACHE)
+
+
+def with_authors(session, rows):
+    """Turn message rows into FeedMessages, looking up their authors."""
+
+    user_ids = {row.user_id for row in rows}
+
+    if not user_ids:
+        return []
+
+    authors = {row.id: Author(*row)
+               for row in main_connection(session).execute(AUTHORS, user_ids=list(user_ids))}
+
+    # A shard can briefly hold messages of a user who was just deleted
+    return [FeedMessage(id, text, timestamp, user_id, authors[user_id])
+            for id, text, timestamp, user_id in rows if user_id in authors]
+
+
+def newest_first(pages):
+    """Merge newest-first pages of message rows into one page."""
+
+    return list(islice(heapq.merge(*pages, key=lambda row: row.id, reverse=True), PAGE_SIZE))
+
+
+##############################################################################
+# Timelines
+
+
+def home_feed(session, following, before=None):
+    """Return a page of messages by the users in `following`.
+
+    Each shard holding some of them is asked for a page; the newest of
+    those make the page.
+    """
+
+    router = shard_router()
+    pages = [router
+             .connection(session, shard)
+             .execute(HOME_FEED[before is not None], following=user_ids, before=before)
+             .fetchall()
+             for shard, user_ids in router.group(following).items()]
+
+    return with_authors(session, newest_first(pages))
+
+
+def user_messages(session, user_id, before=None):
+    """Return a page of the messages user `user_id` posted."""
+
+    router = shard_router()
+    rows = (router
+            .connection(session, router.shard_for(user_id))
+            .execute(USER_MESSAGES[before is not None], user_id=user_id, before=before)
+            .fetchall())
+
+    return with_authors(session, rows)
+
+
+def tag_messages(session, tag_id, before=None):
+    """Return a page of the messages using tag `tag_id`.
+
+    Tags are only kept without shards, so this reads the main database.
+    """
+
+    rows = (main_connection(session)
+            .execute(TAG_MESSAGES[before is not None], tag_id=tag_id, before=before)
+            .fetchall())
+
+    return with_authors(session, rows)
+
+
+def messages_by_id(session, message_ids):
+    """Return the messages with `message_ids` that still exist, newest first."""
+
+    if not message_ids:
+        return []
+
+    pages = [sorted(conn.execute(MESSAGES_BY_ID, message_ids=list(message_ids)),
+                    key=lambda row: row.id, reverse=True)
+             for conn in shard_router().connections(session)]
+
+    return with_authors(session, newest_first(pages))
+
+
+def message_by_id(session, message_id):
+    """Return the message with id `message_id`, or None."""
+
+    found = messages_by_id(session, [message_id])
+    return found[0] if found else None
+
+
+def liked_messages(session, user_id):
+    """Return the latest messages user `user_id` has liked."""
+
+    router = shard_router()
+    liked = [message_id for (message_id,) in (router
+                                               .connection(session, router.shard_for(user_id))
+                                               .execute(LIKED_IDS, user_id=user_id))]
+
+    return messages_by_id(session, liked)
+
+
+def liked_ids(session, user_id, message_ids):
+    """Return the set of `message_ids` that user `user_id` has liked.
+
+    Pass the ids of the messages on screen: the lookup is bounded by
+    how many there are, not by how many likes the user has.
+    """
+
+    if not message_ids:
+        return set()
+
+    router = shard_router()
+    rows = (router
+            .connection(session, router.shard_for(user_id))
+            .execute(LIKED_AMONG, user_id=user_id, message_ids=list(message_ids)))
+
+    return {message_id for (message_id,) in rows}
+
+
+def message_count(session, user_id):
+    router = shard_router()
+    conn = router.connection(session, router.shard_for(user_id))
+    return conn.execute(MESSAGE_COUNT, user_id=user_id).scalar()
+
+
+def like_count(session, user_id):
+    router = shard_router()
+    conn = router.connection(session, router.shard_for(user_id))
+    return conn.execute(LIKE_COUNT, user_id=user_id).scalar()
+
+
+##############################################################################
+# Writes
+#
+# These run in `session`'s transaction; commit the session to keep them.
+
+
+def add_message(session, user_id, text):
+    """Post a message by user `user_id`; return it as a FeedMessage."""
+
+    router = shard_router()
+    message_id = next_id()
+    timestamp = timestamp_of(message_id)
+
+    (router
+     .connection(session, router.shard_for(user_id))
+     .execute(messages.insert(), id=message_id, text=text, timestamp=timestamp,
+              user_id=user_id))
+
+    return FeedMessage(message_id, text, timestamp, user_id, None)
+
+
+def delete_message(session, message_id):
+    """Delete message `message_id` and its likes, wherever they are."""
+
+    for conn in shard_router().connections(session):
+        conn.execute(likes.delete().where(likes.c.message_id == message_id))
+        conn.execute(messages.delete().where(messages.c.id == message_id))
+
+
+def toggle_like(session, user_id, message_id):
+    """Like message `message_id` for user `user_id`, or unlike it if they
+    already do. Returns whether they like it now."""
+
+    router = shard_router()
+    conn = router.connection(session, router.shard_for(user_id))
+    mine = and_(likes.c.user_id == user_id, likes.c.message_id == message_id)
+
+    if conn.execute(likes.delete().where(mine)).rowcount:
+        return False
+
+    conn.execute(likes.insert(), user_id=user_id, message_id=message_id)
+    return True
+
+
+def delete_user_rows(session, user_id):
+    """Delete user `user_id`'s messages and likes from their shard, and
+    other users' likes of those messages from every shard.
+
+    Without shards the database does this when the user is deleted.
+    """
+
+    router = shard_router()
+
+    if router.sharded:
+        conn = router.connection(session, router.shard_for(user_id))
+        message_ids = [message_id for (message_id,) in conn.execute(
+            select([messages.c.id]).where(messages.c.user_id == user_id))]
+
+        conn.execute(likes.delete().where(likes.c.user_id == user_id))
+        conn.execute(messages.delete().where(messages.c.user_id == user_id))
+
+        for start in range(0, len(message_ids), DELETE_BATCH_SIZE):
+            batch = message_ids[start:start + DELETE_BATCH_SIZE]
+
+            for shard in router.connections(session):
+                shard.execute(likes.delete().where(likes.c.message_id.in_(batch)))
@@ -0,0 +1,236 @@
+"""Which code runs which SQL.
+
+Lazy loads and per-row lookups in templates (an `is_following` per card,
+a relationship per message) don't show up until there are enough rows to
+hurt. This records every statement sent to any database, with where it
+came from: the template line if a template caused it, otherwise the line
+of our own code. Session setup (SET LOCAL statement_timeout) isn't
+counted, so budgets are the same on every database.
+
+With QUERY_TRACE on, every request is recorded. Statements of the same
+shape run REPEAT_THRESHOLD or more times in one request are logged as a
+likely N+1, with their origins, and /admin/queries (with ADMIN_METRICS)
+shows each route's latest query count and repeats.
+
+Tests can hold a route to a budget, whatever the config:
+
+    with query_budget(5):
+        client.get('/users/1/followers')
+
+raises QueryBudgetExceeded, listing the statements, if it runs more than
+5 queries or repeats one statement REPEAT_THRESHOLD times.
+"""
+
+import os
+import re
+import sys
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+from flask import request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Runs of one statement shape in one recording that count as an N+1.
+REPEAT_THRESHOLD = 3
+
+# Where our own code lives (anything outside it, or in a virtualenv inside
+# it, is a library).
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Session setup (SET LOCAL statement_timeout and the like) isn't a query.
+SESSION_SETUP = re.compile(r'\s*(?:SET|RESET)\s', re.IGNORECASE)
+
+PLACEHOLDER_LISTS = re.compile(r'\((?:\s*(?:\?|%\([^)]*\)s|:\w+)\s*,?)+\)')
+WHITESPACE = re.compile(r'\s+')
+
+
+class TracedQuery:
+    """A statement as it was sent, and where it came from."""
+
+    __slots__ = ('statement', 'shape', 'origin')
+
+    def __init__(self, statement, origin):
+        self.statement = statement
+        self.shape = shape_of(statement)
+        self.origin = origin
+
+
+class QueryLog:
+    """The statements run while recording."""
+
+    def __init__(self):
+        self.queries = []
+
+    def __len__(self):
+        return len(self.queries)
+
+    def repeated(self, threshold=REPEAT_THRESHOLD):
+        """Return {shape: [origins]} of the statements run `threshold` or more times."""
+
+        counts = Counter(query.shape for query in self.queries)
+
+        return {shape: [query.origin for query in self.queries if query.shape == shape]
+                for shape, count in counts.items() if count >= threshold}
+
+    def report(self):
+        """Return the statements, one per line, with their origins."""
+
+        return '\n'.join(f'  {query.origin}: {query.shape}' for query in self.queries)
+
+
+class QueryBudgetExceeded(AssertionError):
+    """Code ran more queries than its budget allows."""
+
+
+def shape_of(statement):
+    """Return `statement` with whitespace and expanded IN lists collapsed,
+    so the same query with different numbers of ids has one shape."""
+
+    return PLACEHOLDER_LISTS.sub('(...)', WHITESPACE.sub(' ', statement).strip())
+
+
+def origin_of(frame):
+    """Return "file:line" of the template or our own code that ran a statement."""
+
+    ours = None
+
+    while frame is not None:
+        template = frame.f_globals.get('__jinja_template__')
+
+        if template is not None:
+            return f'{template.name}:{template.get_corresponding_lineno(frame.f_lineno)}'
+
+        filename = frame.f_code.co_filename
+
+        if (ours is None and filename.startswith(ROOT) and filename != __file__
+                and 'site-packages' not in filename):
+            ours = f'{os.path.relpath(filename, ROOT)}:{frame.f_lineno}'
+
+        frame = frame.f_back
+
+    return ours or '?'
+
+
+##############################################################################
+# Recording
+
+
+_recordings = threading.local()
+_listening = threading.Lock()
+
+
+def active_logs():
+    return getattr(_recordings, 'logs', [])
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    logs = active_logs()
+
+    if logs and not SESSION_SETUP.match(statement):
+        query = TracedQuery(statement, origin_of(sys._getframe(1)))
+
+        for log in logs:
+            log.queries.append(query)
+
+
+def listen():
+    """Start watching every engine's statements (once per process)."""
+
+    with _listening:
+        if not event.contains(Engine, 'before_cursor_execute', before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def start_recording():
+    """Record this thread's statements into a new QueryLog until it's stopped."""
+
+    listen()
+
+    log = QueryLog()
+    _recordings.logs = active_logs() + [log]
+    return log
+
+
+def stop_recording(log):
+    _recordings.logs = [active for active in active_logs() if active is not log]
+
+
+@contextmanager
+def recording():
+    """Record the statements this thread runs in the block."""
+
+    log = start_recording()
+
+    try:
+        yield log
+    finally:
+        stop_recording(log)
+
+
+@contextmanager
+def query_budget(max_queries, repeat_threshold=REPEAT_THRESHOLD):
+    """Fail if the block runs more than `max_queries` statements, or any
+    statement `repeat_threshold` or more times."""
+
+    with recording() as log:
+        yield log
+
+    if len(log) > max_queries:
+        raise QueryBudgetExceeded(
+            f"{len(log)} queries, over the budget of {max_queries}:\n{log.report()}")
+
+    repeated = log.repeated(repeat_threshold)
+
+    if repeated:
+        shape, origins = next(iter(repeated.items()))
+        raise QueryBudgetExceeded(
+            f"Likely N+1: ran {len(origins)} times from {', '.join(sorted(set(origins)))}:\n"
+            f"  {shape}")
+
+
+##############################################################################
+# Per-request tracing
+
+
+class QueryTracer:
+    """Record each request's statements and log likely N+1s (QUERY_TRACE)."""
+
+    def __init__(self, app):
+        self.app = app
+        self.routes = {}
+        self.lock = threading.Lock()
+
+        app.extensions['query_tracer'] = self
+        app.before_request(self.before_request)
+        app.teardown_request(self.teardown_request)
+
+    def before_request(self):
+        request.environ['warbler.query_log'] = start_recording()
+
+    def teardown_request(self, exc):
+        log = request.environ.pop('warbler.query_log', None)
+
+        if log is None:
+            return
+
+        stop_recording(log)
+
+        route = request.url_rule.rule if request.url_rule else request.path
+        repeated = log.repeated()
+
+        for shape, origins in repeated.items():
+            self.app.logger.warning("Likely N+1 on %s: ran %d times from %s: %s",
+                                    route, len(origins), ', '.join(sorted(set(origins))), shape)
+
+        with self.lock:
+            self.routes[route] = dict(queries=len(log),
+                                      repeated={shape: len(origins)
+                                                for shape, origins in repeated.items()})
+
+    def snapshot(self):
+        """Return {route: its latest request's query count and repeats}."""
+
+        with self.lock:
+            return dict(self.routes)
@@ -0,0 +1,171 @@
+"""Full-text search over message text.
+
+Two backends share one interface:
+
+- PostgreSQL: a GIN expression index on to_tsvector('english', text),
+  ranked with ts_rank.
+- SQLite: an FTS5 table with messages as its external content, kept in
+  sync by triggers and ranked with bm25.
+
+Either way the index is maintained by the database itself as messages are
+inserted and deleted; the app never writes to it directly.
+
+Results are ordered best match first, with newer messages winning ties,
+and paged with an opaque cursor holding the (score, id) of the last result
+shown, so each page is one indexed query with no OFFSET. Only the newest
+SEARCH_CANDIDATES matches are ranked: scoring every message containing a
+common word is what makes naive ranked search slow at millions of rows.
+"""
+
+import re
+
+from sqlalchemy import (DDL, Float, and_, cast, column, event, func, or_,
+                        select, table, text)
+
+from models import db, Message
+from queries import MESSAGES_BY_ID, main_connection, with_authors
+from snowflake import next_id
+
+SEARCH_CONFIG = 'english'
+
+# How many of the newest matches are ranked (see ranked_matches).
+SEARCH_CANDIDATES = 1000
+
+POSTGRES_DDL = [
+    "CREATE INDEX IF NOT EXISTS ix_messages_text_search ON messages "
+    f"USING gin (to_tsvector('{SEARCH_CONFIG}', text))",
+]
+
+SQLITE_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+    "text, content='messages', content_rowid='id')",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages "
+    "BEGIN INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text); END",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages "
+    "BEGIN INSERT INTO messages_fts (messages_fts, rowid, text) "
+    "VALUES ('delete', old.id, old.text); END",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF text ON messages "
+    "BEGIN INSERT INTO messages_fts (messages_fts, rowid, text) "
+    "VALUES ('delete', old.id, old.text); "
+    "INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text); END",
+]
+
+# Build the index along with the messages table (db.create_all), and drop
+# the FTS table with it so a rebuilt schema starts empty.
+for statement in POSTGRES_DDL:
+    event.listen(Message.__table__, 'after_create',
+                 DDL(statement).execute_if(dialect='postgresql'))
+
+for statement in SQLITE_DDL:
+    event.listen(Message.__table__, 'after_create',
+                 DDL(statement).execute_if(dialect='sqlite'))
+
+event.listen(Message.__table__, 'before_drop',
+             DDL("DROP TABLE IF EXISTS messages_fts").execute_if(dialect='sqlite'))
+
+
+def create_search_index(conn):
+    """Build the search index for an existing messages table."""
+
+    if conn.dialect.name == 'postgresql':
+        for statement in POSTGRES_DDL:
+            conn.execute(text(statement))
+
+    elif conn.dialect.name == 'sqlite':
+        for statement in SQLITE_DDL:
+            conn.execute(text(statement))
+
+        conn.execute(text(
+            "INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')"))
+
+
+def encode_cursor(score, message_id, newest_id):
+    """Return the cursor for results after the one with this score and id."""
+
+    return f"{score!r}:{message_id}:{newest_id}"
+
+
+def decode_cursor(cursor):
+    """Return (score, id, newest id) from a cursor, or None if malformed."""
+
+    try:
+        score, message_id, newest_id = cursor.split(':')
+        return float(score), int(message_id), int(newest_id)
+    except (AttributeError, ValueError):
+        return None
+
+
+def ranked_matches(query, newest_id=None):
+    """Return (select, score, id column) ranking messages that match `query`.
+
+    Only the SEARCH_CANDIDATES newest matches with ids up to `newest_id` are
+    scored, which keeps searches for common words from scoring every
+    message that contains them.
+    """
+
+    if db.engine.dialect.name == 'sqlite':
+        # Quote every word so user input can't be parsed as FTS5 syntax.
+        terms = ' '.join(f'"{word}"' for word in re.findall(r'\w+', query))
+        source = table('messages_fts', column('rowid'))
+        id_column = source.c.rowid
+        match = text('messages_fts MATCH :terms').bindparams(terms=terms)
+        score = -func.bm25(text('messages_fts'))
+    else:
+        source = Message.__table__
+        id_column = Message.id
+        document = func.to_tsvector(SEARCH_CONFIG, Message.text)
+        tsquery = func.plainto_tsquery(SEARCH_CONFIG, query)
+        match = document.op('@@')(tsquery)
+        score = cast(func.ts_rank(document, tsquery), Float)
+
+    window = [match]
+    if newest_id is not None:
+        window.append(id_column <= newest_id)
+
+    oldest_id = (select([id_column])
+                 .select_from(source)
+                 .where(and_(*window))
+                 .order_by(id_column.desc())
+                 .limit(1)
+                 .offset(SEARCH_CANDIDATES - 1)
+                 .correlate(None)
+                 .as_scalar())
+
+    matches = (select([id_column.label('id'), score.label('score')])
+               .select_from(source)
+               .where(and_(*window))
+               .where(id_column >= func.coalesce(oldest_id, 0)))
+
+    return matches, score, id_column
+
+
+def search_messages(query, cursor=None, limit=20):
+    """Return (messages, next cursor) for the best matches to `query`.
+
+    The next cursor is None when there are no more results. Messages posted
+    after the first page was fetched don't shift later pages.
+    """
+
+    if not re.search(r'\w', query or ''):
+        return [], None
+
+    after = decode_cursor(cursor) if cursor else None
+    newest_id = after[2] if after else next_id()
+
+    matches, score, id_column = ranked_matches(query, newest_id)
+
+    if after:
+        last_score, last_id, _ = after
+        matches = matches.where(or_(score < last_score,
+                                    and_(score == last_score, id_column < last_id)))
+
+    rows = db.session.execute(
+        matches.order_by(score.desc(), id_column.desc()).limit(limit + 1)).fetchall()
+
+    page, more = rows[:limit], len(rows) > limit
+    found = main_connection(db.session).execute(
+        MESSAGES_BY_ID, message_ids=[row.id for row in page]).fetchall() if page else []
+    by_id = {message.id: message for message in with_authors(db.session, found)}
+
+    next_cursor = encode_cursor(page[-1].score, page[-1].id, newest_id) if more else None
+    return [by_id[row.id] for row in page if row.id in by_id], next_cursor
@@ -1,18 +1,33 @@
 """Seed database with sample data from CSV Files."""
 
 from csv import DictReader
-from app import db
-from models import User, Message, Follows
+from datetime import datetime
+from app import create_app
+from models import db, User, Message, Follows
+from migrations import stamp
+from snowflake import id_for
 
 
+create_app()
+
 db.drop_all()
 db.create_all()
+stamp()
 
 with open('generator/users.csv') as users:
     db.session.bulk_insert_mappings(User, DictReader(users))
 
+# Message ids encode their creation time, so mint them from the CSV
+# timestamps (using the row number to break ties).
+def with_message_id(row, tiebreak):
+    timestamp = datetime.fromisoformat(row['timestamp'])
+    return dict(row, id=id_for(timestamp, tiebreak), timestamp=timestamp)
+
+
 with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+    db.session.bulk_insert_mappings(Message, (
+        with_message_id(row, i) for i, row in enumerate(DictReader(messages))
+    ))
 
 with open('generator/follows.csv') as follows:
     db.session.bulk_insert_mappings(Follows, DictReader(follows))
@@ -0,0 +1,238 @@
+"""Messages and likes spread over several databases, by user id.
+
+Users, follows and everything else live in the main database. With
+MESSAGE_SHARDS set to a list of database URLs, `messages` and `likes`
+live on those instead: a message on its author's shard, a like on the
+liker's shard, with user `u` on shard `u % len(MESSAGE_SHARDS)`.
+
+With no shards configured the main database is the only shard, so the
+same code (queries.py) serves both setups:
+
+- a profile (users_show) reads one shard;
+- the home feed asks each shard for its newest messages by the followed
+  users it holds, and merges the pages (newest first);
+- liked messages are found by id on every shard, since a like doesn't
+  say where its message lives.
+
+Shard connections join the request's session, so `db.session.commit()`
+commits them with everything else (one after another, not two-phase).
+
+Hashtags, mentions and search stay single-database features: they index
+the main `messages` table, so they're only maintained without shards.
+
+Set up or resize the shards with:
+
+    python sharding.py create
+    python sharding.py rebalance --from postgresql:///warbler --to URL URL ...
+
+`rebalance` moves each user whose placement differs between the old and
+new lists of databases. Moving from no shards to some is a rebalance from
+the main database. A user's rows are copied before they're deleted, so a
+rerun after a failure picks up where it stopped; while a user is being
+moved their rows may be briefly missing or doubled.
+"""
+
+import argparse
+
+from sqlalchemy import (MetaData, Table, Column, Index, BigInteger, Integer,
+                        String, DateTime, create_engine, select)
+
+from models import db
+
+# Rows copied per round trip while rebalancing.
+MOVE_BATCH_SIZE = 5000
+
+# The sharded tables, as they are on every shard (and in the main database,
+# where they also have foreign keys to `users`). Shards don't hold users,
+# so these have none.
+metadata = MetaData()
+
+messages = Table(
+    'messages', metadata,
+    Column('id', BigInteger, primary_key=True, autoincrement=False),
+    Column('text', String(140), nullable=False),
+    Column('timestamp', DateTime, nullable=False),
+    Column('user_id', Integer, nullable=False),
+    Index('ix_messages_user_id_id', 'user_id', 'id'),
+)
+
+likes = Table(
+    'likes', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('user_id', Integer),
+    Column('message_id', BigInteger),
+    Index('ix_likes_user_id_message_id', 'user_id', 'message_id', unique=True),
+)
+
+# Compiled SQL of statements on the sharded tables, per dialect.
+COMPILED_CACHE = {}
+
+
+class ShardRouter:
+    """Where each user's messages and likes live."""
+
+    def __init__(self, engines=()):
+        self.engines = list(engines)
+
+    @property
+    def sharded(self):
+        return bool(self.engines)
+
+    def __len__(self):
+        return len(self.engines) or 1
+
+    def shard_for(self, user_id):
+        return user_id % len(self)
+
+    def group(self, user_ids):
+        """Return {shard: [user ids on it]} for `user_ids`."""
+
+        shards = {}
+
+        for user_id in user_ids:
+            shards.setdefault(self.shard_for(user_id), []).append(user_id)
+
+        return shards
+
+    def connection(self, session, shard):
+        """Return a connection to `shard` in `session`'s transaction."""
+
+        if self.engines:
+            conn = session.connection(bind=self.engines[shard])
+        else:
+            conn = session.connection()
+
+        return conn.execution_options(compiled_cache=COMPILED_CACHE)
+
+    def engine(self, shard):
+        """Return the engine of `shard`, for work outside any session."""
+
+        return self.engines[shard] if self.engines else db.engine
+
+    def connections(self, session):
+        """Return a connection to every shard, in `session`'s transaction."""
+
+        return [self.connection(session, shard) for shard in range(len(self))]
+
+    def dispose(self):
+        for engine in self.engines:
+            engine.dispose()
+
+
+def init_shards(app):
+    """Set up `app`'s ShardRouter from MESSAGE_SHARDS."""
+
+    app.extensions['shards'] = ShardRouter(
+        create_engine(url) for url in app.config['MESSAGE_SHARDS'])
+
+
+def shard_router():
+    """Return the current app's ShardRouter."""
+
+    return db.get_app().extensions['shards']
+
+
+##############################################################################
+# Shard administration
+
+
+def create_shards(urls):
+    """Create the sharded tables on each database in `urls`."""
+
+    for url in urls:
+        engine = create_engine(url)
+        metadata.create_all(engine)
+        engine.dispose()
+
+
+def move_user(table, source, target, user_id):
+    """Move user `user_id`'s rows of `table` from `source` to `target`.
+
+    Each user's rows are all in one place, so any the target already has
+    are from an interrupted move; they're replaced. Returns the number
+    of rows moved.
+    """
+
+    # Likes get new ids on their new shard
+    columns = [column for column in table.c if column.name != 'id' or table is messages]
+    mine = table.c.user_id == user_id
+    moved = 0
+
+    with target.begin() as conn:
+        conn.execute(table.delete().where(mine))
+
+        with source.connect() as reader:
+            rows = reader.execution_options(stream_results=True).execute(select(columns).where(mine))
+
+            while True:
+                batch = rows.fetchmany(MOVE_BATCH_SIZE)
+                if not batch:
+                    break
+
+                conn.execute(table.insert(), [dict(row) for row in batch])
+                moved += len(batch)
+
+    with source.begin() as conn:
+        conn.execute(table.delete().where(mine))
+
+    return moved
+
+
+def rebalance(old_urls, new_urls):
+    """Move messages and likes from the `old_urls` layout to `new_urls`.
+
+    Returns {table name: rows moved}.
+    """
+
+    engines = {url: create_engine(url) for url in set(old_urls) | set(new_urls)}
+    router = ShardRouter(engines[url] for url in new_urls)
+    moved = {messages.name: 0, likes.name: 0}
+
+    try:
+        for url in old_urls:
+            source = engines[url]
+
+            # Likes first: in the main database, deleting a message deletes
+            # its likes too.
+            for table in (likes, messages):
+                with source.connect() as conn:
+                    user_ids = [user_id for (user_id,) in conn.execute(
+                        select([table.c.user_id]).distinct().order_by(table.c.user_id))]
+
+                for user_id in user_ids:
+                    target = new_urls[router.shard_for(user_id)]
+
+                    if target != url:
+                        moved[table.name] += move_user(table, source, engines[target], user_id)
+    finally:
+        for engine in engines.values():
+            engine.dispose()
+
+    return moved
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Manage the message shards.")
+    commands = parser.add_subparsers(dest='command')
+
+    create = commands.add_parser('create', help='create the tables on each shard')
+    create.add_argument('urls', nargs='*', help='shards (default: MESSAGE_SHARDS)')
+
+    move = commands.add_parser('rebalance', help='move rows to a new list of shards')
+    move.add_argument('--from', dest='old', nargs='+', required=True, metavar='URL')
+    move.add_argument('--to', dest='new', nargs='+', required=True, metavar='URL')
+
+    args = parser.parse_args()
+
+    if args.command == 'create':
+        from app import create_app
+        urls = args.urls or create_app().config['MESSAGE_SHARDS']
+        create_shards(urls)
+        print(f"Created the message tables on {len(urls)} shards")
+
+    elif args.command == 'rebalance':
+        for table, count in rebalance(args.old, args.new).items():
+            print(f"Moved {count:,} {table}")
+
+    else:
+        parser.print_help()
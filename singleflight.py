@@ -0,0 +1,129 @@
+"""Single-flight: concurrent identical loads share one execution.
+
+When a popular account posts, many requests for the same profile or
+message page arrive at once, and each would run the same queries. With
+
+    page = flights.do(('users_show', user_id), lambda: load_profile(user_id))
+
+the first request for a key runs the load; requests for the same key that
+arrive while it's running wait for it and get the same result (or the same
+exception) instead of running their own. Once the load finishes the key is
+forgotten, so this never serves anything older than the request itself.
+Keys are per process: each worker coalesces its own threads' requests.
+
+Loads shared this way must return values that are safe to hand to other
+threads, e.g. ORM objects loaded in a session of their own and detached
+(see `detached_session`), with everything the page needs already loaded.
+
+Per route (the first element of the key), `SingleFlight` counts how many
+loads ran and how many requests were coalesced into one that was already
+running; see the /admin/singleflight route in app.py.
+"""
+
+import threading
+from contextlib import contextmanager
+
+from sqlalchemy.orm import Session
+
+from deadlines import statement_timeout
+from models import db
+
+
+class Flight:
+    """A load in progress, and its outcome once it's done."""
+
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into one."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._stats = {}
+
+    def do(self, key, load):
+        """Return `load()`, sharing the call with concurrent callers of `key`."""
+
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+
+            if leader:
+                flight = self._flights[key] = Flight()
+
+        if not leader:
+            flight.done.wait()
+            self._record(key, coalesced=True)
+
+            if flight.error is not None:
+                raise flight.error
+
+            return flight.result
+
+        try:
+            flight.result = load()
+            return flight.result
+
+        except Exception as exc:
+            flight.error = exc
+            raise
+
+        finally:
+            with self._lock:
+                del self._flights[key]
+
+            flight.done.set()
+            self._record(key, coalesced=False)
+
+    def _record(self, key, coalesced):
+        route = key[0] if isinstance(key, tuple) else key
+
+        with self._lock:
+            totals = self._stats.setdefault(route, [0, 0])
+            totals[1 if coalesced else 0] += 1
+
+    def snapshot(self):
+        """Return a list of per-route dicts of loads run and requests coalesced."""
+
+        with self._lock:
+            stats = {route: list(totals) for route, totals in self._stats.items()}
+
+        return [{
+            'route': route,
+            'loads': loads,
+            'coalesced': coalesced,
+            'coalesced_ratio': round(coalesced / (loads + coalesced), 3),
+        } for route, (loads, coalesced) in sorted(stats.items())]
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+
+@contextmanager
+def detached_session(timeout_ms=None):
+    """Yield a private session whose objects are detached when it closes.
+
+    Loads shared between requests can't use the request's scoped session:
+    its objects belong to one thread. Load everything the page reads
+    (eagerly, for relationships) before the block ends.
+
+    With `timeout_ms`, each statement in the session gets that long.
+    """
+
+    session = Session(bind=db.engine, expire_on_commit=False)
+
+    try:
+        if timeout_ms is not None:
+            statement_timeout(session, timeout_ms)
+
+        yield session
+    finally:
+        session.close()
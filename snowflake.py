@@ -0,0 +1,189 @@
+"""Time-ordered 64-bit ids for messages.
+
+Ids are laid out Snowflake-style, most significant bits first:
+
+    41 bits  milliseconds since EPOCH (enough for ~69 years)
+    10 bits  worker id
+    12 bits  sequence number within the millisecond
+
+so sorting by id sorts by creation time, and feeds can order and paginate
+on the primary key alone.
+
+Two processes with the same worker id can issue the same id, so each
+process claims its own when it first generates an id (and again after a
+fork). On Postgres, `init_ids` has it take a session-level advisory lock
+on a free worker id over a connection it keeps open: the id is the
+process's until it exits. SNOWFLAKE_WORKER_ID pins one instead (for a
+single-process deployment). Elsewhere, only tests and the development
+server, which run one process, may draw one at random.
+"""
+
+import os
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import NullPool
+
+EPOCH = datetime(2010, 1, 1)
+EPOCH_MS = 1262304000000
+
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+TIMESTAMP_SHIFT = WORKER_BITS + SEQUENCE_BITS
+
+MAX_WORKER_ID = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+MAX_TIEBREAK = (1 << TIMESTAMP_SHIFT) - 1
+
+# First key of the advisory locks on worker ids ('snow').
+WORKER_LOCK_CLASS = 0x736e6f77
+
+
+class WorkerIdsExhausted(RuntimeError):
+    """Every worker id is claimed by another process."""
+
+
+def claim_worker_id(url):
+    """Lock a free worker id in the Postgres database at `url`.
+
+    Returns (worker id, the DBAPI connection holding its lock); the lock is
+    released when the connection closes. Raw DBAPI, so no engine events
+    (query budgets, statement timeouts) see it.
+    """
+
+    connection = create_engine(url, poolclass=NullPool).raw_connection()
+    start = random.SystemRandom().randint(0, MAX_WORKER_ID)
+
+    try:
+        cursor = connection.cursor()
+
+        for offset in range(MAX_WORKER_ID + 1):
+            worker_id = (start + offset) & MAX_WORKER_ID
+            cursor.execute('SELECT pg_try_advisory_lock(%s, %s)',
+                           (WORKER_LOCK_CLASS, worker_id))
+
+            if cursor.fetchone()[0]:
+                connection.commit()
+                return worker_id, connection
+
+    except Exception:
+        connection.close()
+        raise
+
+    connection.close()
+    raise WorkerIdsExhausted(f"All {MAX_WORKER_ID + 1} worker ids are in use")
+
+
+class IdGenerator:
+    """Thread-safe generator of time-ordered ids for one process.
+
+    Pass `worker_id` to pin the worker id, or `claim` (a function returning
+    (worker id, something to keep alive while it's held)) to claim one per
+    process, instead of drawing one at random.
+    """
+
+    def __init__(self, worker_id=None, claim=None):
+        self._lock = threading.Lock()
+        self._last_ms = -1
+        self._sequence = 0
+        self.configure(worker_id, claim)
+
+    def configure(self, worker_id=None, claim=None):
+        """Switch how the worker id is picked; it's picked again on next use."""
+
+        with self._lock:
+            self._fixed_worker_id = worker_id
+            self._claim = claim
+            self._claimed = self._inherited = None
+            self._worker_id = None
+            self._pid = None
+
+    def _current_worker_id(self):
+        """Pick a worker id once per process (forked children re-pick)."""
+
+        pid = os.getpid()
+
+        if pid != self._pid:
+            if self._fixed_worker_id is not None:
+                self._worker_id = self._fixed_worker_id & MAX_WORKER_ID
+            elif self._claim is not None:
+                # A forked child's copy of its parent's lock isn't its own.
+                # Keep the copy referenced: closing it would end the
+                # parent's session, and release the parent's lock.
+                self._inherited, self._claimed = self._claimed, None
+                self._worker_id, self._claimed = self._claim()
+            else:
+                self._worker_id = random.SystemRandom().randint(0, MAX_WORKER_ID)
+
+            self._pid = pid
+
+        return self._worker_id
+
+    def __call__(self):
+        """Return the next id."""
+
+        with self._lock:
+            worker_id = self._current_worker_id()
+            now_ms = int(time.time() * 1000) - EPOCH_MS
+
+            # Never go backwards, even if the wall clock does.
+            if now_ms <= self._last_ms:
+                self._sequence = (self._sequence + 1) & MAX_SEQUENCE
+
+                # Sequence exhausted: borrow the next millisecond.
+                if self._sequence == 0:
+                    self._last_ms += 1
+            else:
+                self._last_ms = now_ms
+                self._sequence = 0
+
+            return ((self._last_ms << TIMESTAMP_SHIFT)
+                    | (worker_id << SEQUENCE_BITS)
+                    | self._sequence)
+
+
+next_id = IdGenerator()
+
+
+def init_ids(app):
+    """Set how `next_id` picks its worker id for `app` (see the module docs).
+
+    Raises RuntimeError for a production app on a database other than
+    Postgres without SNOWFLAKE_WORKER_ID.
+    """
+
+    url = app.config['SQLALCHEMY_DATABASE_URI']
+
+    if app.config['SNOWFLAKE_WORKER_ID'] is not None:
+        next_id.configure(worker_id=int(app.config['SNOWFLAKE_WORKER_ID']))
+
+    elif make_url(url).get_backend_name() == 'postgresql':
+        next_id.configure(claim=lambda: claim_worker_id(url))
+
+    elif app.testing or app.debug:
+        next_id.configure()
+
+    else:
+        raise RuntimeError("Set SNOWFLAKE_WORKER_ID: worker ids are only claimed on Postgres")
+
+
+def id_for(timestamp, tiebreak=0):
+    """Return the id for a (naive UTC) datetime.
+
+    With the default `tiebreak` this is the smallest id that timestamp can
+    have, which makes it usable as a range bound. Pass a distinct `tiebreak`
+    per row to mint ids for existing data.
+    """
+
+    ms = (timestamp - EPOCH) // timedelta(milliseconds=1)
+    return (ms << TIMESTAMP_SHIFT) | (tiebreak & MAX_TIEBREAK)
+
+
+def timestamp_of(message_id):
+    """Return the (naive UTC) datetime encoded in an id."""
+
+    return EPOCH + timedelta(milliseconds=message_id >> TIMESTAMP_SHIFT)
@@ -0,0 +1,74 @@
+"""Compiled templates: cached on disk, loaded before the first request.
+
+Jinja compiles each template to Python the first time it's rendered,
+which made the first requests after every restart slow. The app's Jinja
+environment instead keeps compiled templates in TEMPLATE_CACHE_DIR
+(FileSystemBytecodeCache), shared by every worker and kept across
+restarts; a template whose source changed is recompiled.
+
+`warm_templates` loads every template up front. gunicorn.conf.py runs it
+in the master before forking, so each worker starts with every template
+already compiled, in memory it shares with the others. To fill the cache
+at deploy time:
+
+    python templating.py
+"""
+
+import os
+import tempfile
+
+from jinja2 import FileSystemBytecodeCache
+
+
+class AtomicBytecodeCache(FileSystemBytecodeCache):
+    """A FileSystemBytecodeCache that writes each file whole, so workers
+    never read one that another is still writing."""
+
+    def dump_bytecode(self, bucket):
+        descriptor, temporary = tempfile.mkstemp(dir=self.directory)
+
+        try:
+            with os.fdopen(descriptor, 'wb') as cached:
+                bucket.write_bytecode(cached)
+
+            os.replace(temporary, self._get_cache_filename(bucket))
+        except OSError:
+            if os.path.exists(temporary):
+                os.unlink(temporary)
+
+
+def init_templates(app):
+    """Give `app`'s Jinja environment a bytecode cache in TEMPLATE_CACHE_DIR.
+
+    Call before anything uses `app.jinja_env`, which is built on first use.
+    """
+
+    if app.config['TEMPLATE_CACHE_DIR'] is None:
+        app.config['TEMPLATE_CACHE_DIR'] = os.path.join(app.instance_path, 'template-cache')
+
+    os.makedirs(app.config['TEMPLATE_CACHE_DIR'], exist_ok=True)
+
+    app.jinja_options = dict(app.jinja_options,
+                             bytecode_cache=AtomicBytecodeCache(app.config['TEMPLATE_CACHE_DIR']))
+
+
+def warm_templates(app):
+    """Compile, or load from the cache, every template `app` can render.
+
+    Returns the number of templates loaded.
+    """
+
+    names = app.jinja_env.list_templates(extensions=['html'])
+
+    for name in names:
+        app.jinja_env.get_template(name)
+
+    return len(names)
+
+
+if __name__ == '__main__':
+    from app import create_app
+    app = create_app()
+
+    count = warm_templates(app)
+    print(f"Compiled {count} templates into {app.config['TEMPLATE_CACHE_DIR']}")
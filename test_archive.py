@@ -0,0 +1,149 @@
+"""Message archive tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_archive.py
+
+
+import os
+import tempfile
+import time
+from datetime import datetime
+from unittest import TestCase, mock
+
+from models import db, User, Message, Likes
+from archive import (archive_before, archived_months, archived_messages, has_archive,
+                     read_user_month)
+from queries import message_count
+from snowflake import id_for
+from app import create_app
+
+app = create_app('testing')
+
+db.create_all()
+
+
+class ArchiveTestCase(TestCase):
+    """Test moving old months of messages to files."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.context = app.app_context()
+        self.context.push()
+
+        app.config['ARCHIVE_DIR'] = self.directory = tempfile.mkdtemp()
+
+        author = User(username='author', email='author@test.com', password='password')
+        fan = User(username='fan', email='fan@test.com', password='password')
+        db.session.add_all([author, fan])
+        db.session.flush()
+        self.author, self.fan = author.id, fan.id
+
+        # Two warbles a day through January and February 2020, then one now
+        for day in range(1, 29):
+            for month in (1, 2):
+                for hour in (9, 17):
+                    db.session.add(Message(
+                        id=id_for(datetime(2020, month, day, hour)),
+                        text=f'{month}/{day} {hour}h', user_id=author.id))
+
+        db.session.add(Message(text='fresh warble', user_id=author.id))
+        db.session.flush()
+
+        db.session.add(Likes(user_id=fan.id, message_id=id_for(datetime(2020, 2, 3, 9))))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+        self.context.pop()
+
+    def test_archive(self):
+        """Are whole months before the cutoff archived, and read back?"""
+
+        moved = archive_before(datetime(2020, 2, 15), self.directory)
+
+        # February isn't over at the cutoff, so it stays
+        self.assertEqual(moved, {datetime(2020, 1, 1): 56})
+        self.assertEqual(archived_months(self.directory), [datetime(2020, 1, 1)])
+        self.assertEqual(message_count(db.session, self.author), 57)
+
+        moved = archive_before(datetime(2021, 1, 1), self.directory)
+        self.assertEqual(moved, {datetime(2020, 2, 1): 56})
+        self.assertEqual(Message.query.one().text, 'fresh warble')
+        self.assertEqual(Likes.query.count(), 0)
+
+        page = archived_messages(self.directory, self.author, limit=100)
+        self.assertEqual(len(page), 100)
+        self.assertEqual((page[0].text, page[0].timestamp), ('2/28 17h', datetime(2020, 2, 28, 17)))
+        self.assertEqual([message.id for message in page],
+                         sorted((message.id for message in page), reverse=True))
+
+        rest = archived_messages(self.directory, self.author, before=page[-1].id)
+        self.assertEqual([message.text for message in rest],
+                         ['1/6 17h', '1/6 9h', '1/5 17h', '1/5 9h', '1/4 17h',
+                          '1/4 9h', '1/3 17h', '1/3 9h', '1/2 17h', '1/2 9h', '1/1 17h', '1/1 9h'])
+        self.assertEqual(archived_messages(self.directory, self.fan), [])
+
+        # Likes are kept with the archived warble
+        records = read_user_month(self.directory, datetime(2020, 2, 1), self.author)
+        self.assertEqual([record['liked_by'] for record in records if record['text'] == '2/3 9h'],
+                         [[self.fan]])
+
+        # An index that doesn't match its archive is ignored
+        with open(os.path.join(self.directory, 'messages-2020-02.index.json'), 'w') as index:
+            index.write('{"size": 0, "users": {}}')
+
+        self.assertEqual(archived_messages(self.directory, self.author, limit=1)[0].text,
+                         '2/28 17h')
+
+    def test_rerun(self):
+        """Does archiving a month again merge with what's already there?"""
+
+        archive_before(datetime(2020, 3, 1), self.directory)
+
+        # A straggler that was still in the table
+        db.session.add(Message(id=id_for(datetime(2020, 1, 31, 23)), text='late',
+                               user_id=self.fan))
+        db.session.commit()
+
+        self.assertEqual(archive_before(datetime(2020, 3, 1), self.directory),
+                         {datetime(2020, 1, 1): 1})
+        self.assertEqual(len(archived_messages(self.directory, self.author, limit=1000)), 112)
+        self.assertEqual([message.text for message in archived_messages(self.directory, self.fan)],
+                         ['late'])
+
+    def test_has_archive(self):
+        """Is who has archived warbles read once per version of the archive?"""
+
+        archive_before(datetime(2021, 1, 1), self.directory)
+
+        # Old enough to be cached
+        then = time.time() - 10
+        os.utime(self.directory, (then, then))
+
+        self.assertTrue(has_archive(self.directory, self.author))
+
+        with mock.patch('archive.month_index') as month_index:
+            self.assertTrue(has_archive(self.directory, self.author))
+            self.assertFalse(has_archive(self.directory, self.fan))
+
+        month_index.assert_not_called()
+
+    def test_pages(self):
+        """Does the profile link to archived warbles, and show them?"""
+
+        archive_before(datetime(2021, 1, 1), self.directory)
+        client = app.test_client()
+
+        html = client.get(f'/users/{self.author}').get_data(as_text=True)
+        self.assertIn(f'/users/{self.author}/archive?before=', html)
+
+        # Only users with archived warbles get the link
+        html = client.get(f'/users/{self.fan}').get_data(as_text=True)
+        self.assertNotIn(f'/users/{self.fan}/archive', html)
+
+        html = client.get(f'/users/{self.author}/archive').get_data(as_text=True)
+        self.assertIn('2/28 17h', html)
+        self.assertIn('?before=', html)
@@ -0,0 +1,102 @@
+"""Static asset pipeline tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_assets.py
+
+
+import gzip
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from app import create_app
+from assets import build
+
+app = create_app('testing')
+
+
+class AssetTestCase(TestCase):
+    """Test building and serving fingerprinted assets."""
+
+    def setUp(self):
+        """Build the real static folder into a scratch copy."""
+
+        self.static = os.path.join(tempfile.mkdtemp(), 'static')
+        shutil.copytree(app.static_folder, self.static,
+                        ignore=shutil.ignore_patterns('dist'))
+
+        self.manifest = build(self.static)
+
+        self.original_static = app.static_folder
+        app.static_folder = self.static
+        app.extensions.pop('asset_manifest', None)
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.static_folder = self.original_static
+        app.extensions.pop('asset_manifest', None)
+        shutil.rmtree(os.path.dirname(self.static))
+
+    def test_build(self):
+        """Are assets fingerprinted, rewritten and precompressed?"""
+
+        css = self.manifest['stylesheets/style.css']
+        self.assertRegex(css, r'^dist/stylesheets/style\.[0-9a-f]{10}\.css$')
+
+        with open(os.path.join(self.static, css)) as built:
+            text = built.read()
+
+        self.assertIn(f"/static/{self.manifest['images/nav-bg.png']}", text)
+        self.assertNotIn('/static/images/nav-bg.png', text)
+
+        with gzip.open(os.path.join(self.static, css + '.gz'), 'rt') as compressed:
+            self.assertEqual(compressed.read(), text)
+
+        self.assertTrue(os.path.exists(os.path.join(self.static, css + '.br')))
+
+        # Images aren't worth compressing again
+        logo = os.path.join(self.static, self.manifest['images/warbler-logo.png'])
+        self.assertFalse(os.path.exists(logo + '.gz'))
+
+        # Rebuilding unchanged files gives the same names
+        self.assertEqual(build(self.static), self.manifest)
+
+        # Hidden files aren't assets
+        with open(os.path.join(self.static, 'stylesheets', '.DS_Store'), 'wb') as hidden:
+            hidden.write(b'\0' * 64)
+
+        self.assertNotIn('stylesheets/.DS_Store', build(self.static))
+
+    def test_serve(self):
+        """Are built assets linked to and served precompressed, cached forever?"""
+
+        resp = self.client.get('/login')
+        css = self.manifest['stylesheets/style.css']
+        self.assertIn(f'/static/{css}', str(resp.data))
+
+        resp = self.client.get(f'/static/{css}', headers={'Accept-Encoding': 'gzip, br'})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Content-Encoding'], 'br')
+        self.assertEqual(resp.mimetype, 'text/css')
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+
+        # Encodings the client refuses (q=0) or likes less aren't picked
+        resp = self.client.get(f'/static/{css}', headers={'Accept-Encoding': 'gzip, br;q=0'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+
+        resp = self.client.get(f'/static/{css}', headers={'Accept-Encoding': 'br;q=0.5, gzip'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+
+        resp = self.client.get(f'/static/{css}', headers={'Accept-Encoding': 'br;q=0, gzip;q=0'})
+        self.assertNotIn('Content-Encoding', resp.headers)
+
+        resp = self.client.get(f'/static/{css}')
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertIn(b'background-image', resp.data)
+
+        self.assertEqual(self.client.get('/static/dist/missing.css').status_code, 404)
+        self.assertEqual(self.client.get('/static/dist/../../app.py').status_code, 404)
@@ -0,0 +1,147 @@
+"""Response compression tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_compression.py
+
+
+import gzip
+import zlib
+from unittest import TestCase
+
+import brotli
+from flask import Flask, Response
+
+from compression import Compressor, choose_encoding
+from models import db, User
+from app import create_app, CURR_USER_KEY
+
+app = create_app('testing')
+
+db.create_all()
+
+
+class CompressionTestCase(TestCase):
+    """Test compressing rendered pages."""
+
+    def setUp(self):
+        """Create test client and enough users for a big page."""
+
+        db.drop_all()
+        db.create_all()
+
+        for i in range(50):
+            db.session.add(User(username=f"user{i}", email=f"user{i}@test.com",
+                                password="password"))
+        db.session.commit()
+
+        app.extensions['compressor'].stats.reset()
+        self.client = app.test_client()
+
+    def test_choose_encoding(self):
+        """Is the client's preferred encoding picked?"""
+
+        self.assertEqual(choose_encoding('gzip, deflate, br'), 'br')
+        self.assertEqual(choose_encoding('gzip;q=1.0, br;q=0.5'), 'gzip')
+        self.assertEqual(choose_encoding('br;q=0, gzip'), 'gzip')
+        self.assertIsNone(choose_encoding('deflate'))
+        self.assertIsNone(choose_encoding(''))
+
+    def test_compressed_page(self):
+        """Are big pages compressed with the negotiated encoding?"""
+
+        plain = self.client.get('/users')
+        self.assertNotIn('Content-Encoding', plain.headers)
+
+        resp = self.client.get('/users', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+        self.assertEqual(int(resp.headers['Content-Length']), len(resp.data))
+        self.assertEqual(gzip.decompress(resp.data), plain.data)
+
+        resp = self.client.get('/users', headers={'Accept-Encoding': 'gzip, br'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'br')
+        self.assertEqual(brotli.decompress(resp.data), plain.data)
+
+        # Small pages aren't worth it
+        resp = self.client.get('/users/not-a-number', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', resp.headers)
+
+    def test_stats(self):
+        """Are compression ratios tracked per route?"""
+
+        self.client.get('/users', headers={'Accept-Encoding': 'gzip'})
+        self.client.get('/users', headers={'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(self.client.get('/admin/compression').status_code, 404)
+
+        app.config.update(ADMIN_METRICS=True, ADMIN_USERNAMES={'user0'})
+        try:
+            # Only for admins
+            self.assertEqual(self.client.get('/admin/compression').status_code, 404)
+
+            with self.client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = User.query.filter_by(username='user1').one().id
+            self.assertEqual(self.client.get('/admin/compression').status_code, 404)
+
+            with self.client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = User.query.filter_by(username='user0').one().id
+            routes = self.client.get('/admin/compression').get_json()['routes']
+        finally:
+            app.config.update(ADMIN_METRICS=False, ADMIN_USERNAMES=set())
+
+        users = [row for row in routes if row['route'] == '/users'][0]
+        self.assertEqual(users['encoding'], 'gzip')
+        self.assertEqual(users['responses'], 2)
+        self.assertLess(users['ratio'], 0.5)
+
+
+class StreamedCompressionTestCase(TestCase):
+    """Test compressing streamed and precompressed responses."""
+
+    def setUp(self):
+        streaming = Flask(__name__)
+        streaming.config['COMPRESS_MIN_SIZE'] = 1024
+        streaming.config['COMPRESS_LEVELS'] = {'br': 4, 'gzip': 6}
+
+        @streaming.route('/stream')
+        def stream():
+            return Response((f"<p>chunk {i}</p>" for i in range(100)),
+                            mimetype='text/html')
+
+        @streaming.route('/encoded')
+        def encoded():
+            return Response(gzip.compress(b'x' * 5000), mimetype='text/plain',
+                            headers={'Content-Encoding': 'gzip'})
+
+        self.compressor = Compressor(streaming)
+        self.client = streaming.test_client()
+
+    def test_streamed(self):
+        """Are streamed responses compressed chunk by chunk?"""
+
+        resp = self.client.get('/stream', headers={'Accept-Encoding': 'gzip'},
+                               buffered=False)
+
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertNotIn('Content-Length', resp.headers)
+
+        chunks = list(resp.response)
+        self.assertGreater(len(chunks), 1)
+
+        # Each chunk can be decoded as it arrives
+        decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.assertEqual(decoder.decompress(chunks[0]), b"<p>chunk 0</p>")
+        self.assertEqual(b"".join(decoder.decompress(chunk) for chunk in chunks[1:]),
+                         b"".join(f"<p>chunk {i}</p>".encode() for i in range(1, 100)))
+
+        stats = self.compressor.stats.snapshot()
+        self.assertEqual(stats[0]['route'], '/stream')
+
+    def test_already_encoded(self):
+        """Are already-compressed responses left alone?"""
+
+        resp = self.client.get('/encoded', headers={'Accept-Encoding': 'gzip, br'})
+
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(resp.data), b'x' * 5000)
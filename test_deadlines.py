@@ -0,0 +1,260 @@
+"""Query deadline and last good result tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_deadlines.py
+
+
+import time
+from unittest import TestCase, mock
+
+from sqlalchemy import create_engine
+from sqlalchemy.exc import DBAPIError, OperationalError
+
+from models import db, User, Message
+from deadlines import DeadlineExceeded, LastGoodCache, is_deadline_error
+from sharding import ShardRouter
+from singleflight import detached_session
+from app import create_app, CURR_USER_KEY
+
+app = create_app('testing')
+
+db.create_all()
+
+
+class QueryCanceled(Exception):
+    pgcode = '57014'
+
+
+def cancelled(*args):
+    raise OperationalError('SELECT ...', {}, QueryCanceled('canceling statement'))
+
+
+class LastGoodCacheTestCase(TestCase):
+    """Test falling back to the last good load."""
+
+    def test_is_deadline_error(self):
+        """Is only a cancelled statement a missed deadline?"""
+
+        error = OperationalError('SELECT ...', {}, QueryCanceled())
+        self.assertTrue(is_deadline_error(error))
+        self.assertFalse(is_deadline_error(OperationalError('SELECT ...', {}, Exception())))
+        self.assertFalse(is_deadline_error(QueryCanceled()))
+
+    def test_fetch(self):
+        """Is the last good result served stale, then refreshed?"""
+
+        cache = LastGoodCache(app)
+        deadlines = []
+
+        def slow(deadline_ms):
+            """Too slow for the route's deadline, fine for a refresh."""
+
+            deadlines.append(deadline_ms)
+
+            if deadline_ms < cache.refresh_deadline_ms:
+                cancelled()
+
+            return 'fresh'
+
+        # Nothing to fall back on yet
+        with self.assertRaises(DeadlineExceeded):
+            cache.fetch('page', cancelled, 100)
+
+        self.assertEqual(cache.fetch('page', lambda deadline_ms: 'first', 100),
+                         ('first', False))
+
+        self.assertEqual(cache.fetch('page', slow, 100), ('first', True))
+
+        # The refresh gets the longer deadline
+        for _ in range(100):
+            if cache.fetch('page', cancelled, 100) == ('fresh', True):
+                break
+            time.sleep(0.05)
+
+        self.assertEqual(deadlines, [100, cache.refresh_deadline_ms])
+        self.assertEqual(cache.fetch('page', cancelled, 100), ('fresh', True))
+
+        # Other errors aren't missed deadlines
+        with self.assertRaises(ZeroDivisionError):
+            cache.fetch('page', lambda deadline_ms: 1 / 0, 100)
+
+    def test_size(self):
+        """Are the least recently used results dropped first?"""
+
+        cache = LastGoodCache(app, max_entries=2)
+
+        for key in 'abc':
+            cache.fetch(key, lambda deadline_ms: key, 100)
+
+        with self.assertRaises(DeadlineExceeded):
+            cache.fetch('a', cancelled, 100)
+
+        self.assertEqual(cache.fetch('c', cancelled, 100), ('c', True))
+
+        # Serving a result stale counts as using it
+        cache.fetch('b', cancelled, 100)
+        cache.fetch('d', lambda deadline_ms: 'd', 100)
+        self.assertEqual(cache.fetch('b', cancelled, 100), ('b', True))
+
+        with self.assertRaises(DeadlineExceeded):
+            cache.fetch('c', cancelled, 100)
+
+        # Results not worth keeping aren't
+        self.assertEqual(cache.fetch('e', lambda deadline_ms: 'e', 100, keep=False),
+                         ('e', False))
+
+        with self.assertRaises(DeadlineExceeded):
+            cache.fetch('e', cancelled, 100)
+
+
+class StalePageTestCase(TestCase):
+    """Test pages served after a missed deadline."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        user = User(username='poster', email='poster@test.com', password='password')
+        db.session.add(user)
+        db.session.flush()
+
+        db.session.add(Message(text='hello everyone', user_id=user.id))
+        db.session.commit()
+
+        self.user_id = user.id
+
+        app.extensions['last_good'].clear()
+        self.client = app.test_client()
+
+    def test_users_show(self):
+        """Is a profile served stale when its load misses the deadline?"""
+
+        resp = self.client.get(f'/users/{self.user_id}')
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotIn('Warning', resp.headers)
+        self.assertEqual(self.client.get(f'/users/{self.user_id}?before=1').status_code, 200)
+
+        with mock.patch('app.load_profile', side_effect=cancelled):
+            resp = self.client.get(f'/users/{self.user_id}')
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.headers['Warning'], '110 - "Response is Stale"')
+            self.assertIn('hello everyone', resp.get_data(as_text=True))
+            self.assertIn('may be a little out of date', resp.get_data(as_text=True))
+
+            # Nothing kept for pages past the first
+            resp = self.client.get(f'/users/{self.user_id}?before=1')
+            self.assertEqual(resp.status_code, 503)
+
+    def test_stale_viewer_queries(self):
+        """Are a stale page's per-viewer lookups skipped rather than 503ing?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            self.assertEqual(c.get(f'/users/{self.user_id}').status_code, 200)
+
+            with mock.patch('app.load_profile', side_effect=cancelled), \
+                    mock.patch('app.liked_ids', side_effect=cancelled), \
+                    mock.patch('app.unread_count', side_effect=cancelled):
+                resp = c.get(f'/users/{self.user_id}')
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.headers['Warning'], '110 - "Response is Stale"')
+            self.assertIn('hello everyone', resp.get_data(as_text=True))
+
+
+class PostgresDeadlineTestCase(TestCase):
+    """Test deadlines enforced by Postgres itself (skipped on other databases)."""
+
+    def setUp(self):
+        if db.engine.dialect.name != 'postgresql':
+            self.skipTest("statement_timeout needs Postgres")
+
+        db.drop_all()
+        db.create_all()
+
+        user = User(username='poster', email='poster@test.com', password='password')
+        db.session.add(user)
+        db.session.flush()
+
+        db.session.add(Message(text='hello everyone', user_id=user.id))
+        db.session.commit()
+
+        self.user_id = user.id
+
+        app.extensions['last_good'].clear()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_statement_timeout(self):
+        """Is a statement past its deadline cancelled?"""
+
+        with self.assertRaises(DBAPIError) as raised:
+            with detached_session(100) as session:
+                session.execute('SELECT pg_sleep(2)')
+
+        self.assertTrue(is_deadline_error(raised.exception))
+
+    def test_shard_timeout(self):
+        """Does every shard connection the session opens get its timeout?"""
+
+        router = ShardRouter([create_engine(db.engine.url), create_engine(db.engine.url)])
+
+        try:
+            with detached_session(100) as session:
+                for shard in range(len(router)):
+                    self.assertEqual(router.connection(session, shard)
+                                     .execute('SHOW statement_timeout').scalar(), '100ms')
+
+                # Including in the session's next transaction
+                session.commit()
+                self.assertEqual(router.connection(session, 1)
+                                 .execute('SHOW statement_timeout').scalar(), '100ms')
+
+            with detached_session() as session:
+                self.assertEqual(router.connection(session, 0)
+                                 .execute('SHOW statement_timeout').scalar(), '0')
+        finally:
+            router.dispose()
+
+    def test_homepage(self):
+        """Is the homepage served stale when its load runs out of time?"""
+
+        def slow_feed(session, following, before=None):
+            session.execute('SELECT pg_sleep(2)')
+            return []
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            self.assertNotIn('Warning', c.get('/').headers)
+
+            with mock.patch('app.home_feed', side_effect=slow_feed):
+                resp = c.get('/')
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.headers['Warning'], '110 - "Response is Stale"')
+            self.assertIn('hello everyone', resp.get_data(as_text=True))
+
+    def test_request_queries(self):
+        """Do a page's queries outside its load get the deadline too?"""
+
+        def slow_likes(session, user_id, message_ids):
+            session.execute('SELECT pg_sleep(2)')
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            with mock.patch('app.liked_ids', side_effect=slow_likes):
+                resp = c.get(f'/users/{self.user_id}')
+
+            self.assertEqual(resp.status_code, 503)
+
+            # The next request's session has no deadline left over
+            self.assertEqual(c.get('/notifications').status_code, 200)
@@ -0,0 +1,135 @@
+"""Account export and bulk import tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_export.py
+
+
+import csv
+import io
+import json
+import tempfile
+from datetime import datetime
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes, StaleRecommendation
+from archive import archive_before
+from bulk import import_follows
+from export import export
+from snowflake import id_for
+from app import create_app, CURR_USER_KEY
+
+app = create_app('testing')
+
+db.create_all()
+
+
+class ExportTestCase(TestCase):
+    """Test streaming a user's data out and follow lists back in."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.context = app.app_context()
+        self.context.push()
+
+        app.config['ARCHIVE_DIR'] = self.directory = tempfile.mkdtemp()
+
+        users = [User(username=f'user{n}', email=f'user{n}@test.com', password='password')
+                 for n in range(4)]
+        db.session.add_all(users)
+        db.session.flush()
+        self.ids = [user.id for user in users]
+        me, other = self.ids[:2]
+
+        db.session.add(Message(id=id_for(datetime(2020, 1, 5)), text='old, "quoted"',
+                               user_id=me))
+        db.session.add(Message(text='fresh warble', user_id=me))
+        db.session.add(Message(text='not mine', user_id=other))
+        db.session.flush()
+
+        self.liked = Message.query.filter_by(text='not mine').one().id
+        db.session.add(Likes(user_id=me, message_id=self.liked))
+        db.session.add(Follows(user_being_followed_id=other, user_following_id=me))
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        self.context.pop()
+
+    def test_export(self):
+        """Are a user's rows exported, live and archived, in both formats?"""
+
+        me, other = self.ids[:2]
+        archive_before(datetime(2021, 1, 1), self.directory)
+
+        lines = list(''.join(export(me, 'messages', 'ndjson', self.directory)).splitlines())
+        self.assertEqual([json.loads(line)['text'] for line in lines],
+                         ['fresh warble', 'old, "quoted"'])
+        self.assertEqual(json.loads(lines[1])['timestamp'], '2020-01-05 00:00:00')
+
+        rows = list(csv.DictReader(io.StringIO(''.join(export(me, 'messages', 'csv',
+                                                              self.directory)))))
+        self.assertEqual([row['text'] for row in rows], ['fresh warble', 'old, "quoted"'])
+
+        self.assertEqual(''.join(export(me, 'follows', 'csv')),
+                         f'user_being_followed_id,user_following_id\r\n{other},{me}\r\n')
+        self.assertEqual(''.join(export(me, 'likes', 'ndjson')),
+                         json.dumps({'message_id': self.liked}) + '\n')
+
+    def test_export_view(self):
+        """Is the export downloaded, and only by a logged in user?"""
+
+        with self.client as c:
+            resp = c.get('/users/export/likes.csv')
+            self.assertEqual(resp.status_code, 302)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.ids[0]
+
+            resp = c.get('/users/export/likes.csv')
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.mimetype, 'text/csv')
+            self.assertIn('attachment', resp.headers['Content-Disposition'])
+            self.assertEqual(resp.get_data(as_text=True), f'message_id\r\n{self.liked}\r\n')
+
+            self.assertEqual(c.get('/users/export/passwords.csv').status_code, 404)
+            self.assertEqual(c.get('/users/export/likes.xml').status_code, 404)
+
+    def test_import_follows(self):
+        """Are new follows added in batches, and everything else skipped?"""
+
+        me, other, third, fourth = self.ids
+        rows = [
+            dict(user_being_followed_id=other, user_following_id=me),    # exists
+            dict(user_being_followed_id=third, user_following_id=me),
+            dict(user_being_followed_id=third, user_following_id=me),    # repeated
+            dict(user_being_followed_id=me, user_following_id=me),       # self
+            dict(user_being_followed_id=9999, user_following_id=me),     # no such user
+            dict(user_being_followed_id=me, user_following_id=fourth),
+            dict(user_being_followed_id=other, user_following_id=fourth),
+        ]
+
+        self.assertEqual(import_follows(rows, batch_size=3), (7, 3))
+
+        self.assertEqual(
+            {(f.user_being_followed_id, f.user_following_id) for f in Follows.query},
+            {(other, me), (third, me), (me, fourth), (other, fourth)})
+        self.assertEqual({stale.user_id for stale in StaleRecommendation.query},
+                         {me, other, third, fourth})
+
+        # Rerunning adds nothing
+        self.assertEqual(import_follows(rows), (7, 0))
+
+    def test_round_trip(self):
+        """Can a follows export be imported for another account?"""
+
+        me, other, third, fourth = self.ids
+        exported = ''.join(export(me, 'follows', 'csv')).replace(f',{me}\r', f',{fourth}\r')
+
+        self.assertEqual(import_follows(csv.DictReader(io.StringIO(exported))), (1, 1))
+        self.assertTrue(Follows.query.filter_by(user_being_followed_id=other,
+                                                user_following_id=fourth).count())
@@ -0,0 +1,176 @@
+"""Follow graph tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_followgraph.py
+
+
+import os
+import tempfile
+from unittest import TestCase
+
+import numpy as np
+
+from config import TestingConfig
+from followgraph import FollowGraph, Snapshot, build_snapshot
+from models import db, User, Follows, FollowEvent
+from app import create_app, CURR_USER_KEY
+
+SNAPSHOT = os.path.join(tempfile.mkdtemp(), 'follows.graph')
+
+
+class FollowGraphConfig(TestingConfig):
+    FOLLOW_GRAPH_PATH = SNAPSHOT
+    FOLLOW_GRAPH_SYNC_SECONDS = 0
+
+
+app = create_app(FollowGraphConfig)
+
+db.create_all()
+
+
+class SnapshotTestCase(TestCase):
+    """Test the compact adjacency arrays."""
+
+    def test_snapshot(self):
+        """Are edges found in both directions, before and after a save?"""
+
+        followers = np.array([1, 1, 2, 3, 1], dtype=np.int32)
+        followed = np.array([4, 2, 4, 4, 3], dtype=np.int32)
+
+        path = os.path.join(tempfile.mkdtemp(), 'test.graph')
+        Snapshot.from_edges(followers, followed, 6, last_event_id=7).save(path)
+        snapshot = Snapshot.load(path)
+
+        self.assertEqual(snapshot.edges, 5)
+        self.assertEqual(snapshot.last_event_id, 7)
+        self.assertEqual(snapshot.row('following', 1).tolist(), [2, 3, 4])
+        self.assertEqual(snapshot.row('followers', 4).tolist(), [1, 2, 3])
+        self.assertTrue(snapshot.has_edge(1, 3))
+        self.assertFalse(snapshot.has_edge(3, 1))
+        self.assertEqual(snapshot.degree('followers', 4), 3)
+        self.assertEqual(snapshot.degree('following', 5), 0)
+
+        # Ids past the end (users newer than the snapshot) have no edges
+        self.assertFalse(snapshot.has_edge(99, 1))
+        self.assertEqual(snapshot.degree('following', 99), 0)
+        self.assertEqual(snapshot.row('followers', 99).tolist(), [])
+
+
+class FollowGraphTestCase(TestCase):
+    """Test answering follow questions from the graph."""
+
+    def setUp(self):
+        """Users 1-4; 1 follows 2, and 2 follows 3."""
+
+        db.drop_all()
+        db.create_all()
+
+        for i in range(1, 5):
+            db.session.add(User(username=f'user{i}', email=f'user{i}@email.com',
+                                password='password'))
+        db.session.flush()
+
+        db.session.add_all([Follows(user_following_id=1, user_being_followed_id=2),
+                            Follows(user_following_id=2, user_being_followed_id=3)])
+        db.session.commit()
+
+        build_snapshot(SNAPSHOT)
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_follow_events(self):
+        """Do follows and unfollows reach this worker and the others?"""
+
+        other_worker = FollowGraph(SNAPSHOT, sync_seconds=0)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 1
+
+            graph = app.extensions['follow_graph']
+
+            c.post('/users/follow/3')
+            self.assertTrue(graph.is_following(1, 3))
+            self.assertEqual(graph.following(1), [2, 3])
+            self.assertEqual(graph.followers_count(3), 2)
+
+            c.post('/users/stop-following/2')
+            self.assertFalse(graph.is_following(1, 2))
+            self.assertEqual(graph.followers(2), [])
+
+            self.assertEqual(FollowEvent.query.count(), 2)
+
+            html = c.get('/users/1/following').get_data(as_text=True)
+            self.assertIn('@user3', html)
+            self.assertNotIn('@user2', html)
+
+        other_worker.sync()
+        self.assertTrue(other_worker.is_following(1, 3))
+        self.assertFalse(other_worker.is_following(1, 2))
+        self.assertEqual(other_worker.following_count(1), 1)
+
+    def test_rebuild(self):
+        """Does a new snapshot take over, and prune events it no longer needs?"""
+
+        graph = FollowGraph(SNAPSHOT, sync_seconds=0)
+        graph.sync()
+
+        db.session.add(Follows(user_following_id=4, user_being_followed_id=1))
+        db.session.add(FollowEvent(follower_id=4, followed_id=1, following=True))
+        db.session.commit()
+
+        build_snapshot(SNAPSHOT)
+        graph.sync()
+        self.assertTrue(graph.is_following(4, 1))
+        self.assertEqual(FollowEvent.query.count(), 1)
+
+        build_snapshot(SNAPSHOT)
+        self.assertEqual(FollowEvent.query.count(), 0)
+        self.assertEqual(graph.followers(1), [4])
+
+    def test_late_events(self):
+        """Is an event that commits after a later one has synced still applied?"""
+
+        graph = FollowGraph(SNAPSHOT, sync_seconds=0)
+        graph.sync()
+
+        # Event 2's transaction commits first; event 1's is still open
+        db.session.add(FollowEvent(id=2, follower_id=3, followed_id=1, following=True))
+        db.session.commit()
+        graph.sync()
+        self.assertEqual(graph.followers(1), [3])
+
+        db.session.add(FollowEvent(id=1, follower_id=4, followed_id=1, following=True))
+        db.session.commit()
+        graph.sync()
+        self.assertEqual(graph.followers(1), [3, 4])
+
+        # A new snapshot replays the events just before its cursor
+        db.session.add(FollowEvent(id=3, follower_id=4, followed_id=2, following=True))
+        db.session.commit()
+        build_snapshot(SNAPSHOT)
+        graph.sync()
+        self.assertEqual(graph.followers(2), [1, 4])
+
+    def test_delete_user(self):
+        """Does deleting a user drop their follows from every worker's graph?"""
+
+        other_worker = FollowGraph(SNAPSHOT, sync_seconds=0)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 2
+
+            graph = app.extensions['follow_graph']
+            c.post('/users/delete')
+
+            self.assertEqual(graph.following(1), [])
+            self.assertEqual(graph.followers(3), [])
+
+        other_worker.sync()
+        self.assertEqual(other_worker.following_count(1), 0)
+        self.assertEqual(other_worker.followers_count(3), 0)
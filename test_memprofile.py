@@ -0,0 +1,78 @@
+"""Per-route memory profiling tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_memprofile.py
+
+
+import json
+import os
+import tempfile
+import tracemalloc
+from unittest import TestCase
+
+from memprofile import MemoryProfiler
+from models import db, User
+from app import create_app, CURR_USER_KEY
+
+app = create_app('testing')
+app.config.update(MEMORY_PROFILE_RATE=1.0, ADMIN_METRICS=True, ADMIN_USERNAMES={'user0'},
+                  MEMORY_PROFILE_LOG=os.path.join(tempfile.mkdtemp(), 'memory.ndjson'))
+profiler = MemoryProfiler(app)
+
+db.create_all()
+
+
+class MemoryProfileTestCase(TestCase):
+    """Test sampling requests' memory use per route."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        for i in range(200):
+            db.session.add(User(username=f"user{i}", email=f"user{i}@test.com",
+                                password="password", bio="x" * 100))
+        db.session.commit()
+
+        profiler.reset()
+        self.client = app.test_client()
+
+    def test_profile(self):
+        """Are peaks and allocation sites recorded per route, and logged?"""
+
+        self.assertEqual(self.client.get('/users').status_code, 200)
+        self.assertEqual(self.client.get('/login').status_code, 200)
+        self.assertFalse(tracemalloc.is_tracing())
+
+        routes = {row['route']: row for row in profiler.snapshot()}
+        users = routes['/users']
+
+        self.assertEqual(users['samples'], 1)
+        self.assertGreater(users['peak_kib_max'], routes['/login']['peak_kib_max'])
+        self.assertTrue(users['top'])
+        self.assertTrue(all(set(site) == {'site', 'kib', 'blocks'} for site in users['top']))
+
+        with open(app.config['MEMORY_PROFILE_LOG']) as log:
+            self.assertIn('/users', [json.loads(line)['route'] for line in log])
+
+        self.assertEqual(self.client.get('/admin/memory').status_code, 404)
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = User.query.filter_by(username='user0').one().id
+
+        resp = self.client.get('/admin/memory')
+        self.assertEqual(resp.get_json()['routes'][0]['route'], '/users')
+
+    def test_already_tracing(self):
+        """Is a request left alone when something else is tracing?"""
+
+        tracemalloc.start()
+
+        try:
+            self.client.get('/login')
+            self.assertTrue(tracemalloc.is_tracing())
+        finally:
+            tracemalloc.stop()
+
+        self.assertEqual(profiler.snapshot(), [])
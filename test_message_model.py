@@ -5,22 +5,17 @@
 #    python -m unittest test_message_model.py
 
 
-import os
+from datetime import datetime
 from unittest import TestCase
 
-from models import db, User, Message, Follows
-
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
-
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
-
+from flask import Flask
 
-# Now we can import app
+from models import db, User, Message, Follows
+from snowflake import (IdGenerator, WORKER_LOCK_CLASS, claim_worker_id, id_for, init_ids,
+                       next_id, timestamp_of)
+from app import create_app
 
-from app import app
+app = create_app('testing')
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -66,4 +61,77 @@ class MessageModelTestCase(TestCase):
         self.assertEqual(message.text, 'This is a test message.')
 
         # Does the repr method work as expected?
-        self.assertEqual(repr(message), '<Message #1 made by user #1>')
+        self.assertEqual(repr(message), f'<Message #{message.id} made by user #1>')
+
+    def test_message_ids(self):
+        """Are message ids time-ordered, with timestamps to match?"""
+
+        m1 = Message(user_id=1, text='First')
+        m2 = Message(user_id=1, text='Second')
+
+        db.session.add(m1)
+        db.session.commit()
+        db.session.add(m2)
+        db.session.commit()
+
+        self.assertLess(m1.id, m2.id)
+        self.assertLessEqual(m1.timestamp, m2.timestamp)
+        self.assertEqual(m1.timestamp, timestamp_of(m1.id))
+
+        # Ordering by id alone gives newest first
+        messages = Message.query.order_by(Message.id.desc()).all()
+        self.assertEqual([m.text for m in messages], ['Second', 'First'])
+
+    def test_id_generator(self):
+        """Does the id generator stay ordered within one millisecond?"""
+
+        generate = IdGenerator(worker_id=7)
+        ids = [generate() for i in range(10000)]
+
+        self.assertEqual(ids, sorted(set(ids)))
+        self.assertEqual(timestamp_of(id_for(datetime(2020, 5, 17))),
+                         datetime(2020, 5, 17))
+
+    def test_worker_ids(self):
+        """Does a production app need a worker id it can't claim?"""
+
+        production = Flask(__name__)
+        production.config.update(SQLALCHEMY_DATABASE_URI='sqlite://', SNOWFLAKE_WORKER_ID=None)
+
+        try:
+            with self.assertRaises(RuntimeError):
+                init_ids(production)
+
+            production.config['SNOWFLAKE_WORKER_ID'] = '12'
+            init_ids(production)
+            self.assertEqual((next_id() >> 12) & 1023, 12)
+        finally:
+            init_ids(app)
+
+    def test_claim_worker_id(self):
+        """Is a claimed worker id held until its connection closes?"""
+
+        if db.engine.dialect.name != 'postgresql':
+            self.skipTest("worker ids are only claimed on Postgres")
+
+        def locked_elsewhere(worker_id):
+            with db.engine.connect() as conn:
+                taken = not conn.execute('SELECT pg_try_advisory_lock(%s, %s)',
+                                         WORKER_LOCK_CLASS, worker_id).scalar()
+                if not taken:
+                    conn.execute('SELECT pg_advisory_unlock(%s, %s)', WORKER_LOCK_CLASS, worker_id)
+                return taken
+
+        worker_id, connection = claim_worker_id(db.engine.url)
+        self.assertTrue(locked_elsewhere(worker_id))
+
+        other_id, other = claim_worker_id(db.engine.url)
+        self.assertNotEqual(other_id, worker_id)
+        other.close()
+
+        connection.close()
+        self.assertFalse(locked_elsewhere(worker_id))
+
+        generate = IdGenerator(claim=lambda: claim_worker_id(db.engine.url))
+        worker_id = (generate() >> 12) & 1023
+        self.assertTrue(locked_elsewhere(worker_id))
@@ -5,23 +5,16 @@
 #    FLASK_ENV=production python -m unittest test_message_views.py
 
 
-import os
 from unittest import TestCase
 from urllib.parse import urlparse
 
-from models import db, connect_db, Message, User
+from models import db, connect_db, Message, User, Tag, MessageTag, Mention
+from hashtags import trending, index_message, extract_tags, extract_mentions
+from search import search_messages
+from querytrace import query_budget
+from app import create_app, CURR_USER_KEY
 
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
-
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
-
-
-# Now we can import app
-
-from app import app, CURR_USER_KEY
+app = create_app('testing')
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -29,10 +22,6 @@ from app import app, CURR_USER_KEY
 
 db.create_all()
 
-# Don't have WTForms use CSRF at all, since it's a pain to test
-
-app.config['WTF_CSRF_ENABLED'] = False
-
 
 class MessageViewTestCase(TestCase):
     """Test views for messages."""
@@ -96,7 +85,9 @@ class MessageViewTestCase(TestCase):
 
             c.post("/messages/new", data={"text": "Hello"})
 
-            resp = c.get("/messages/1")
+            msg = Message.query.one()
+
+            resp = c.get(f"/messages/{msg.id}")
             html = resp.get_data(as_text=True)
 
             # Make sure it loads the message detail page
@@ -113,7 +104,9 @@ class MessageViewTestCase(TestCase):
 
             c.post("/messages/new", data={"text": "Hello"})
 
-            resp = c.post("/messages/1/delete")
+            msg = Message.query.one()
+
+            resp = c.post(f"/messages/{msg.id}/delete")
 
             # Make sure it redirects
             self.assertEqual(resp.status_code, 302)
@@ -121,7 +114,9 @@ class MessageViewTestCase(TestCase):
 
             c.post("/messages/new", data={"text": "Hello Again"})
 
-            redir_resp = c.post("/messages/2/delete", follow_redirects=True)
+            msg = Message.query.one()
+
+            redir_resp = c.post(f"/messages/{msg.id}/delete", follow_redirects=True)
             html = redir_resp.get_data(as_text=True)
 
             # Confirm that it redirects to correct content
@@ -131,4 +126,109 @@ class MessageViewTestCase(TestCase):
             messages = Message.query.filter(Message.user_id == 1)
 
             # Confirm message has been deleted
-            self.assertEqual(messages.count(), 0)
\ No newline at end of file
+            self.assertEqual(messages.count(), 0)
+
+    def test_hashtags(self):
+        """Are hashtags and mentions recorded and shown on tag pages?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post("/messages/new", data={"text": "Learning #Flask with @testuser"})
+
+            msg = Message.query.one()
+            tag = Tag.query.one()
+
+            self.assertEqual(tag.name, 'flask')
+            self.assertEqual(MessageTag.query.one().message_id, msg.id)
+            self.assertEqual(Mention.query.one().user_id, self.testuser.id)
+
+            resp = c.get("/tags/FLASK")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('Learning', html)
+            self.assertIn('<a href="/tags/flask">#Flask</a>', html)
+
+            self.assertEqual(c.get("/tags/nope").status_code, 404)
+
+            trending.invalidate()
+            self.assertEqual(trending.get(), [('flask', 1)])
+
+    def test_extract_tags(self):
+        """Are tags and mentions parsed out of message text?"""
+
+        self.assertEqual(extract_tags("#One two #three&#39; #One"), {'one', 'three'})
+        self.assertEqual(extract_mentions("hi @ann.lee. and @bob_1!"), {'ann.lee', 'bob_1'})
+
+    def test_search(self):
+        """Does message search rank, page and stay in sync with deletes?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post("/messages/new", data={"text": "Warbling about birds"})
+            c.post("/messages/new", data={"text": "Birds, birds and more birds"})
+            c.post("/messages/new", data={"text": "Nothing to see here"})
+
+            resp = c.get("/messages/search?q=birds")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('Warbling about birds', html)
+            self.assertIn('Birds, birds and more birds', html)
+            self.assertNotIn('Nothing to see here', html)
+
+            # The message that says it most ranks first, one per page
+            first, cursor = search_messages("birds", limit=1)
+            second, last = search_messages("birds", cursor=cursor, limit=1)
+
+            self.assertEqual(first[0].text, 'Birds, birds and more birds')
+            self.assertEqual(second[0].text, 'Warbling about birds')
+            self.assertIsNone(last)
+
+            c.post(f"/messages/{first[0].id}/delete")
+
+            messages, cursor = search_messages("birds")
+            self.assertEqual([m.text for m in messages], ['Warbling about birds'])
+
+    def test_query_budgets(self):
+        """Do the home feed and message, tag and search pages run a fixed number of queries?"""
+
+        authors = [User.signup(username=f"author{n}", email=f"author{n}@test.com",
+                               password="password", image_url=None)
+                   for n in range(5)]
+        db.session.flush()
+
+        for author in authors:
+            self.testuser.following.append(author)
+
+            for n in range(3):
+                message = Message(text=f"{author.username} #{n} on #birds", user_id=author.id)
+                db.session.add(message)
+                db.session.flush()
+                index_message(message)
+
+        db.session.commit()
+        message_id = Message.query.first().id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            # The trending sidebar is recomputed once a minute, not per request
+            trending.get()
+
+            with query_budget(12):
+                self.assertEqual(c.get('/').status_code, 200)
+
+            with query_budget(5):
+                self.assertEqual(c.get(f'/messages/{message_id}').status_code, 200)
+
+            with query_budget(6):
+                self.assertEqual(c.get('/tags/birds').status_code, 200)
+
+            with query_budget(5):
+                self.assertEqual(c.get('/messages/search?q=birds').status_code, 200)
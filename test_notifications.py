@@ -0,0 +1,115 @@
+"""Notification tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_notifications.py
+
+
+from unittest import TestCase
+
+from models import db, User, Message, Notification
+from notifications import notify, unread_count, notification_page
+import notifications
+from app import create_app, CURR_USER_KEY
+
+app = create_app('testing')
+
+db.create_all()
+
+
+class NotificationsTestCase(TestCase):
+    """Test recording, grouping and counting follows and likes."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.context = app.app_context()
+        self.context.push()
+
+        users = [User(username=f'user{n}', email=f'user{n}@test.com', password='password')
+                 for n in range(5)]
+        db.session.add_all(users)
+        db.session.flush()
+        self.ids = [user.id for user in users]
+
+        message = Message(text='worth a like', user_id=self.ids[0])
+        db.session.add(message)
+        db.session.commit()
+        self.message = message.id
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        self.context.pop()
+
+    def login(self, c, user_id):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def test_views(self):
+        """Do follows and likes notify, and does reading them clear the badge?"""
+
+        me = self.ids[0]
+
+        with self.client as c:
+            for fan in self.ids[1:]:
+                self.login(c, fan)
+                c.post(f'/users/add_like/{self.message}')
+
+            # Unliking doesn't take the notification back, nor add one
+            c.post(f'/users/add_like/{self.message}')
+
+            c.post('/users/follow', data={'user_ids': [me]})
+            self.login(c, self.ids[1])
+            c.post(f'/users/follow/{me}')
+
+            self.assertEqual(unread_count(db.session, me), 6)
+
+            self.login(c, me)
+            html = c.get('/').get_data(as_text=True)
+            self.assertIn('<span class="badge badge-danger">6</span>', html)
+
+            html = c.get('/notifications').get_data(as_text=True)
+            self.assertIn(f'@user1</a> and <a href="/users/{self.ids[4]}">@user4</a>', html)
+            self.assertIn('followed you', html)
+            self.assertIn('and 2 others', html)
+            self.assertIn('liked your warble', html)
+            self.assertIn('worth a like', html)
+
+            self.assertEqual(unread_count(db.session, me), 0)
+            self.assertNotIn('badge-danger', c.get('/').get_data(as_text=True))
+
+    def test_grouping(self):
+        """Are notifications grouped per kind and message, and paged by id?"""
+
+        me, a, b, c = self.ids[:4]
+
+        notify(db.session, 'like', a, [me], self.message)
+        notify(db.session, 'follow', a, [me])
+        notify(db.session, 'like', b, [me], self.message)
+        notify(db.session, 'like', a, [me], self.message)
+        notify(db.session, 'like', c, [me], 12345)         # since deleted
+        notify(db.session, 'follow', me, [me])              # oneself: ignored
+        db.session.commit()
+
+        notices, cursor = notification_page(db.session, me)
+
+        self.assertIsNone(cursor)
+        self.assertEqual([(n.kind, n.actor_ids, n.unread) for n in notices],
+                         [('like', [a, b], True), ('follow', [a], True)])
+        self.assertEqual(notices[0].message.text, 'worth a like')
+        self.assertEqual(Notification.query.count(), 5)
+        self.assertEqual(unread_count(db.session, me), 5)
+
+        # A full page leaves a cursor to the rest
+        page_size, notifications.PAGE_SIZE = notifications.PAGE_SIZE, 2
+        try:
+            notices, cursor = notification_page(db.session, me)
+            self.assertEqual([n.kind for n in notices], ['like'])
+            notices, cursor = notification_page(db.session, me, cursor)
+            self.assertEqual([(n.kind, n.actor_ids) for n in notices],
+                             [('like', [b]), ('follow', [a])])
+        finally:
+            notifications.PAGE_SIZE = page_size
@@ -0,0 +1,110 @@
+"""Prepared hot query tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_queries.py
+
+
+from unittest import TestCase
+
+from models import db, User, Message, Likes
+from queries import (FeedMessage, home_feed, user_messages, liked_messages, liked_ids,
+                     toggle_like, add_message, delete_message, message_count, like_count)
+from app import create_app
+
+app = create_app('testing')
+
+db.create_all()
+
+
+class QueriesTestCase(TestCase):
+    """Test the prepared queries against their plain ORM versions."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        u1 = User(username='user1', email='user1@email.com', password='password')
+        u2 = User(username='user2', email='user2@email.com', password='password')
+        u3 = User(username='user3', email='user3@email.com', password='password')
+        db.session.add_all([u1, u2, u3])
+        db.session.flush()
+
+        for n in range(3):
+            for user in (u1, u2, u3):
+                db.session.add(Message(text=f'{user.username} #{n}', user_id=user.id))
+                db.session.flush()
+
+        self.u1, self.u2, self.u3 = u1.id, u2.id, u3.id
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def texts(self, messages):
+        return [message.text for message in messages]
+
+    def test_feeds(self):
+        """Do the feeds select, order and page like the unbaked queries did?"""
+
+        session = db.session()
+
+        feed = home_feed(session, [self.u1, self.u2])
+        self.assertEqual(self.texts(feed), ['user2 #2', 'user1 #2', 'user2 #1',
+                                            'user1 #1', 'user2 #0', 'user1 #0'])
+
+        # Light records, one author record per author on the page
+        self.assertIsInstance(feed[0], FeedMessage)
+        self.assertEqual((feed[0].user_id, feed[0].user.id, feed[0].user.username),
+                         (self.u2, self.u2, 'user2'))
+        self.assertIs(feed[0].user, feed[2].user)
+
+        # Paging bakes a second variant; both keep working
+        self.assertEqual(self.texts(home_feed(session, [self.u3], feed[1].id)),
+                         ['user3 #1', 'user3 #0'])
+        self.assertEqual(len(home_feed(session, [self.u3])), 3)
+
+        messages = user_messages(session, self.u2)
+        self.assertEqual(self.texts(messages), ['user2 #2', 'user2 #1', 'user2 #0'])
+        self.assertEqual(self.texts(user_messages(session, self.u2, messages[0].id)),
+                         ['user2 #1', 'user2 #0'])
+
+    def test_likes(self):
+        """Do the like lookups find exactly the user's likes?"""
+
+        session = db.session()
+        first, second = user_messages(session, self.u2)[:2]
+
+        db.session.add(Likes(user_id=self.u1, message_id=first.id))
+        db.session.commit()
+
+        self.assertEqual([message.id for message in liked_messages(session, self.u1)],
+                         [first.id])
+        self.assertEqual(liked_messages(session, self.u3), [])
+
+        self.assertEqual(liked_ids(session, self.u1, [first.id, second.id]), {first.id})
+        self.assertEqual(liked_ids(session, self.u3, [first.id, second.id]), set())
+        self.assertEqual(like_count(session, self.u1), 1)
+
+        self.assertTrue(toggle_like(session, self.u1, second.id))
+        self.assertFalse(toggle_like(session, self.u1, first.id))
+        self.assertEqual(liked_ids(session, self.u1, [first.id, second.id]), {second.id})
+
+    def test_writes(self):
+        """Are messages posted and deleted (with their likes)?"""
+
+        session = db.session()
+
+        message = add_message(session, self.u1, 'fresh warble')
+        toggle_like(session, self.u2, message.id)
+        session.commit()
+
+        self.assertEqual(self.texts(user_messages(session, self.u1))[0], 'fresh warble')
+        self.assertEqual(Message.query.get(message.id).timestamp, message.timestamp)
+        self.assertEqual(message_count(session, self.u1), 4)
+
+        delete_message(session, message.id)
+        session.commit()
+
+        self.assertEqual(message_count(session, self.u1), 3)
+        self.assertEqual(like_count(session, self.u2), 0)
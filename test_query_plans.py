@@ -0,0 +1,275 @@
+"""Query plan regression tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_query_plans.py
+#
+# Each hot query is run through EXPLAIN: the Core statements from
+# queries.py as they are, and the ORM queries app.py and models.py still
+# make. A test fails if the plan falls back to reading a whole table,
+# which usually means an index was dropped or a query stopped matching one.
+
+
+from datetime import datetime
+from unittest import TestCase
+
+from sqlalchemy import (MetaData, Table, Column, Integer, String, Text, DateTime,
+                        ForeignKey, and_, event, select)
+from sqlalchemy.exc import IntegrityError
+
+import queries
+from models import db, User, Message, Follows
+from migrations import MIGRATIONS, upgrade, stamp, applied_versions
+from search import ranked_matches
+from sharding import likes
+from snowflake import id_for
+from app import create_app
+
+app = create_app('testing')
+
+db.create_all()
+
+
+def explain(query, **params):
+    """Return the lines of the query plan for an ORM query or select.
+
+    The statement is executed as usual, with `params` (expanding IN lists
+    and all), in the test's transaction, but with EXPLAIN put in front of
+    its SQL on the way to the database.
+    """
+
+    conn = db.session.connection()
+    prefix = 'EXPLAIN QUERY PLAN' if conn.dialect.name == 'sqlite' else 'EXPLAIN'
+
+    def explained(conn, cursor, statement, parameters, context, executemany):
+        return f"{prefix} {statement}", parameters
+
+    event.listen(conn, 'before_cursor_execute', explained, retval=True)
+
+    try:
+        cursor = conn.execute(getattr(query, 'statement', query), **params).cursor
+        return [row[-1] for row in cursor.fetchall()]
+    finally:
+        event.remove(conn, 'before_cursor_execute', explained)
+
+
+# The schema the app started with, before any migration: SERIAL message
+# ids, and UNIQUE(message_id) on likes (one like per message).
+baseline = MetaData()
+
+Table('users', baseline,
+      Column('id', Integer, primary_key=True),
+      Column('email', Text, nullable=False, unique=True),
+      Column('username', Text, nullable=False, unique=True),
+      Column('image_url', Text),
+      Column('header_image_url', Text),
+      Column('bio', Text),
+      Column('location', Text),
+      Column('password', Text, nullable=False))
+
+Table('follows', baseline,
+      Column('user_being_followed_id', Integer,
+             ForeignKey('users.id', ondelete='cascade'), primary_key=True),
+      Column('user_following_id', Integer,
+             ForeignKey('users.id', ondelete='cascade'), primary_key=True))
+
+Table('messages', baseline,
+      Column('id', Integer, primary_key=True),
+      Column('text', String(140), nullable=False),
+      Column('timestamp', DateTime, nullable=False),
+      Column('user_id', Integer, ForeignKey('users.id', ondelete='cascade'), nullable=False))
+
+Table('likes', baseline,
+      Column('id', Integer, primary_key=True),
+      Column('user_id', Integer, ForeignKey('users.id', ondelete='cascade')),
+      Column('message_id', Integer, ForeignKey('messages.id', ondelete='cascade'), unique=True))
+
+
+def full_scans(plan):
+    """Return the plan lines that read an entire table."""
+
+    return [line for line in plan
+            if "Seq Scan" in line
+            or (line.startswith("SCAN") and "INDEX" not in line)]
+
+
+class QueryPlanTestCase(TestCase):
+    """EXPLAIN the hot queries and reject sequential scans."""
+
+    def setUp(self):
+        """Create a fresh schema and tell the planner to avoid seq scans."""
+
+        db.drop_all()
+        db.create_all()
+
+        u1 = User(username='user1', email='user1@email.com', password='password')
+        u2 = User(username='user2', email='user2@email.com', password='password')
+
+        db.session.add_all([u1, u2])
+        db.session.commit()
+
+        # With tiny tables Postgres would rightly prefer a seq scan. Turning
+        # them off makes it pick an index whenever one is usable, so a seq
+        # scan in the plan means there is no usable index at all.
+        if db.engine.dialect.name == 'postgresql':
+            db.session.execute("SET LOCAL enable_seqscan = off")
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def assertIndexed(self, query, **params):
+        plan = explain(query, **params)
+        self.assertEqual(full_scans(plan), [], "\n".join(plan))
+
+    def test_home_feed(self):
+        """homepage: newest messages from followed users."""
+
+        self.assertIndexed(queries.HOME_FEED[False], following=[1, 2])
+        self.assertIndexed(queries.HOME_FEED[True], following=[1, 2], before=10 ** 15)
+
+    def test_user_messages(self):
+        """users_show: a user's newest messages."""
+
+        self.assertIndexed(queries.USER_MESSAGES[False], user_id=1)
+        self.assertIndexed(queries.USER_MESSAGES[True], user_id=1, before=10 ** 15)
+
+    def test_messages_by_id(self):
+        """messages_show and liked pages: messages by id."""
+
+        self.assertIndexed(queries.MESSAGES_BY_ID, message_ids=[1, 2, 3])
+
+    def test_authors(self):
+        """Every timeline: the authors of a page of messages."""
+
+        self.assertIndexed(queries.AUTHORS, user_ids=[1, 2])
+
+    def test_counts(self):
+        """Profile counts: a user's messages and likes."""
+
+        self.assertIndexed(queries.MESSAGE_COUNT, user_id=1)
+        self.assertIndexed(queries.LIKE_COUNT, user_id=1)
+
+    def test_following(self):
+        """User.following: who a user follows."""
+
+        self.assertIndexed(User
+                           .query
+                           .join(Follows, Follows.user_being_followed_id == User.id)
+                           .filter(Follows.user_following_id == 1))
+
+    def test_followers(self):
+        """User.followers: who follows a user."""
+
+        self.assertIndexed(User
+                           .query
+                           .join(Follows, Follows.user_following_id == User.id)
+                           .filter(Follows.user_being_followed_id == 1))
+
+    def test_user_likes(self):
+        """show_user_likes: the messages a user has liked, newest first."""
+
+        self.assertIndexed(queries.LIKED_IDS, user_id=1)
+
+    def test_liked_ids(self):
+        """liked_ids: which messages on screen the viewer liked."""
+
+        self.assertIndexed(queries.LIKED_AMONG, user_id=1, message_ids=[1, 2, 3])
+
+    def test_like_lookup(self):
+        """toggle_like: remove this user's like of this message, if any."""
+
+        self.assertIndexed(likes.delete().where(and_(likes.c.user_id == 1,
+                                                     likes.c.message_id == 1)))
+
+    def test_tag_page(self):
+        """tags_show: newest messages using a hashtag."""
+
+        self.assertIndexed(queries.TAG_MESSAGES[False], tag_id=1)
+        self.assertIndexed(queries.TAG_MESSAGES[True], tag_id=1, before=10 ** 15)
+
+    def test_search(self):
+        """messages_search: messages matching a full-text query."""
+
+        matches, score, id_column = ranked_matches('hello world')
+        self.assertIndexed(matches.order_by(score.desc(), id_column.desc()).limit(21))
+
+    def test_authenticate(self):
+        """User.authenticate: find a user by username."""
+
+        self.assertIndexed(User.query.filter_by(username='user1'))
+
+
+class MigrationTestCase(TestCase):
+    """Test the migration runner."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.rollback()
+        db.drop_all()
+
+    def test_upgrade(self):
+        """Do migrations apply once and then become no-ops?"""
+
+        self.assertEqual(upgrade(), list(range(1, len(MIGRATIONS) + 1)))
+        self.assertEqual(upgrade(), [])
+
+    def test_stamp(self):
+        """Does stamping a fresh schema mark everything applied?"""
+
+        stamp()
+
+        with db.engine.connect() as conn:
+            self.assertEqual(len(applied_versions(conn)), len(MIGRATIONS))
+
+        self.assertEqual(upgrade(), [])
+
+    def test_upgrade_baseline(self):
+        """Does a database from before the migrations upgrade, data and all?"""
+
+        db.drop_all()
+        baseline.create_all(db.engine)
+
+        users, messages, likes = (baseline.tables[name] for name in ('users', 'messages', 'likes'))
+        posted = [datetime(2018, 10, 1, 12), datetime(2018, 10, 2, 12)]
+
+        with db.engine.begin() as conn:
+            conn.execute(users.insert(), [
+                dict(id=n, email=f'user{n}@test.com', username=f'user{n}', password='password')
+                for n in (1, 2)])
+            conn.execute(messages.insert(), [
+                dict(id=n, text=f'warble {n}', timestamp=timestamp, user_id=1)
+                for n, timestamp in enumerate(posted, start=1)])
+            conn.execute(likes.insert(), dict(user_id=1, message_id=1))
+
+        self.assertEqual(upgrade(), list(range(1, len(MIGRATIONS) + 1)))
+
+        with db.engine.connect() as conn:
+            ids = [message_id for (message_id,) in conn.execute(
+                select([messages.c.id]).order_by(messages.c.id))]
+            liked = conn.execute(select([likes.c.message_id])).scalar()
+
+        # Renumbered from their timestamps, and the like follows its message
+        self.assertEqual(ids, [id_for(timestamp, tiebreak=n)
+                               for n, timestamp in enumerate(posted, start=1)])
+        self.assertEqual(liked, ids[0])
+
+        # Likes are unique per user and message, not per message (SQLite
+        # keeps the old constraint too; see allow_many_likes_per_message)
+        if db.engine.dialect.name == 'postgresql':
+            with db.engine.begin() as conn:
+                conn.execute(likes.insert(), dict(user_id=2, message_id=ids[0]))
+
+        with self.assertRaises(IntegrityError):
+            with db.engine.begin() as conn:
+                conn.execute(likes.insert(), dict(user_id=1, message_id=ids[0]))
+
+        # New messages get 64-bit ids
+        message = Message(text='later', user_id=2)
+        db.session.add(message)
+        db.session.commit()
+        self.assertGreater(message.id, 2 ** 31)
+
+        self.assertEqual(upgrade(), [])
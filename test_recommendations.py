@@ -0,0 +1,83 @@
+"""Recommendation engine tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_recommendations.py
+
+
+from unittest import TestCase
+
+from models import db, User, Follows, Recommendation, StaleRecommendation
+from bulk import follow_users
+from recommendations import recompute
+from app import create_app
+
+app = create_app('testing')
+
+db.create_all()
+
+
+class RecommendationTestCase(TestCase):
+    """Test "who to follow" recommendations."""
+
+    def setUp(self):
+        """Create five users; 1 follows 2 and 3, who both follow 4."""
+
+        db.drop_all()
+        db.create_all()
+
+        for i in range(1, 6):
+            db.session.add(User(username=f'user{i}',
+                                email=f'user{i}@email.com',
+                                password='password'))
+        db.session.commit()
+
+        for follower, followed in [(1, 2), (1, 3), (2, 4), (3, 4), (2, 5)]:
+            db.session.add(Follows(user_following_id=follower,
+                                   user_being_followed_id=followed))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_friends_of_friends(self):
+        """Are accounts followed by followed accounts suggested, best first?"""
+
+        recompute(full=True)
+
+        suggested = [u.username for u in Recommendation.for_user(1)]
+
+        # user4 is followed by two of user1's follows, user5 by one
+        self.assertEqual(suggested, ['user4', 'user5'])
+
+    def test_excludes_followed(self):
+        """Are users never suggested themselves or accounts they follow?"""
+
+        recompute(full=True)
+
+        for rec in Recommendation.query.all():
+            self.assertNotEqual(rec.user_id, rec.recommended_user_id)
+            self.assertIsNone(Follows.query.get((rec.recommended_user_id,
+                                                 rec.user_id)))
+
+    def test_incremental(self):
+        """Does an incremental run rescore only the users a follow affects?"""
+
+        recompute(full=True)
+
+        follow_users(db.session, 3, {5})
+        db.session.commit()
+        self.assertEqual({stale.user_id for stale in StaleRecommendation.query}, {3, 5})
+
+        # user3 and user5, their followers user1 and user2, and user3's follows
+        self.assertEqual(recompute(), 5)
+        self.assertEqual(StaleRecommendation.query.count(), 0)
+
+        scores = {r.recommended_user_id: r.score
+                  for r in Recommendation.query.filter_by(user_id=1)}
+        self.assertEqual(scores[5], scores[4])
+
+        # user4 is co-followed with user5 by user3 now, as well as user2
+        scores = {r.recommended_user_id: r.score
+                  for r in Recommendation.query.filter_by(user_id=5)}
+        self.assertEqual(scores[4], 1.0)
@@ -0,0 +1,214 @@
+"""Message shard tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_sharding.py
+#
+# The shards are SQLite files in a temporary directory; the main database
+# is the usual test database.
+
+
+import os
+import tempfile
+from unittest import TestCase
+
+from sqlalchemy import create_engine, select, func
+
+from models import db, User, Message, Likes
+from queries import (home_feed, user_messages, liked_messages, liked_ids,
+                     add_message, delete_message, toggle_like)
+from sharding import ShardRouter, create_shards, rebalance, messages, likes
+from app import create_app, CURR_USER_KEY
+
+app = create_app('testing')
+
+db.create_all()
+
+
+class ShardingTestCase(TestCase):
+    """Test routing messages and likes to shards."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        # So shard_router() finds this app's shards
+        self.context = app.app_context()
+        self.context.push()
+
+        directory = tempfile.mkdtemp()
+        self.urls = [f"sqlite:///{os.path.join(directory, f'shard{n}.db')}" for n in range(3)]
+        create_shards(self.urls)
+
+        self.unsharded = app.extensions['shards']
+        self.use_shards(self.urls[:2])
+
+        self.users = []
+        for n in range(1, 5):
+            user = User(username=f'user{n}', email=f'user{n}@test.com', password='password')
+            db.session.add(user)
+            db.session.flush()
+            self.users.append(user.id)
+
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+        app.extensions['shards'].dispose()
+        app.extensions['shards'] = self.unsharded
+        self.context.pop()
+
+    def use_shards(self, urls):
+        if app.extensions['shards'] is not self.unsharded:
+            app.extensions['shards'].dispose()
+
+        app.extensions['shards'] = ShardRouter(create_engine(url) for url in urls)
+
+    def count(self, url, table, **where):
+        engine = create_engine(url)
+        query = select([func.count()]).select_from(table)
+
+        for column, value in where.items():
+            query = query.where(table.c[column] == value)
+
+        with engine.connect() as conn:
+            count = conn.execute(query).scalar()
+
+        engine.dispose()
+        return count
+
+    def test_routing(self):
+        """Do messages and likes land on their user's shard, and read back merged?"""
+
+        session = db.session()
+        u1, u2, u3, u4 = self.users
+
+        posted = [add_message(session, user_id, f'warble {n} by {user_id}')
+                  for n in range(3) for user_id in (u1, u2, u3)]
+        self.assertTrue(toggle_like(session, u4, posted[0].id))
+        self.assertTrue(toggle_like(session, u4, posted[1].id))
+        session.commit()
+
+        # User u is on shard u % 2; the main database holds none of it
+        self.assertEqual(self.count(self.urls[1], messages, user_id=u1), 3)
+        self.assertEqual(self.count(self.urls[0], messages, user_id=u2), 3)
+        self.assertEqual(self.count(self.urls[0], messages, user_id=u1), 0)
+        self.assertEqual(self.count(self.urls[0], likes, user_id=u4), 2)
+        self.assertEqual(Message.query.count(), 0)
+
+        # The home feed merges every shard's page, newest first
+        feed = home_feed(session, [u1, u2, u3])
+        self.assertEqual([message.id for message in feed],
+                         sorted((message.id for message in posted), reverse=True))
+        self.assertEqual(feed[0].user.username, 'user3')
+
+        self.assertEqual(len(home_feed(session, [u1, u2], before=posted[3].id)), 2)
+        self.assertEqual([message.user_id for message in user_messages(session, u2)], [u2] * 3)
+
+        self.assertEqual([message.id for message in liked_messages(session, u4)],
+                         [posted[1].id, posted[0].id])
+        self.assertEqual(liked_ids(session, u4, [message.id for message in posted]),
+                         {posted[0].id, posted[1].id})
+
+        delete_message(session, posted[0].id)
+        session.commit()
+
+        self.assertEqual(self.count(self.urls[1], messages, user_id=u1), 2)
+        self.assertEqual(liked_ids(session, u4, [posted[0].id]), set())
+
+    def test_pages(self):
+        """Do posting, liking and the home page work with shards?"""
+
+        u1, u2 = self.users[:2]
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u2
+
+            c.post('/users/follow/' + str(u1))
+            c.post('/messages/new', data={'text': 'sharded #warble'})
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u1
+
+            c.post('/messages/new', data={'text': 'followed warble'})
+            message_id = user_messages(db.session, u1)[0].id
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u2
+
+            c.post(f'/users/add_like/{message_id}')
+            html = c.get('/').get_data(as_text=True)
+
+            self.assertIn('sharded', html)
+            self.assertIn('followed warble', html)
+            self.assertEqual(html.count('btn-primary'), 1)
+
+            html = c.get(f'/messages/{message_id}').get_data(as_text=True)
+            self.assertIn('followed warble', html)
+
+        self.assertEqual(self.count(self.urls[0], messages, user_id=u2), 1)
+        self.assertEqual(self.count(self.urls[0], likes, user_id=u2), 1)
+
+    def test_delete_user(self):
+        """Are other users' likes of a deleted user's messages deleted too?"""
+
+        u1, u2, u3 = self.users[:3]
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u1
+
+            c.post('/messages/new', data={'text': 'soon gone'})
+            message_id = user_messages(db.session, u1)[0].id
+
+            for fan in (u2, u3):
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = fan
+                c.post(f'/users/add_like/{message_id}')
+
+            self.assertEqual(self.count(self.urls[u2 % 2], likes, message_id=message_id), 1)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u1
+            c.post('/users/delete')
+
+        for url in self.urls[:2]:
+            self.assertEqual(self.count(url, likes, message_id=message_id), 0)
+            self.assertEqual(self.count(url, messages, user_id=u1), 0)
+
+    def test_rebalance(self):
+        """Are rows moved from the main database, and between shard layouts?"""
+
+        main = str(db.engine.url)
+        u1, u2, u3, u4 = self.users
+
+        for user_id in self.users:
+            db.session.add(Message(text=f'warble by {user_id}', user_id=user_id))
+        db.session.flush()
+
+        db.session.add(Likes(user_id=u4, message_id=Message.query.first().id))
+        db.session.commit()
+        db.session.remove()
+
+        moved = rebalance([main], self.urls[:2])
+        self.assertEqual(moved, {'messages': 4, 'likes': 1})
+        self.assertEqual(Message.query.count(), 0)
+        self.assertEqual(self.count(self.urls[1], messages), 2)
+        self.assertEqual(self.count(self.urls[0], likes, user_id=u4), 1)
+
+        # Adding a third shard moves only the users whose place changed
+        moved = rebalance(self.urls[:2], self.urls)
+        self.assertEqual(moved, {'messages': 3, 'likes': 1})
+
+        self.use_shards(self.urls)
+        session = db.session()
+
+        for user_id in self.users:
+            self.assertEqual(len(user_messages(session, user_id)), 1)
+            self.assertEqual(self.count(self.urls[user_id % 3], messages, user_id=user_id), 1)
+
+        self.assertEqual(len(liked_messages(session, u4)), 1)
+
+        # Running it again moves nothing
+        self.assertEqual(rebalance(self.urls[:2], self.urls), {'messages': 0, 'likes': 0})
@@ -0,0 +1,122 @@
+"""Single-flight request coalescing tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_singleflight.py
+
+
+import threading
+import time
+from unittest import TestCase
+
+from models import db, User, Message
+from singleflight import SingleFlight
+from app import create_app
+
+app = create_app('testing')
+
+db.create_all()
+
+
+class SingleFlightTestCase(TestCase):
+    """Test coalescing concurrent loads."""
+
+    def run_concurrently(self, flights, key, load, callers=5):
+        """Call flights.do(key, load) from `callers` threads at once."""
+
+        results = []
+
+        def call():
+            try:
+                results.append(flights.do(key, load))
+            except Exception as exc:
+                results.append(exc)
+
+        threads = [threading.Thread(target=call) for _ in range(callers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return results
+
+    def test_coalesced(self):
+        """Do concurrent calls with one key share a single load?"""
+
+        flights = SingleFlight()
+        loads = []
+
+        def load():
+            loads.append(1)
+            time.sleep(0.2)
+            return object()
+
+        results = self.run_concurrently(flights, ('page', 1), load)
+
+        self.assertEqual(len(loads), 1)
+        self.assertEqual(len(set(map(id, results))), 1)
+        self.assertEqual(flights.snapshot(),
+                         [{'route': 'page', 'loads': 1, 'coalesced': 4,
+                           'coalesced_ratio': 0.8}])
+
+        # Finished keys are forgotten: the next call loads again
+        flights.do(('page', 1), load)
+        self.assertEqual(len(loads), 2)
+
+        # Different keys don't wait on each other
+        flights.do(('page', 2), load)
+        self.assertEqual(len(loads), 3)
+
+    def test_errors_shared(self):
+        """Do waiting callers get the leader's exception?"""
+
+        flights = SingleFlight()
+
+        def load():
+            time.sleep(0.2)
+            raise ValueError("database is down")
+
+        results = self.run_concurrently(flights, ('page', 1), load, callers=3)
+
+        self.assertEqual(len(results), 3)
+        self.assertTrue(all(isinstance(result, ValueError) for result in results))
+
+
+class SharedPageTestCase(TestCase):
+    """Test pages whose loads are shared."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.user = User(username='poster', email='poster@test.com', password='password')
+        db.session.add(self.user)
+        db.session.flush()
+
+        self.message = Message(text='hello everyone', user_id=self.user.id)
+        db.session.add(self.message)
+        db.session.commit()
+
+        self.user_id = self.user.id
+        self.message_id = self.message.id
+
+        app.extensions['singleflight'].reset()
+        self.client = app.test_client()
+
+    def test_shared_pages(self):
+        """Do profile and message pages render from shared, detached loads?"""
+
+        resp = self.client.get(f'/users/{self.user_id}')
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('hello everyone', resp.get_data(as_text=True))
+
+        resp = self.client.get(f'/messages/{self.message_id}')
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('@poster', resp.get_data(as_text=True))
+
+        self.assertEqual(self.client.get('/users/999').status_code, 404)
+        self.assertEqual(self.client.get('/messages/999').status_code, 404)
+
+        routes = {row['route']: row for row in app.extensions['singleflight'].snapshot()}
+        self.assertEqual(routes['users_show']['loads'], 2)
+        self.assertEqual(routes['messages_show']['loads'], 2)
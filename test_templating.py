@@ -0,0 +1,49 @@
+"""Template bytecode cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_templating.py
+
+
+import os
+import tempfile
+from unittest import TestCase, mock
+
+from config import TestingConfig
+from models import db
+from templating import warm_templates
+from app import create_app
+
+
+class TemplatingTestCase(TestCase):
+    """Test compiling templates ahead of the first request."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+        class Config(TestingConfig):
+            TEMPLATE_CACHE_DIR = self.directory
+
+        self.config = Config
+        self.app = db.app
+
+    def tearDown(self):
+        # Creating apps rebinds db; give it back to the other tests
+        db.app = self.app
+
+    def test_warm_templates(self):
+        """Are templates compiled once, then loaded by other apps from disk?"""
+
+        count = warm_templates(create_app(self.config))
+
+        self.assertGreater(count, 10)
+        cached = os.listdir(self.directory)
+        self.assertEqual(len(cached), count)
+        self.assertTrue(all(name.endswith('.cache') for name in cached))
+
+        # Another worker (or a restart) compiles nothing
+        app = create_app(self.config)
+
+        with mock.patch.object(app.jinja_env, 'compile') as compile:
+            self.assertEqual(warm_templates(app), count)
+            compile.assert_not_called()
@@ -5,22 +5,12 @@
 #    python -m unittest test_user_model.py
 
 
-import os
 from unittest import TestCase
 
 from models import db, User, Message, Follows
+from app import create_app
 
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
-
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
-
-
-# Now we can import app
-
-from app import app
+app = create_app('testing')
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -67,8 +57,8 @@ class UserModelTestCase(TestCase):
         db.session.commit()
 
         # User should have no messages & no followers
-        self.assertEqual(len(u.messages), 0)
-        self.assertEqual(len(u.followers), 0)
+        self.assertEqual(u.messages.count(), 0)
+        self.assertEqual(u.followers.count(), 0)
 
         # Does the repr method work as expected?
         self.assertEqual(repr(u), '<User #3: testuser, test@test.com>')
@@ -5,23 +5,19 @@
 #    FLASK_ENV=production python -m unittest test_user_views.py
 
 
+import io
 import os
-from unittest import TestCase
+import tempfile
+from unittest import TestCase, mock
 from urllib.parse import urlparse
 
 from models import db, connect_db, Message, User, Follows, Likes
+from queries import liked_ids
+from app import create_app, CURR_USER_KEY
+from images import ImageCache, ImageUnavailable, resized
+from querytrace import query_budget, QueryBudgetExceeded
 
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
-
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
-
-
-# Now we can import app
-
-from app import app, CURR_USER_KEY
+app = create_app('testing')
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -29,10 +25,6 @@ from app import app, CURR_USER_KEY
 
 db.create_all()
 
-# Don't have WTForms use CSRF at all, since it's a pain to test
-
-app.config['WTF_CSRF_ENABLED'] = False
-
 
 class UserViewTestCase(TestCase):
     """Test views for users."""
@@ -235,6 +227,16 @@ class UserViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertNotIn('@followeduser', html)
 
+            # Following twice or unfollowing a stranger changes nothing
+            c.post("/users/follow/2")
+            c.post("/users/follow/2")
+            self.assertEqual(Follows.query.count(), 1)
+
+            c.post("/users/stop-following/2")
+            resp = c.post("/users/stop-following/2")
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(Follows.query.count(), 0)
+
             # Log out for remaining assertions
             c.get('/logout')
 
@@ -247,6 +249,67 @@ class UserViewTestCase(TestCase):
             self.assertEqual(remove_resp.status_code, 302)
             self.assertEqual(urlparse(remove_resp.location).path, '/')
 
+    def test_bulk_follow(self):
+        """Can many users be followed and unfollowed in one request?"""
+
+        others = [User.signup(username=f"other{n}", email=f"other{n}@test.com",
+                              password="password", image_url=None)
+                  for n in range(3)]
+        db.session.commit()
+        ids = [user.id for user in others]
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.post("/users/follow", data={'user_ids': ids[:2]})
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(Follows.query.count(), 2)
+
+            # Existing follows, unknown users and oneself are skipped
+            resp = c.post("/users/follow", json={
+                'user_ids': ids + [9999, self.testuser.id]})
+            self.assertEqual(resp.get_json(), {'followed': [ids[2]]})
+            self.assertEqual(Follows.query.count(), 3)
+
+            resp = c.post("/users/stop-following", json={'user_ids': [ids[0], ids[1], 9999]})
+            self.assertEqual(resp.get_json(), {'unfollowed': ids[:2]})
+            self.assertEqual([f.user_being_followed_id for f in Follows.query], [ids[2]])
+
+            self.assertEqual(c.post("/users/follow", json={'user_ids': 'all'}).status_code, 400)
+            self.assertEqual(c.post("/users/follow", data={'user_ids': 'x'}).status_code, 400)
+
+    def test_query_budgets(self):
+        """Do user pages run a fixed number of queries however many users they show?"""
+
+        others = [User.signup(username=f"other{n}", email=f"other{n}@test.com",
+                              password="password", image_url=None)
+                  for n in range(6)]
+        db.session.flush()
+
+        for other in others:
+            db.session.add(Follows(user_being_followed_id=self.testuser.id,
+                                   user_following_id=other.id))
+            db.session.add(Follows(user_being_followed_id=other.id,
+                                   user_following_id=self.testuser.id))
+        db.session.commit()
+        user_id = self.testuser.id
+        other_ids = [other.id for other in others]
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            for url in ('/users', f'/users/{user_id}/followers',
+                        f'/users/{user_id}/following', f'/users/{user_id}'):
+                with query_budget(8):
+                    self.assertEqual(c.get(url).status_code, 200)
+
+            # A query per card is caught
+            with self.assertRaisesRegex(QueryBudgetExceeded, 'N\\+1'):
+                with query_budget(100):
+                    for other_id in other_ids:
+                        Follows.exists(follower_id=user_id, followed_id=other_id)
 
     def test_update_profile_form(self):
         """Does the profile update form display properly?"""
@@ -325,4 +388,228 @@ class UserViewTestCase(TestCase):
 
             # Routes should redirect to root
             self.assertEqual(resp.status_code, 302)
-            self.assertEqual(urlparse(resp.location).path, '/')
\ No newline at end of file
+            self.assertEqual(urlparse(resp.location).path, '/')
+
+    def test_likes(self):
+        """Can several users like a message, and do liked messages show as liked?"""
+
+        author = User.signup(username="author", email="author@test.com",
+                             password="author", image_url=None)
+        other = User.signup(username="other", email="other@test.com",
+                            password="other", image_url=None)
+        db.session.flush()
+
+        liked = Message(text="liked warble", user_id=author.id)
+        unliked = Message(text="unliked warble", user_id=author.id)
+        db.session.add_all([liked, unliked,
+                            Follows(user_being_followed_id=author.id,
+                                    user_following_id=self.testuser.id)])
+        db.session.flush()
+
+        db.session.add(Likes(user_id=other.id, message_id=liked.id))
+        db.session.commit()
+
+        self.assertEqual(liked_ids(db.session, other.id, [liked.id, unliked.id]), {liked.id})
+        self.assertEqual(liked_ids(db.session, other.id, []), set())
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.post(f"/users/add_like/{liked.id}")
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(Likes.query.filter_by(message_id=liked.id).count(), 2)
+
+            html = c.get("/").get_data(as_text=True)
+            self.assertEqual(html.count('btn-primary'), 1)
+            # Newest first, with each like button after its message
+            self.assertLess(html.index('<p>unliked warble'), html.index('<p>liked warble'))
+            self.assertLess(html.index('<p>liked warble'), html.index('btn-primary'))
+
+            html = c.get(f"/users/{self.testuser.id}/likes").get_data(as_text=True)
+            self.assertIn('liked warble', html)
+            self.assertNotIn('unliked warble', html)
+
+            # Liking again takes it back
+            c.post(f"/users/add_like/{liked.id}")
+            self.assertEqual(liked_ids(db.session, self.testuser.id, [liked.id]), set())
+
+    def test_image_proxy(self):
+        """Are user images served resized, cached and signed?"""
+
+        from PIL import Image
+
+        app.config['IMAGE_CACHE_DIR'] = tempfile.mkdtemp()
+        app.config['IMAGE_PROXY_ALLOW_FILES'] = True
+        app.extensions.pop('image_cache', None)
+
+        src = f"file://{os.path.abspath('static/images/warbler-hero.jpg')}"
+
+        with app.test_request_context():
+            url = resized(src, 'timeline')
+
+        with self.client as c:
+            resp = c.get(url)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.mimetype, 'image/jpeg')
+            self.assertIn('immutable', resp.headers['Cache-Control'])
+            self.assertEqual(Image.open(io.BytesIO(resp.data)).size, (96, 96))
+
+            # Served from the disk cache the second time
+            self.assertEqual(c.get(url).data, resp.data)
+
+            # Unsigned or unknown variants are refused
+            self.assertEqual(c.get(url.replace('/timeline/', '/hero/')).status_code, 404)
+            self.assertEqual(c.get(f"/images/huge/0000?src={src}").status_code, 404)
+
+        app.config['IMAGE_PROXY_ALLOW_FILES'] = False
+        app.extensions.pop('image_cache', None)
+
+    def test_image_cache_eviction(self):
+        """Does the image cache evict least recently used files?"""
+
+        cache = ImageCache(tempfile.mkdtemp(), max_bytes=400 * 1024,
+                           allow_files=True)
+        images = os.path.abspath('static/images')
+
+        cache.variant(f"file://{images}/signed-out-home.jpg", 'card')
+        old = cache._content_hash(f"file://{images}/signed-out-home.jpg")
+        self.assertTrue(os.path.exists(cache._path('originals', old)))
+
+        # The 1MB hero image pushes the older files out of the cache
+        path, mimetype = cache.variant(f"file://{images}/warbler-hero.jpg", 'card')
+
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(mimetype, 'image/jpeg')
+        self.assertFalse(os.path.exists(cache._path('originals', old)))
+        self.assertLessEqual(cache._scan_size(), 400 * 1024)
+
+
+class ImageProxyTestCase(TestCase):
+    """Test fetching image sources."""
+
+    def test_refuses_internal_hosts(self):
+        """Does the image proxy refuse internal addresses, even by redirect?"""
+
+        cache = ImageCache(tempfile.mkdtemp(), max_bytes=1024 * 1024)
+
+        for src in ('http://127.0.0.1/a.jpg', 'http://localhost:8080/a.jpg',
+                    'http://10.0.0.5/a.jpg', 'http://169.254.169.254/latest/meta-data/',
+                    'http://[::1]/a.jpg', 'http://[::ffff:192.168.0.1]/a.jpg',
+                    'ftp://93.184.216.34/a.jpg'):
+            with self.assertRaises(ImageUnavailable, msg=src):
+                cache.fetch(src)
+
+        redirect = mock.MagicMock(is_redirect=True,
+                                  headers={'Location': 'http://169.254.169.254/latest/'})
+        redirect.__enter__.return_value = redirect
+
+        with mock.patch('requests.get', return_value=redirect) as get:
+            with self.assertRaises(ImageUnavailable):
+                cache.fetch('http://93.184.216.34/a.jpg')
+
+        get.assert_called_once_with('http://93.184.216.34/a.jpg', stream=True, timeout=5,
+                                    allow_redirects=False)
+
+    def test_failures_cached(self):
+        """Is a source that failed not fetched again for a while?"""
+
+        import requests
+
+        cache = ImageCache(tempfile.mkdtemp(), max_bytes=1024 * 1024)
+        src = 'http://93.184.216.34/gone.jpg'
+
+        with mock.patch('requests.get', side_effect=requests.Timeout('timed out')) as get:
+            for _ in range(3):
+                with self.assertRaises(ImageUnavailable):
+                    cache.variant(src, 'card')
+
+        self.assertEqual(get.call_count, 1)
+
+        # Undecodable (or decompression bomb) sources are remembered too
+        bomb = os.path.join(tempfile.mkdtemp(), 'bomb.png')
+
+        from PIL import Image
+        Image.new('1', (20000, 20000)).save(bomb)
+
+        cache.allow_files = True
+
+        with self.assertRaises(ImageUnavailable):
+            cache.variant(f'file://{bomb}', 'card')
+        self.assertTrue(os.path.exists(cache._path('failures', cache._source_key(f'file://{bomb}'))))
+
+    def test_broken_source(self):
+        """Is a source whose body breaks off partway unavailable, not an error?"""
+
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        import threading
+
+        class Broken(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/png')
+
+                if self.path == '/chunked.png':
+                    # One chunk, then the connection drops
+                    self.send_header('Transfer-Encoding', 'chunked')
+                    self.end_headers()
+                    self.wfile.write(b'5\r\n\x89PNG\r\r\n')
+                else:
+                    self.send_header('Content-Encoding', 'gzip')
+                    self.send_header('Content-Length', '20')
+                    self.end_headers()
+                    self.wfile.write(b'not gzip at all, no!')
+
+                self.close_connection = True
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(('127.0.0.1', 0), Broken)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        cache = ImageCache(tempfile.mkdtemp(), max_bytes=1024 * 1024)
+
+        try:
+            with mock.patch('images.check_host'):
+                for path in ('/chunked.png', '/gzip.png'):
+                    with self.assertRaises(ImageUnavailable, msg=path):
+                        cache.fetch(f'http://127.0.0.1:{server.server_port}{path}')
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_refetch_changed_source(self):
+        """Is a source refetched after its original was evicted stored under
+        its new content hash, if it changed?"""
+
+        import hashlib
+        from PIL import Image
+
+        cache = ImageCache(tempfile.mkdtemp(), max_bytes=1024 * 1024, allow_files=True)
+        source = os.path.join(tempfile.mkdtemp(), 'avatar.png')
+        src = f'file://{source}'
+
+        Image.new('RGB', (50, 50), 'red').save(source)
+        first, _ = cache.variant(src, 'timeline')
+        os.remove(first)
+
+        Image.new('RGB', (50, 50), 'blue').save(source)
+        with open(source, 'rb') as changed:
+            new_hash = hashlib.sha256(changed.read()).hexdigest()
+
+        content_hash = cache._content_hash
+
+        def evicted(src):
+            """Look the source up, then lose its original to eviction."""
+
+            old_hash = content_hash(src)
+            os.remove(cache._path('originals', old_hash))
+            return old_hash
+
+        with mock.patch.object(cache, '_content_hash', side_effect=evicted):
+            path, _ = cache.variant(src, 'timeline')
+
+        self.assertEqual(os.path.basename(path), f'{new_hash}-timeline.jpg')
+        self.assertEqual(cache._content_hash(src), new_hash)
+        self.assertGreater(Image.open(path).getpixel((0, 0))[2], 200)